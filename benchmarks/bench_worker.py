@@ -0,0 +1,174 @@
+"""Times envexp's own operations inside a scratch copy of an envexp checkout.
+
+Run by `run_benchmarks.py` with the copied envexp directory as the working directory,
+so `envexp_utils` (and its ROOT_DIR) resolve to the scratch copy. Operations that an
+older envexp does not have are skipped, and only the arguments it supports are passed.
+
+Usage: python bench_worker.py <config.json> <results.json>
+"""
+
+import importlib
+import inspect
+import json
+import shutil
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path.cwd()))
+
+
+def find_function(module_name, function_name):
+    """Returns a function of envexp_utils, or None if this version does not have it."""
+
+    try:
+        module = importlib.import_module(f"envexp_utils.{module_name}")
+    except ImportError:
+        return None
+    return getattr(module, function_name, None)
+
+
+def call(function, **kwargs):
+    """Calls a function with only the keyword arguments it accepts."""
+
+    parameters = inspect.signature(function).parameters
+    return function(
+        **{key: value for key, value in kwargs.items() if key in parameters}
+    )
+
+
+def time_operation(setup, operation, repeat):
+    """Times an operation (after an untimed setup) a number of times.
+
+    Returns:
+        dict: The minimum and median wall time and the number of runs.
+    """
+
+    times = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+    return {
+        "min_s": round(min(times), 4),
+        "median_s": round(statistics.median(times), 4),
+        "runs": repeat,
+    }
+
+
+def run_benchmarks(config):
+    """Times each operation on the synthetic source tree and prefix.
+
+    Args:
+        config (dict): The 'source' tree, the 'repo_name', the 'library', the
+            'output_dir' for dependency logs and the number of times to 'repeat'.
+
+    Returns:
+        dict: Mapping of operation name to its timings (or to None if unavailable).
+    """
+
+    from envexp_utils.file import EXP_DIR
+
+    source = Path(config["source"])
+    repo_name = config["repo_name"]
+    output_path = EXP_DIR / repo_name
+    repeat = config["repeat"]
+
+    find_and_copy_imports = find_function("code_edit", "find_and_copy_imports")
+    copy_repo = find_function("code_edit", "copy_repo")
+    delete_old_experiment_code = find_function(
+        "code_edit", "delete_old_experiment_code"
+    )
+    gitignore_repo = find_function("commit", "gitignore_repo")
+    un_gitignore_prev_repo = find_function("commit", "un_gitignore_prev_repo")
+    log_dependencies = find_function("log", "log_dependencies")
+    commit_changes = find_function("commit", "commit_changes")
+
+    def clean():
+        shutil.rmtree(output_path, ignore_errors=True)
+
+    def copied():
+        clean()
+        call(copy_repo, input_dir=source, output_path=output_path)
+
+    def scan(use_index):
+        output_path.mkdir(parents=True, exist_ok=True)
+        call(
+            find_and_copy_imports,
+            input_dir=source,
+            output_path=output_path,
+            library=config["library"],
+            nested=True,
+            use_index=use_index,
+        )
+
+    def ignored():
+        copied()
+        gitignore_repo(repo_name)
+
+    def commit():
+        with open(EXP_DIR.parent / "test.log", "a") as log:
+            log.write(f"{time.time()}\n")
+        commit_changes(commit_message="P: benchmark")
+
+    operations = {
+        "find_and_copy_imports": (
+            [find_and_copy_imports],
+            clean,
+            lambda: scan(use_index=False),
+        ),
+        "find_and_copy_imports[indexed]": (
+            [find_and_copy_imports],
+            lambda: scan(use_index=True),
+            lambda: scan(use_index=True),
+        ),
+        "copy_repo": (
+            [copy_repo],
+            clean,
+            lambda: call(copy_repo, input_dir=source, output_path=output_path),
+        ),
+        "delete_old_experiment_code": (
+            [copy_repo, gitignore_repo, delete_old_experiment_code],
+            ignored,
+            delete_old_experiment_code,
+        ),
+        "un_gitignore_prev_repo": (
+            [gitignore_repo, un_gitignore_prev_repo],
+            lambda: gitignore_repo(repo_name),
+            un_gitignore_prev_repo,
+        ),
+        "log_dependencies": (
+            [log_dependencies],
+            lambda: None,
+            lambda: call(
+                log_dependencies,
+                conda_command="conda",
+                output_dir=Path(config["output_dir"]),
+            ),
+        ),
+        "commit": (
+            [copy_repo, gitignore_repo, commit_changes],
+            ignored,
+            commit,
+        ),
+    }
+
+    results = {}
+    for name, (functions, setup, operation) in operations.items():
+        if not all(functions):
+            print(f"\t... skipping {name} (not in envexp)", file=sys.stderr)
+            results[name] = None
+            continue
+        print(f"\nTiming {name}...", file=sys.stderr)
+        results[name] = time_operation(setup, operation, repeat)
+    clean()
+    if un_gitignore_prev_repo is not None:
+        un_gitignore_prev_repo()
+    return results
+
+
+if __name__ == "__main__":
+    config = json.loads(Path(sys.argv[1]).read_text())
+    Path(sys.argv[2]).write_text(json.dumps(run_benchmarks(config), indent=2))
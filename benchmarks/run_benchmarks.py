@@ -0,0 +1,211 @@
+"""Benchmarks envexp's own operations on synthetic source trees of increasing size.
+
+Each envexp checkout under test is copied into a scratch repository, so the real
+results, caches and git history are not touched. A stand-in conda executable returns
+canned output that points at a synthetic environment prefix, so no conda is needed.
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes 1000,10000,100000
+    python benchmarks/run_benchmarks.py --envexp-dir ../old/envexp --compare <json>
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from synthetic import LIBRARY, make_fake_conda, make_prefix, make_source_tree
+
+# Configure benchmark defaults
+BENCH_DIR = Path(__file__).resolve().parent
+DEFAULT_ENVEXP_DIR = BENCH_DIR.parent / "envexp"
+RESULTS_DIR = BENCH_DIR / "results"
+DEFAULT_SIZES = "1000,10000"
+DEFAULT_REPEAT = 3
+REPO_NAME = "synthrepo"
+REGRESSION_RATIO = 1.2  # Slowdown (relative to the baseline) reported as a regression
+REGRESSION_MIN_SECONDS = 0.05  # Slowdowns of faster operations are timer noise
+
+
+def describe_version(envexp_dir):
+    """Returns the short commit (and whether it has changes) of an envexp checkout."""
+
+    output = subprocess.run(
+        ["git", "describe", "--always", "--dirty"],
+        cwd=envexp_dir,
+        capture_output=True,
+        text=True,
+    )
+    if output.returncode != 0:
+        return "unknown"
+    return output.stdout.strip()
+
+
+def make_scratch_repo(envexp_dir, root):
+    """Copies an envexp checkout into a fresh git repository (with one commit)."""
+
+    shutil.rmtree(root, ignore_errors=True)
+    shutil.copytree(
+        envexp_dir,
+        root / "envexp",
+        ignore=shutil.ignore_patterns("__pycache__", "*.pyc"),
+    )
+    (root / "test.log").touch()
+    for args in [
+        ["init", "-q"],
+        ["config", "user.email", "bench@envexp"],
+        ["config", "user.name", "envexp benchmark"],
+        ["add", "-A"],
+        ["commit", "-q", "-m", "Scratch copy of envexp"],
+    ]:
+        subprocess.run(["git", *args], cwd=root, check=True)
+    return root
+
+
+def run_worker(root, config, bin_dir, cache_dir):
+    """Runs the benchmark worker in the scratch copy of envexp.
+
+    Returns:
+        dict: Mapping of operation name to its timings.
+    """
+
+    config_path = root / "bench_config.json"
+    results_path = root / "bench_results.json"
+    config_path.write_text(json.dumps(config))
+
+    env = dict(os.environ)
+    env["PATH"] = f"{bin_dir}{os.pathsep}{env.get('PATH', '')}"
+    env["ENVEXP_CACHE_DIR"] = str(cache_dir)
+    subprocess.run(
+        [
+            sys.executable,
+            str(BENCH_DIR / "bench_worker.py"),
+            str(config_path),
+            str(results_path),
+        ],
+        cwd=root / "envexp",
+        env=env,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    return json.loads(results_path.read_text())
+
+
+def compare_results(results, baseline):
+    """Prints the ratio of each timing to the baseline and flags regressions."""
+
+    print(f"\nComparing {results['version']} to {baseline['version']}...")
+    regressions = 0
+    for size, operations in results["sizes"].items():
+        for name, timing in operations.items():
+            previous = baseline["sizes"].get(size, {}).get(name)
+            if timing is None or previous is None:
+                continue
+            ratio = timing["min_s"] / max(previous["min_s"], 1e-4)
+            slower = timing["min_s"] - previous["min_s"] > REGRESSION_MIN_SECONDS
+            flag = "  <-- regression" if ratio > REGRESSION_RATIO and slower else ""
+            regressions += bool(flag)
+            print(f"\t{size:>7} files  {name:<32} {ratio:5.2f}x{flag}")
+    print(f"\t... {regressions} regressions (slower than {REGRESSION_RATIO}x)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default=DEFAULT_SIZES,
+        help="Comma separated numbers of files of the synthetic source trees.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help="Number of times to time each operation.",
+    )
+    parser.add_argument(
+        "--envexp-dir",
+        type=Path,
+        default=DEFAULT_ENVEXP_DIR,
+        help="The envexp directory to benchmark (e.g. of an older checkout).",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "envexp-bench",
+        help="Scratch directory (the synthetic source trees are reused).",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help="Path of the results. Defaults to benchmarks/results/<version>.json.",
+    )
+    parser.add_argument(
+        "--compare",
+        type=Path,
+        default=None,
+        help="Results of a previous run to compare against.",
+    )
+    args = parser.parse_args()
+
+    envexp_dir = args.envexp_dir.resolve()
+    work_dir = args.work_dir.resolve()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    version = describe_version(envexp_dir)
+
+    print(f"\nBenchmarking envexp {version} [{envexp_dir}]...")
+    prefix = make_prefix(work_dir / "envs" / "experiment")
+    bin_dir = make_fake_conda(work_dir / "bin", prefix=prefix)
+
+    results = {
+        "version": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "sizes": {},
+    }
+    for size in sizes:
+        print(f"\nGenerating synthetic source tree of {size} files...")
+        source = make_source_tree(work_dir / "src" / str(size) / REPO_NAME, size)
+        root = make_scratch_repo(envexp_dir, work_dir / "root")
+        cache_dir = work_dir / "cache"
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        print(f"Timing operations on {size} files...")
+        config = {
+            "source": str(source),
+            "repo_name": REPO_NAME,
+            "library": LIBRARY,
+            "output_dir": str(work_dir / "logs"),
+            "repeat": args.repeat,
+        }
+        timings = run_worker(root, config, bin_dir=bin_dir, cache_dir=cache_dir)
+        results["sizes"][str(size)] = timings
+        for name, timing in timings.items():
+            if timing is None:
+                print(f"\t{name:<32} (not in this version)")
+            else:
+                print(
+                    f"\t{name:<32} min {timing['min_s']:8.3f}s  "
+                    f"median {timing['median_s']:8.3f}s"
+                )
+
+    output = args.output or RESULTS_DIR / f"{version}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"\nSaved results to {output}")
+
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text())
+        if compare_results(results, baseline):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
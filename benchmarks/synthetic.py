@@ -0,0 +1,197 @@
+"""Defines generators of synthetic inputs for benchmarking envexp.
+
+A synthetic source tree stands in for the repo under test, a synthetic prefix for the
+experiment environment, and a stand-in conda executable returns canned output that
+points at the synthetic prefix.
+"""
+
+import json
+import platform
+import random
+import stat
+import sys
+from pathlib import Path
+
+# Configure the synthetic source tree
+LIBRARY = "qtpy"  # The library whose imports are scanned for
+FILES_PER_PACKAGE = 50
+MODULE_FUNCTIONS = 40  # Filler functions per module
+TREE_MARKER = ".envexp-bench-tree"
+
+# Configure the synthetic environment prefix
+PREFIX_PACKAGES = 300
+PREFIX_DISTRIBUTIONS = 150
+
+# Import statements of varied styles (formatted with a random module and name)
+IMPORT_STYLES = [
+    "import {library}",
+    "import {library}.{module}",
+    "import {library}.{module} as {alias}",
+    "from {library} import {name}",
+    "from {library}.{module} import {name}, {other}",
+    "from {library}.{module} import (\n    {name},\n    {other},\n)",
+    "import os, {library}.{module}",
+    "from . import {sibling}",
+    "from .{sibling} import {name}",
+    "import numpy as np",
+    "from collections import OrderedDict",
+]
+NESTED_STYLES = [
+    "try:\n    {statement}\nexcept ImportError:\n    pass",
+    "if TYPE_CHECKING:\n    {statement}",
+    "def load():\n    {statement}\n    return None",
+]
+MODULES = ["QtCore", "QtGui", "QtWidgets", "QtNetwork", "compat", "uic"]
+NAMES = ["Signal", "Slot", "QWidget", "QTimer", "QPixmap", "QThread", "Property"]
+
+
+def make_module(rng, package_files):
+    """Returns the source of a synthetic module with varied import styles."""
+
+    def statement():
+        return rng.choice(IMPORT_STYLES).format(
+            library=LIBRARY,
+            module=rng.choice(MODULES),
+            alias=f"alias_{rng.randrange(100)}",
+            name=rng.choice(NAMES),
+            other=rng.choice(NAMES),
+            sibling=rng.choice(package_files),
+        )
+
+    lines = ['"""Synthetic module."""', "from typing import TYPE_CHECKING"]
+    lines += [statement() for _ in range(rng.randint(2, 8))]
+    for _ in range(rng.randint(0, 3)):
+        lines.append(rng.choice(NESTED_STYLES).format(statement=statement()))
+    for idx in range(MODULE_FUNCTIONS):
+        lines.append(f"def function_{idx}(value):\n    return value * {idx}\n")
+    return "\n".join(lines) + "\n"
+
+
+def make_source_tree(directory, num_files, seed=0):
+    """Writes a synthetic repo of Python packages (reused if it already exists).
+
+    Args:
+        directory (Path): The directory of the repo, e.g. '<work dir>/src/synthrepo'.
+        num_files (int): The number of .py files to write.
+        seed (int): The seed of the random import styles.
+
+    Returns:
+        Path: The directory of the repo.
+    """
+
+    directory = Path(directory)
+    marker = directory / TREE_MARKER
+    if marker.exists() and marker.read_text() == f"{num_files}:{seed}":
+        return directory
+
+    rng = random.Random(seed)
+    written = 0
+    package_idx = 0
+    while written < num_files:
+        package = directory / f"package_{package_idx // 20}" / f"module_{package_idx}"
+        package.mkdir(parents=True, exist_ok=True)
+        count = min(FILES_PER_PACKAGE, num_files - written)
+        package_files = [f"file_{idx}" for idx in range(1, count)] or ["file_0"]
+        (package / "__init__.py").write_text(f"from .{package_files[0]} import *\n")
+        for name in package_files[: count - 1]:
+            (package / f"{name}.py").write_text(make_module(rng, package_files))
+        written += count
+        package_idx += 1
+
+    (directory / ".gitignore").write_text("build/\n*.egg-info/\n")
+    marker.write_text(f"{num_files}:{seed}")
+    return directory
+
+
+def make_prefix(directory, num_packages=PREFIX_PACKAGES, seed=0):
+    """Writes a synthetic environment prefix with conda records and dist-infos.
+
+    Args:
+        directory (Path): The prefix. Its name is the environment name.
+        num_packages (int): The number of conda packages.
+        seed (int): The seed of the random dependencies.
+
+    Returns:
+        Path: The prefix.
+    """
+
+    rng = random.Random(seed)
+    prefix = Path(directory)
+    conda_meta = prefix / "conda-meta"
+    site_packages = prefix / "lib" / "python3.10" / "site-packages"
+    conda_meta.mkdir(parents=True, exist_ok=True)
+    site_packages.mkdir(parents=True, exist_ok=True)
+
+    names = [f"package-{idx}" for idx in range(num_packages)]
+    for idx, name in enumerate(names):
+        dist_info = f"package_{idx}-1.{idx}.0.dist-info"
+        record = {
+            "name": name,
+            "version": f"1.{idx}.0",
+            "build": f"py310h{idx:06x}_0",
+            "channel": "https://conda.anaconda.org/conda-forge/linux-64",
+            "depends": [f"{dep} >=1" for dep in rng.sample(names[:idx], min(idx, 3))],
+            "files": [f"lib/python3.10/site-packages/{dist_info}/METADATA"],
+        }
+        (conda_meta / f"{name}-1.{idx}.0-{record['build']}.json").write_text(
+            json.dumps(record)
+        )
+        if idx < PREFIX_DISTRIBUTIONS:
+            (site_packages / dist_info).mkdir(exist_ok=True)
+            requires = "".join(
+                f"Requires-Dist: {dep}\n" for dep in record["depends"]
+            ).replace(" >=1", ">=1")
+            (site_packages / dist_info / "METADATA").write_text(
+                f"Metadata-Version: 2.1\nName: {name}\nVersion: 1.{idx}.0\n{requires}"
+            )
+
+    # The python executable only has to exist to be found
+    python = prefix / ("python.exe" if platform.system() == "Windows" else "bin/python")
+    python.parent.mkdir(parents=True, exist_ok=True)
+    if not python.exists():
+        python.write_bytes(b"")
+    return prefix
+
+
+FAKE_CONDA_SOURCE = '''"""Stand-in conda executable (returns canned output)."""
+
+import json
+import sys
+
+PREFIX = {prefix!r}
+HELP = "  --file FILE\\n  --clone ENV\\n  --dry-run\\n  --json\\n"
+
+args = sys.argv[1:]
+if args[:1] == ["--version"]:
+    print("conda 24.1.0")
+elif args[:2] == ["env", "list"]:
+    print(json.dumps({{"envs": [PREFIX]}}))
+elif "--help" in args:
+    print(HELP)
+'''
+
+
+def make_fake_conda(bin_dir, prefix):
+    """Writes a stand-in `conda` executable that reports the synthetic prefix.
+
+    Args:
+        bin_dir (Path): The directory to put on the PATH.
+        prefix (Path): The synthetic prefix that `conda env list` reports.
+
+    Returns:
+        Path: The directory of the executable.
+    """
+
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    script = bin_dir / "fake_conda.py"
+    script.write_text(FAKE_CONDA_SOURCE.format(prefix=str(prefix)))
+
+    if platform.system() == "Windows":
+        (bin_dir / "conda.bat").write_text(f'@"{sys.executable}" "{script}" %*\n')
+    else:
+        executable = bin_dir / "conda"
+        executable.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{script}" "$@"\n')
+        executable.chmod(executable.stat().st_mode | stat.S_IEXEC)
+    return bin_dir
+
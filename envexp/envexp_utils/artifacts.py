@@ -0,0 +1,241 @@
+"""Defines a compressed, content-addressed store of run artifacts.
+
+With --compact-artifacts, the large result files of a run (e.g. test.log and the
+inventories) are stored compressed in the artifact store, named by the sha256 of their
+contents so identical files (e.g. the inventories of runs in the same environment) are
+stored once. Only a small manifest of the stored files is committed, from which the
+files of any run can be expanded again.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import subprocess
+import zlib
+from pathlib import Path
+
+from envexp_utils.file import CACHE_DIR, ROOT_DIR
+
+try:
+    import zstandard
+except ImportError:  # Optional, artifacts are gzipped without it
+    zstandard = None
+
+# Configure the artifact store (e.g. a shared directory, so clones can expand runs)
+ARTIFACT_STORE = Path(os.environ.get("ENVEXP_ARTIFACT_STORE", CACHE_DIR / "artifacts"))
+ARTIFACT_MANIFEST = ROOT_DIR / "artifacts.json"
+ARTIFACT_MANIFEST_VERSION = 1
+DEFAULT_ARTIFACT_BUDGET_GB = 5.0
+ZSTD_LEVEL = 10
+GZIP_LEVEL = 9
+
+
+def object_path(digest, suffix):
+    """Returns the path of a stored object, e.g. 'objects/ab/abcd....zst'."""
+
+    return ARTIFACT_STORE / "objects" / digest[:2] / f"{digest}{suffix}"
+
+
+def find_object(digest):
+    """Returns the path of a stored object (in any compression), or None."""
+
+    for suffix in (".zst", ".gz"):
+        path = object_path(digest, suffix)
+        if path.exists():
+            return path
+    return None
+
+
+def compress(data):
+    """Compresses data with zstd (if installed) or gzip.
+
+    Returns:
+        tuple[bytes, str]: The compressed data and the suffix of its compression.
+    """
+
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), ".zst"
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0), ".gz"
+
+
+def decompress(path):
+    """Reads and decompresses a stored object."""
+
+    data = Path(path).read_bytes()
+    if path.suffix == ".zst":
+        if zstandard is None:
+            raise ImportError(
+                f"Reading [{path}] requires the zstandard package to be installed."
+            )
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return gzip.decompress(data)
+
+
+def store_artifact(data):
+    """Stores data in the artifact store (once per content).
+
+    Returns:
+        tuple[str, bool]: The sha256 of the data and whether it was newly stored.
+    """
+
+    digest = hashlib.sha256(data).hexdigest()
+    existing = find_object(digest)
+    if existing is not None:
+        # Mark the object as recently used, so it is pruned last
+        os.utime(existing)
+        return digest, False
+
+    compressed, suffix = compress(data)
+    path = object_path(digest, suffix)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(compressed)
+    os.replace(tmp_path, path)
+    return digest, True
+
+
+def read_artifact(digest):
+    """Returns the contents of a stored object, or None if it is not in the store."""
+
+    path = find_object(digest)
+    if path is None:
+        return None
+    try:
+        return decompress(path)
+    except (OSError, EOFError, zlib.error):
+        return None
+
+
+def compact_artifacts(paths, budget_gb=DEFAULT_ARTIFACT_BUDGET_GB):
+    """Stores result files in the artifact store and writes the manifest of the run.
+
+    Args:
+        paths (list[Path]): The result files (and directories of result files) to
+            store. Missing paths are skipped.
+        budget_gb (float): The disk budget of the artifact store in GB.
+
+    Returns:
+        list[str]: The stored files, relative to the root directory.
+    """
+
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files += sorted(file for file in path.rglob("*") if file.is_file())
+        elif path.exists():
+            files.append(path)
+
+    print(f"\nStoring {len(files)} run artifacts in [{ARTIFACT_STORE}]...")
+    manifest = {"version": ARTIFACT_MANIFEST_VERSION, "files": {}}
+    new_files, total_size = 0, 0
+    for file in files:
+        data = file.read_bytes()
+        digest, new = store_artifact(data)
+        new_files += new
+        total_size += len(data)
+        relative_path = file.relative_to(ROOT_DIR).as_posix()
+        manifest["files"][relative_path] = {"sha256": digest, "size": len(data)}
+    print(
+        f"\t... {new_files} new, {len(files) - new_files} already stored "
+        f"({total_size / 1024**2:.1f} MB uncompressed)"
+    )
+
+    ARTIFACT_MANIFEST.write_text(json.dumps(manifest, indent=2) + "\n")
+    prune_artifact_store(budget_gb=budget_gb)
+    return list(manifest["files"])
+
+
+def read_manifest_file(manifest_text, relative_path):
+    """Reads a file listed in a committed manifest from the artifact store.
+
+    Returns:
+        str: The contents of the file, or None if it is not listed or not stored.
+    """
+
+    try:
+        manifest = json.loads(manifest_text)
+    except json.JSONDecodeError:
+        return None
+    entry = manifest.get("files", {}).get(relative_path)
+    if entry is None:
+        return None
+    data = read_artifact(entry["sha256"])
+    return None if data is None else data.decode(errors="replace")
+
+
+def expand_artifacts(rev, output_dir=None):
+    """Expands the artifacts committed (as a manifest) at a revision.
+
+    Args:
+        rev (str): The revision of the run, e.g. the hash of an 'F:' commit.
+        output_dir (Path): The directory to write the files to. Defaults to
+            'expanded/<short commit hash>' in the root directory.
+
+    Returns:
+        list[Path]: The expanded files.
+    """
+
+    output = subprocess.run(
+        ["git", "show", f"{rev}:{ARTIFACT_MANIFEST.relative_to(ROOT_DIR).as_posix()}"],
+        capture_output=True,
+        text=True,
+        cwd=ROOT_DIR,
+    )
+    if output.returncode != 0:
+        raise ValueError(f"No artifact manifest is committed at {rev}.")
+    manifest = json.loads(output.stdout)
+
+    if output_dir is None:
+        # Named by the commit, so e.g. HEAD~1 is not expanded to a moving name
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", rev],
+            capture_output=True,
+            text=True,
+            cwd=ROOT_DIR,
+        ).stdout.strip()
+        output_dir = ROOT_DIR / "expanded" / commit
+    output_dir = Path(output_dir)
+    print(f"\nExpanding the artifacts of {rev} to [{output_dir}]...")
+
+    expanded, missing = [], []
+    for relative_path, entry in manifest["files"].items():
+        data = read_artifact(entry["sha256"])
+        if data is None:
+            missing.append(relative_path)
+            continue
+        path = output_dir / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        expanded.append(path)
+        print(f"\t{relative_path} ({entry['size']} bytes)")
+
+    if missing:
+        print(f"\t... {len(missing)} artifacts are not in the store: {missing}")
+    return expanded
+
+
+def prune_artifact_store(budget_gb=DEFAULT_ARTIFACT_BUDGET_GB):
+    """Removes the least recently used objects until the store is within the budget.
+
+    Runs whose objects were pruned can no longer be expanded.
+    """
+
+    objects = [
+        (path.stat().st_mtime, path.stat().st_size, path)
+        for path in (ARTIFACT_STORE / "objects").glob("*/*")
+        if path.suffix in (".zst", ".gz")
+    ]
+    budget = budget_gb * 1024**3
+    total = sum(size for _, size, _ in objects)
+
+    pruned = 0
+    for _, size, path in sorted(objects):
+        if total <= budget:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        pruned += 1
+    if pruned:
+        print(f"\t... pruned {pruned} least recently used artifacts")
+    return pruned
@@ -0,0 +1,302 @@
+"""Defines functions for bisecting package versions between two environments."""
+
+import hashlib
+from pathlib import Path
+
+from envexp_utils.cache import DEFAULT_CACHE_BUDGET_GB
+from envexp_utils.environment import read_pip_requirements
+from envexp_utils.file import EXP_DIR, ROOT_DIR
+from envexp_utils.lockfile import parse_package_filename
+from envexp_utils.log import logger
+from envexp_utils.matrix import FAILED, run_variant
+
+# Configure bisection outputs
+BISECT_DIR = ROOT_DIR / "bisect"
+BISECT_RESULTS = ROOT_DIR / "bisect_results.txt"
+
+# The experiment package itself is installed from the pip section of environment.yml
+EXPERIMENT_PACKAGE = "experiment"
+# The column header of `mamba list` (and `micromamba list`) output
+PACKAGE_LIST_HEADER = ["Name", "Version", "Build", "Channel"]
+
+
+def parse_package_list(text):
+    """Parses the packages of an environment from a mamba_list.txt or explicit lockfile.
+
+    Args:
+        text (str): The contents of a mamba_list.txt (output of `mamba list`) or of
+            an explicit lockfile (output of `mamba list --explicit`).
+
+    Returns:
+        dict: Mapping of package name to a dict with version, build and channel.
+    """
+
+    packages = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or line.startswith("@"):
+            continue
+        # The uncommented header of `micromamba list` output and its separator line
+        if line.startswith("List of packages in environment"):
+            continue
+        if line.split()[:4] == PACKAGE_LIST_HEADER or not line.strip("─-=━ "):
+            continue
+
+        # Explicit lockfile line, e.g. https://.../conda-forge/noarch/name-1.0-0.conda
+        if "://" in line:
+            url = line.split("#")[0]
+            channel_and_subdir, package_filename = url.rsplit("/", 1)
+            name, version, build = parse_package_filename(package_filename)
+            channel = channel_and_subdir.rsplit("/", 1)[0]
+        # mamba list line, e.g. name  1.0  h0  conda-forge
+        else:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            name, version, build = fields[:3]
+            channel = fields[3] if len(fields) > 3 else "defaults"
+
+        packages[name] = {"version": version, "build": build, "channel": channel}
+    return packages
+
+
+def read_package_list(filename):
+    """Reads the packages of an environment from a mamba_list.txt or explicit lockfile.
+
+    Args:
+        filename (Path): The mamba_list.txt (output of `mamba list`) or the explicit
+            lockfile (output of `mamba list --explicit`).
+
+    Returns:
+        dict: Mapping of package name to a dict with version, build and channel.
+    """
+
+    return parse_package_list(Path(filename).read_text())
+
+
+def diff_package_lists(good_packages, bad_packages):
+    """Returns the sorted names of packages that differ between the two environments."""
+
+    names = set(good_packages) | set(bad_packages)
+    return sorted(
+        name
+        for name in names
+        if name != EXPERIMENT_PACKAGE
+        and good_packages.get(name) != bad_packages.get(name)
+    )
+
+
+def describe_change(name, good_packages, bad_packages):
+    """Describes how a package differs between the good and bad environments."""
+
+    def describe(package):
+        if package is None:
+            return "(absent)"
+        return f"{package['version']} ({package['build']})"
+
+    good, bad = good_packages.get(name), bad_packages.get(name)
+    return f"{name}: {describe(good)} -> {describe(bad)}"
+
+
+def absolutize_pip_requirement(requirement):
+    """Makes local paths in a pip requirement absolute (relative to envexp/)."""
+
+    editable = requirement.startswith("-e ")
+    target = requirement[3:].strip() if editable else requirement
+    if target.startswith("."):
+        target = (EXP_DIR / target).resolve().as_posix()
+    return f"-e {target}" if editable else target
+
+
+def write_candidate_environment(packages):
+    """Writes a fully pinned environment file for a candidate set of packages.
+
+    Returns:
+        Path: The path of the candidate environment file.
+    """
+
+    channels = []
+    conda_lines = []
+    pip_lines = []
+    for name, package in sorted(packages.items()):
+        if name == EXPERIMENT_PACKAGE:
+            continue
+        if package["channel"] == "pypi":
+            pip_lines.append(f"{name}=={package['version']}")
+            continue
+        if package["channel"] not in channels:
+            channels.append(package["channel"])
+        conda_lines.append(f"{name}={package['version']}={package['build']}")
+    pip_lines += [absolutize_pip_requirement(req) for req in read_pip_requirements()]
+
+    lines = ["channels:"]
+    lines += [f"  - {channel}" for channel in channels]
+    lines += ["dependencies:"]
+    lines += [f"  - {line}" for line in conda_lines]
+    if pip_lines:
+        lines += ["  - pip:"]
+        lines += [f"    - {line}" for line in pip_lines]
+    content = "\n".join(lines) + "\n"
+
+    candidate_hash = hashlib.sha256(content.encode()).hexdigest()[:8]
+    candidate_file = BISECT_DIR / f"candidate-{candidate_hash}.yml"
+    BISECT_DIR.mkdir(parents=True, exist_ok=True)
+    candidate_file.write_text(content)
+    return candidate_file
+
+
+def find_culprits(changes, is_bad, applied=()):
+    """Finds a minimal set of changes that turns a good environment bad.
+
+    Assumes the environment with only the `applied` changes is good and the
+    environment with the `applied` and all `changes` is bad. A half that cannot be
+    tested (e.g. its environment cannot be built) is not narrowed onto; the search
+    continues with the other half pulled in instead.
+
+    Args:
+        changes (list[str]): The changes to search.
+        is_bad (callable): Returns True if the environment with the given changes
+            applied is bad, False if it is good and None if it cannot be tested.
+        applied (tuple[str]): The changes that are always applied.
+
+    Returns:
+        list[str]: The minimal set of culprit changes.
+    """
+
+    changes = list(changes)
+    if len(changes) <= 1:
+        return changes
+
+    half = len(changes) // 2
+    first, second = changes[:half], changes[half:]
+    first_bad = is_bad(tuple(applied) + tuple(first))
+    if first_bad is True:
+        return find_culprits(first, is_bad, applied)
+    second_bad = is_bad(tuple(applied) + tuple(second))
+    if second_bad is True:
+        return find_culprits(second, is_bad, applied)
+
+    # Neither half is (testably) bad on its own, so the culprits interact across both
+    # halves (or are in an untestable half). One half is searched with the other
+    # applied, the untestable half first, as the other half is then known to be good
+    searched, other, searched_bad = first, second, first_bad
+    if second_bad is None and first_bad is False:
+        searched, other, searched_bad = second, first, second_bad
+    culprits = find_culprits(searched, is_bad, tuple(applied) + tuple(other))
+    if searched_bad is None and is_bad(tuple(applied) + tuple(culprits)) is True:
+        # The culprits of the untestable half are bad without the other half
+        return culprits
+    culprits += find_culprits(other, is_bad, tuple(applied) + tuple(culprits))
+    return [change for change in changes if change in culprits]
+
+
+def bisect_environments(
+    conda_command,
+    good_file,
+    bad_file,
+    repo_name=None,
+    use_cache=True,
+    budget_gb=DEFAULT_CACHE_BUDGET_GB,
+    timeout=None,
+    pythonpath=None,
+    offline=False,
+    use_pool=True,
+    test_limits=None,
+):
+    """Bisects the package versions between a known-good and a known-bad environment.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        good_file (Path): The mamba_list.txt or explicit lockfile of the good run.
+        bad_file (Path): The mamba_list.txt or explicit lockfile of the bad run.
+        repo_name (str): The name of the repo to test imports for. If None, testing
+            the repo import is skipped.
+        use_cache (bool): Whether to look up and store environments in the cache.
+        budget_gb (float): The disk budget for all cached environments in GB.
+        timeout (float): Seconds after which a hung import or test step is killed.
+        pythonpath (Path): A directory to add to PYTHONPATH to import the repo from.
+        offline (bool): Whether to build only from the managed package directory.
+        use_pool (bool): Whether to build from the closest base of the warm pool.
+        test_limits (dict): The limits of the user test functions (see `test_code`).
+
+    Candidates whose environment cannot be built (e.g. the exact pins of the two
+    solves are unsatisfiable together) are untestable: they are neither good nor bad
+    and are reported separately.
+
+    Returns:
+        list[str]: The names of the culprit packages.
+    """
+
+    good_packages = read_package_list(good_file)
+    bad_packages = read_package_list(bad_file)
+    changes = diff_package_lists(good_packages, bad_packages)
+    print(f"\nBisecting {len(changes)} differing packages...")
+
+    results = {}
+
+    def is_bad(applied):
+        """Builds and tests the good environment with the applied changes.
+
+        Returns:
+            bool: Whether the imports or tests failed, or None if the environment
+                could not be built.
+        """
+
+        key = frozenset(applied)
+        if key not in results:
+            packages = dict(good_packages)
+            for name in applied:
+                if name in bad_packages:
+                    packages[name] = bad_packages[name]
+                else:
+                    packages.pop(name, None)
+
+            print(f"\nTesting candidate with {len(applied)}/{len(changes)} changes...")
+            result = run_variant(
+                conda_command=conda_command,
+                environment_file=write_candidate_environment(packages),
+                repo_name=repo_name,
+                use_cache=use_cache,
+                budget_gb=budget_gb,
+                timeout=timeout,
+                pythonpath=pythonpath,
+                offline=offline,
+                use_pool=use_pool,
+                test_limits=test_limits,
+            )
+            if result["environment"] == FAILED:
+                results[key] = None
+            else:
+                results[key] = any(
+                    result[step] == FAILED for step in ("imports", "tests")
+                )
+            status = {True: "bad", False: "good", None: "untestable"}[results[key]]
+            logger.info(
+                f"Bisect candidate [{result['variant']}] with {len(applied)} changes: "
+                f"{status}"
+            )
+        return results[key]
+
+    if not changes:
+        culprits = []
+    else:
+        bad = is_bad(tuple(changes))
+        if bad is None:
+            raise Exception("The bad environment could not be built to bisect!")
+        if not bad:
+            raise Exception(
+                "The bad environment passed, so there is nothing to bisect!"
+            )
+        culprits = find_culprits(changes, is_bad)
+
+    lines = [describe_change(name, good_packages, bad_packages) for name in culprits]
+    report = "\n".join(lines) if lines else "No culprit packages found."
+    untestable = [applied for applied, bad in results.items() if bad is None]
+    if untestable:
+        report += f"\n\nUntestable candidates ({len(untestable)} failed to build):"
+        report += "".join(f"\n  {', '.join(sorted(applied))}" for applied in untestable)
+    logger.info(f"Bisect culprits ({len(results)} environments built):\n{report}")
+    print(f"\nBisect culprits ({len(results)} environments built):\n{report}")
+    BISECT_RESULTS.write_text(report + "\n")
+
+    return culprits
@@ -0,0 +1,340 @@
+"""Defines a content-addressed cache of experiment environments."""
+
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from envexp_utils.environment import (
+    clone_environment,
+    create_environment,
+    get_environment_prefix,
+    hash_environment_file,
+    remove_environment,
+)
+from envexp_utils.file import CACHE_DIR, EXP_DIR, ROOT_DIR
+from envexp_utils.lockfile import LOCKFILE, read_lockfile_hash
+from envexp_utils.log import log_dependencies
+from envexp_utils.pool import find_closest_base
+from envexp_utils.report import timed_phase
+
+# Configure the environment cache
+ENV_CACHE_DIR = CACHE_DIR / "envs"
+CACHE_INDEX = ENV_CACHE_DIR / "index.json"
+CACHE_KEY_FILENAME = "envexp-cache-key"
+DEFAULT_CACHE_BUDGET_GB = 20.0
+
+# Guards read-modify-write of the cache index when environments are built in parallel
+_INDEX_LOCK = threading.RLock()
+# Per cache key locks, held while a cached prefix is stored or cloned from (so it is
+# neither replaced nor evicted meanwhile)
+_KEY_LOCKS = {}
+
+
+def load_cache_index():
+    """Loads the cache index mapping cache keys to stored prefixes."""
+
+    if not CACHE_INDEX.exists():
+        return {}
+    try:
+        return json.loads(CACHE_INDEX.read_text())
+    except json.JSONDecodeError:
+        return {}
+
+
+def save_cache_index(index):
+    """Saves the cache index."""
+
+    ENV_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = CACHE_INDEX.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(index, indent=2))
+    os.replace(tmp_path, CACHE_INDEX)
+
+
+def cache_key_lock(cache_key):
+    """Returns the lock of a cache key (the same lock in every thread)."""
+
+    with _INDEX_LOCK:
+        return _KEY_LOCKS.setdefault(cache_key, threading.RLock())
+
+
+def read_cache_key(prefix):
+    """Reads the cache key an environment prefix was built from (if any)."""
+
+    key_file = Path(prefix) / "conda-meta" / CACHE_KEY_FILENAME
+    if not key_file.exists():
+        return None
+    return key_file.read_text().strip()
+
+
+def write_cache_key(prefix, cache_key):
+    """Records the cache key an environment prefix was built from."""
+
+    key_file = Path(prefix) / "conda-meta" / CACHE_KEY_FILENAME
+    key_file.parent.mkdir(parents=True, exist_ok=True)
+    key_file.write_text(cache_key)
+
+
+def get_directory_size(directory):
+    """Returns the size of a directory in bytes, counting hardlinked files once."""
+
+    size = 0
+    seen = set()
+    for root, _, files in os.walk(directory):
+        for file in files:
+            try:
+                stat = os.lstat(os.path.join(root, file))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in seen:
+                continue
+            seen.add((stat.st_dev, stat.st_ino))
+            size += stat.st_size
+    return size
+
+
+def restore_cached_environment(conda_command, cache_key, env_name="experiment"):
+    """Reuses or clones a cached environment matching the cache key.
+
+    Returns:
+        bool: True if the experiment environment now matches the cache key.
+    """
+
+    # Reuse the existing experiment environment if it was built from the same key
+    prefix = get_environment_prefix(conda_command=conda_command, env_name=env_name)
+    if prefix is not None and read_cache_key(prefix) == cache_key:
+        print(f"\t... reusing existing {env_name} environment")
+        touch_cache_entry(cache_key)
+        return True
+
+    with cache_key_lock(cache_key):
+        with _INDEX_LOCK:
+            entry = load_cache_index().get(cache_key)
+        if entry is None or not Path(entry["prefix"]).exists():
+            return False
+
+        print(f"\t... cloning cached environment [{entry['prefix']}]")
+        remove_environment(conda_command=conda_command, env_name=env_name)
+        cloned = clone_environment(
+            conda_command, source=entry["prefix"], env_name=env_name
+        )
+    if not cloned:
+        print("\t... failed to clone cached environment")
+        return False
+
+    prefix = get_environment_prefix(conda_command=conda_command, env_name=env_name)
+    if prefix is not None:
+        write_cache_key(prefix, cache_key)
+    touch_cache_entry(cache_key)
+    return True
+
+
+def touch_cache_entry(cache_key):
+    """Marks a cache entry as recently used."""
+
+    with _INDEX_LOCK:
+        index = load_cache_index()
+        if cache_key in index:
+            index[cache_key]["last_used"] = time.time()
+            save_cache_index(index)
+
+
+def store_environment(
+    conda_command,
+    cache_key,
+    budget_gb=DEFAULT_CACHE_BUDGET_GB,
+    env_name="experiment",
+):
+    """Stores the experiment environment in the cache and evicts old entries."""
+
+    source = get_environment_prefix(conda_command=conda_command, env_name=env_name)
+    if source is None:
+        return
+
+    print(f"\nStoring {env_name} environment in cache...")
+    write_cache_key(source, cache_key)
+    cached_prefix = ENV_CACHE_DIR / cache_key
+    with cache_key_lock(cache_key):
+        if cached_prefix.exists():
+            shutil.rmtree(cached_prefix)
+        if not clone_environment(conda_command, source=source, prefix=cached_prefix):
+            print("\t... failed to store environment in cache")
+            return
+        write_cache_key(cached_prefix, cache_key)
+
+        size = get_directory_size(cached_prefix)
+        with _INDEX_LOCK:
+            index = load_cache_index()
+            index[cache_key] = {
+                "prefix": cached_prefix.as_posix(),
+                "size": size,
+                "created": time.time(),
+                "last_used": time.time(),
+            }
+            save_cache_index(index)
+    evict_environments(budget_gb=budget_gb, keep=cache_key)
+
+
+def evict_environments(budget_gb=DEFAULT_CACHE_BUDGET_GB, keep=None):
+    """Evicts least recently used cached environments until within the disk budget.
+
+    Entries that are being stored or cloned from (in another thread) are skipped.
+
+    Args:
+        budget_gb (float): The disk budget for all cached environments in GB.
+        keep (str): A cache key that should never be evicted.
+    """
+
+    with _INDEX_LOCK:
+        index = load_cache_index()
+        budget = budget_gb * 1024**3
+        total = sum(entry["size"] for entry in index.values())
+
+        for cache_key, entry in sorted(
+            index.items(), key=lambda x: x[1]["last_used"]
+        ):
+            if total <= budget:
+                break
+            if cache_key == keep:
+                continue
+            # Not waiting for the key, as its holder may be waiting for the index
+            lock = cache_key_lock(cache_key)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                print(f"Evicting cached environment [{entry['prefix']}]...")
+                shutil.rmtree(entry["prefix"], ignore_errors=True)
+            finally:
+                lock.release()
+            total -= entry["size"]
+            del index[cache_key]
+
+        save_cache_index(index)
+
+
+def find_pool_base(use_pool, use_lockfile, environment_file=None, output_dir=None):
+    """Returns the closest pool base to build from, or None if there is no solve.
+
+    Environments created from an up-to-date lockfile skip the solve anyway, so they
+    are not built from a base.
+    """
+
+    if not use_pool:
+        return None
+    if environment_file is None:
+        environment_file = EXP_DIR / "environment.yml"
+    lockfile = (output_dir or ROOT_DIR) / LOCKFILE.name
+    yml_hash = hash_environment_file(environment_file=environment_file)
+    if use_lockfile and read_lockfile_hash(lockfile) == yml_hash:
+        return None
+    return find_closest_base(environment_file=environment_file, lockfile=lockfile)
+
+
+def create_cached_environment(
+    conda_command,
+    use_cache=True,
+    budget_gb=DEFAULT_CACHE_BUDGET_GB,
+    use_lockfile=True,
+    env_name="experiment",
+    environment_file=None,
+    output_dir=None,
+    include_pip=True,
+    offline=False,
+    use_pool=True,
+    defer_logging=False,
+):
+    """Creates the experiment environment, reusing a cached prefix when possible.
+
+    If the environment needs a solve, it is cloned from the closest
+    base of the warm pool (if any) and only the delta is installed.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        use_cache (bool): Whether to look up and store environments in the cache.
+        budget_gb (float): The disk budget for all cached environments in GB.
+        use_lockfile (bool): Whether to create the environment from the lockfile.
+        env_name (str): The name of the environment to create.
+        environment_file (Path): The environment file to create the environment
+            from. Defaults to envexp/environment.yml.
+        output_dir (Path): The directory to write the lockfile and dependency logs
+            to. Defaults to the root directory.
+        include_pip (bool): If False, pipdeptree.txt is not written.
+        offline (bool): Whether to build only from the managed package directory.
+        use_pool (bool): Whether to build from the closest base of the warm pool.
+        defer_logging (bool): If True, the dependencies are only logged if creating
+            the environment fails (see `create_environment`).
+    """
+
+    create_kwargs = dict(
+        conda_command=conda_command,
+        use_lockfile=use_lockfile,
+        env_name=env_name,
+        environment_file=environment_file,
+        output_dir=output_dir,
+        include_pip=include_pip,
+        offline=offline,
+        defer_logging=defer_logging,
+    )
+
+    pool_kwargs = dict(
+        use_pool=use_pool,
+        use_lockfile=use_lockfile,
+        environment_file=environment_file,
+        output_dir=output_dir,
+    )
+
+    if not use_cache:
+        with timed_phase("remove_environment"):
+            remove_environment(conda_command=conda_command, env_name=env_name)
+        create_environment(**create_kwargs, base_prefix=find_pool_base(**pool_kwargs))
+        return
+
+    print(f"\nLooking up {env_name} environment in cache...")
+    cache_key = hash_environment_file(
+        conda_command=conda_command, environment_file=environment_file
+    )
+    # Variants with the same key wait for each other, so the later ones are restored
+    with cache_key_lock(cache_key):
+        build_cached_environment(
+            conda_command=conda_command,
+            cache_key=cache_key,
+            budget_gb=budget_gb,
+            create_kwargs=create_kwargs,
+            pool_kwargs=pool_kwargs,
+        )
+
+
+def build_cached_environment(
+    conda_command, cache_key, budget_gb, create_kwargs, pool_kwargs
+):
+    """Restores the environment of a cache key, or creates and stores it."""
+
+    env_name = create_kwargs["env_name"]
+    with timed_phase("restore_cached_environment"):
+        restored = restore_cached_environment(
+            conda_command=conda_command, cache_key=cache_key, env_name=env_name
+        )
+    if restored:
+        if not create_kwargs["defer_logging"]:
+            with timed_phase("log_dependencies"):
+                log_dependencies(
+                    conda_command=conda_command,
+                    env_name=env_name,
+                    output_dir=create_kwargs["output_dir"],
+                    include_pip=create_kwargs["include_pip"],
+                )
+        return
+
+    print("\t... cache miss")
+    with timed_phase("remove_environment"):
+        remove_environment(conda_command=conda_command, env_name=env_name)
+    create_environment(**create_kwargs, base_prefix=find_pool_base(**pool_kwargs))
+    with timed_phase("store_environment"):
+        store_environment(
+            conda_command=conda_command,
+            cache_key=cache_key,
+            budget_gb=budget_gb,
+            env_name=env_name,
+        )
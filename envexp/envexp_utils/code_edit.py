@@ -1,8 +1,44 @@
 
+import ast
+import fnmatch
+import os
+import platform
 import shutil
+import tokenize
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
 
 from envexp_utils.commit import gitignore_repo, un_gitignore_prev_repo
 from envexp_utils.file import EXP_DIR
+from envexp_utils.import_index import (
+    IMPORT_INDEX_VERSION,
+    find_stale_files,
+    load_import_index,
+    record_imports,
+    save_import_index,
+)
+from envexp_utils.module_graph import (
+    MODULE_GRAPH,
+    find_closure,
+    format_graph_dot,
+    format_graph_json,
+    normalize_entry,
+    resolve_module_graph,
+    scan_module_file,
+    subgraph,
+)
+
+# Configure parallel scanning of Python files for imports
+PARALLEL_SCAN_THRESHOLD = 256  # Fewer files are scanned in-process
+SCAN_CHUNKSIZE = 64
+
+# Configure how the entire repo is made available to the experiment
+WORKSPACE_MODES = ("link", "symlink", "hardlink", "reflink", "copy", "pythonpath")
+DEFAULT_WORKSPACE_MODE = "link"
+DEFAULT_EXCLUDE_PATTERNS = (".git/", "__pycache__/", "*.py[cod]")
+FICLONE = 0x40049409  # Linux ioctl to reflink (copy-on-write clone) a file
+
 
 def delete_old_experiment_code():
     """Removes all directories in ./envexp folder that does not contain "envexp"."""
@@ -13,11 +49,24 @@ def delete_old_experiment_code():
     for directory in envexp_dir.iterdir():
         if directory.is_dir() and ("envexp" not in directory.name):
             print(f"Removing directory [{directory}]...")
-            shutil.rmtree(directory)
+            # Only remove the link of a linked workspace, not the linked source tree
+            if directory.is_symlink():
+                directory.unlink()
+            else:
+                shutil.rmtree(directory)
 
     un_gitignore_prev_repo()
 
-def copy_source_code(input_dir, repo_name, library=None):
+def copy_source_code(
+    input_dir,
+    repo_name,
+    library=None,
+    nested_imports=False,
+    rescan_imports=False,
+    workspace=DEFAULT_WORKSPACE_MODE,
+    exclude=(),
+    entries=(),
+):
     """Finds all imports from a given library in Python files and copies them to test.
 
     Args:
@@ -26,84 +75,504 @@ def copy_source_code(input_dir, repo_name, library=None):
         repo_name (str): The name of the repo to copy imports from. E.g. 'sleap'.
         library (str): The library to search for in the imports. E.g. 'qtpy'. If None,
             the function will search for imports all non-tabbed imports.
+        nested_imports (bool): If True, also copy library imports nested in
+            conditionals, try-blocks and functions.
+        rescan_imports (bool): If True, rescan every file instead of only the files
+            that changed since the last scan.
+        workspace (str): How to make the entire repo available when no library is
+            provided (see `make_workspace`).
+        exclude (list[str]): Additional .gitignore-style patterns of files that are
+            not materialized in the workspace.
+        entries (list[str]): Entry modules of the repo (e.g. 'sleap.gui.app'). When
+            no library is provided, only the modules needed to import them are
+            copied (see `copy_import_closure`) instead of the entire repo.
+
+    Returns:
+        Path: The directory to add to PYTHONPATH to import the repo, or None if the
+            repo is importable from the envexp directory.
     """
 
-    # Remove the imports directory if it exists
+    # Remove the imports directory (and module graph of the last run) if they exist
     delete_old_experiment_code()
+    MODULE_GRAPH.unlink(missing_ok=True)
 
     # Set-up output path to copy and test code
     output_path = EXP_DIR / repo_name
-    output_path.mkdir(
-        parents=True, exist_ok=True
-    )  # Create output directory if it doesn't exist
 
     gitignore_repo(repo_name)
 
     # Only find and copy specific imports if a library is provided
     if library is not None:
+        output_path.mkdir(
+            parents=True, exist_ok=True
+        )  # Create output directory if it doesn't exist
         print(f"\nFinding and copying imports from [{library}]...")
         find_and_copy_imports(
-            input_dir=input_dir, output_path=output_path, library=library
+            input_dir=input_dir,
+            output_path=output_path,
+            library=library,
+            nested=nested_imports,
+            use_index=not rescan_imports,
         )
         print(f"Finished copying imports from [{library}].")
+    elif entries:
+        print(f"\nCopying the modules needed to import {list(entries)}...")
+        copy_import_closure(
+            input_dir=input_dir,
+            output_path=output_path,
+            package=repo_name,
+            entries=entries,
+            mode=workspace,
+            exclude=exclude,
+            use_index=not rescan_imports,
+        )
+        print("Finished copying the modules needed to import the entry points.")
     else:
-        print("\nCopying entire repo from input directory...")
-        copy_repo(input_dir=input_dir, output_path=output_path)
-        print("Finished copying entire repo.")
+        print(f"\nCreating [{workspace}] workspace of entire repo...")
+        pythonpath = make_workspace(
+            input_dir=input_dir,
+            output_path=output_path,
+            mode=workspace,
+            exclude=exclude,
+        )
+        print("Finished creating workspace of entire repo.")
+        return pythonpath
 
     return
 
-def copy_repo(input_dir, output_path):
-    """Copies the entire repo to the output path."""
+def copy_repo(input_dir, output_path, exclude=(), copy_function=shutil.copy2):
+    """Copies the entire repo to the output path.
+
+    Args:
+        input_dir (Path): The directory of the repo to copy.
+        output_path (Path): The directory to copy the repo to.
+        exclude (list[str]): Additional .gitignore-style patterns of files to skip.
+        copy_function (callable): The function used to copy each file.
+    """
 
     # Copy the entire repo to the output path
-    shutil.copytree(input_dir, output_path, dirs_exist_ok=True)
+    shutil.copytree(
+        input_dir,
+        output_path,
+        ignore=make_ignore(input_dir, exclude=exclude),
+        copy_function=copy_function,
+        dirs_exist_ok=True,
+    )
 
 
-def find_and_copy_imports(input_dir, output_path, library):
+def read_exclude_patterns(input_dir, exclude=()):
+    """Returns the default, .gitignore and additional exclude patterns of a repo."""
 
-    def is_import(line):
-        """Check if the line is an import statement from the library."""
+    patterns = list(DEFAULT_EXCLUDE_PATTERNS) + list(exclude)
+    gitignore = Path(input_dir) / ".gitignore"
+    if gitignore.exists():
+        for line in gitignore.read_text(errors="replace").splitlines():
+            line = line.strip()
+            # Negated patterns are not supported, so they are skipped
+            if line and not line.startswith("#") and not line.startswith("!"):
+                patterns.append(line)
+    return patterns
 
-        if line.startswith(f"from {library}") or line.startswith(f"import {library}"):
-            return True
-        return False
 
-    # Create __init__.py file in output directory to add all imports
-    init_path = output_path / "__init__.py"
+def make_ignore(input_dir, exclude=()):
+    """Makes a `shutil.copytree` ignore function from .gitignore-style patterns."""
+
+    input_dir = Path(input_dir)
+    patterns = read_exclude_patterns(input_dir, exclude=exclude)
+
+    def ignore(directory, names):
+        relative_dir = Path(directory).relative_to(input_dir)
+        ignored = set()
+        for name in names:
+            relative_path = (relative_dir / name).as_posix()
+            is_dir = (Path(directory) / name).is_dir()
+            for pattern in patterns:
+                dir_only = pattern.endswith("/")
+                # Patterns with a (leading or inner) slash are relative to the repo
+                anchored = "/" in pattern.rstrip("/")
+                pattern = pattern.strip("/")
+                if dir_only and not is_dir:
+                    continue
+                target = relative_path if anchored else name
+                if fnmatch.fnmatch(target, pattern):
+                    ignored.add(name)
+                    break
+        return ignored
+
+    return ignore
+
+
+def hardlink_or_copy(src, dst):
+    """Hardlinks a file, falling back to a copy (e.g. across filesystems)."""
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def reflink_or_copy(src, dst):
+    """Reflinks (copy-on-write clones) a file, falling back to a copy."""
+
+    if platform.system() == "Linux":
+        import fcntl
+
+        try:
+            with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
+def make_workspace(input_dir, output_path, mode=DEFAULT_WORKSPACE_MODE, exclude=()):
+    """Makes the entire repo importable from the envexp directory.
+
+    Args:
+        input_dir (Path): The directory of the repo.
+        output_path (Path): The directory the repo is made available at.
+        mode (str): One of
+            - "link": symlink, falling back to hardlink (e.g. without symlink
+                privileges on Windows)
+            - "symlink": symlink the output path to the repo (nothing is copied)
+            - "hardlink": hardlink each file, falling back to a copy
+            - "reflink": reflink (copy-on-write) each file, falling back to a copy
+            - "copy": copy each file
+            - "pythonpath": nothing is materialized, the repo's parent directory is
+                added to PYTHONPATH instead
+        exclude (list[str]): Additional .gitignore-style patterns of files that are
+            not materialized (hardlink, reflink and copy modes).
+
+    Returns:
+        Path: The directory to add to PYTHONPATH, or None.
+    """
+
+    input_dir = Path(input_dir).absolute()
+
+    if mode == "pythonpath":
+        return input_dir.parent
+
+    if mode in ("link", "symlink"):
+        try:
+            os.symlink(input_dir, output_path, target_is_directory=True)
+            return None
+        except OSError as e:
+            if mode == "symlink":
+                raise e
+            print(f"\t... could not symlink ({e}), hardlinking instead")
+        mode = "hardlink"
+
+    copy_functions = {
+        "hardlink": hardlink_or_copy,
+        "reflink": reflink_or_copy,
+        "copy": shutil.copy2,
+    }
+    if mode not in copy_functions:
+        raise ValueError(f"Unknown workspace mode [{mode}].")
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    copy_repo(
+        input_dir=input_dir,
+        output_path=output_path,
+        exclude=exclude,
+        copy_function=copy_functions[mode],
+    )
+    return None
+
+
+def is_library_module(module, library):
+    """Returns True if the module is the library or one of its submodules."""
+
+    return module == library or module.startswith(f"{library}.")
+
+
+def extract_imports(source, library, nested=False, filename="<unknown>"):
+    """Extracts the import statements of a library from Python source code.
+
+    Handles every import form (e.g. `import a, qtpy`, parenthesized and backslash
+    continued imports) as the source is parsed with `ast` instead of line-by-line.
+
+    Args:
+        source (str): The Python source code.
+        library (str): The library to search for in the imports. E.g. 'qtpy'.
+        nested (bool): If True, also extract imports nested in conditionals,
+            try-blocks and functions. Otherwise only module-level imports.
+        filename (str): The filename used in syntax error messages.
+
+    Returns:
+        list[str]: The (normalized) import statements in source order.
+    """
+
+    tree = ast.parse(source, filename=filename)
+    nodes = ast.walk(tree) if nested else tree.body
+
+    imports = []
+    for node in sorted(
+        (node for node in nodes if isinstance(node, (ast.Import, ast.ImportFrom))),
+        key=lambda node: (node.lineno, node.col_offset),
+    ):
+        if isinstance(node, ast.Import):
+            # Only keep the library aliases of e.g. `import a, qtpy`
+            aliases = [
+                alias for alias in node.names if is_library_module(alias.name, library)
+            ]
+            if aliases:
+                imports.append(ast.unparse(ast.Import(names=aliases)))
+        elif (
+            node.level == 0
+            and node.module is not None
+            and is_library_module(node.module, library)
+        ):
+            imports.append(ast.unparse(node))
+    return imports
+
+
+def scan_file(python_file, library, nested=False):
+    """Extracts the library imports from a Python file (run in a worker process).
+
+    Returns:
+        tuple[list[str], str]: The import statements and an error message (or None).
+    """
+
+    try:
+        with tokenize.open(python_file) as infile:
+            source = infile.read()
+        imports = extract_imports(
+            source, library=library, nested=nested, filename=str(python_file)
+        )
+    except (SyntaxError, UnicodeDecodeError, ValueError) as e:
+        return [], f"{type(e).__name__}: {e}"
+    return imports, None
+
+
+def map_files(scan, python_files, max_workers=None):
+    """Runs a (picklable) scan function on Python files, in parallel if there are many.
+
+    Returns:
+        list: The result of the scan of each file (in the order given).
+    """
+
+    if len(python_files) < PARALLEL_SCAN_THRESHOLD:
+        return [scan(python_file) for python_file in python_files]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(scan, python_files, chunksize=SCAN_CHUNKSIZE))
+
+
+def scan_files(python_files, library, nested=False, max_workers=None):
+    """Extracts the library imports from Python files in parallel.
+
+    Returns:
+        list[tuple[list[str], str]]: The import statements and error message for
+            each file (in the order given).
+    """
+
+    scan = partial(scan_file, library=library, nested=nested)
+    return map_files(scan, python_files, max_workers=max_workers)
+
+
+def format_imports_module(imports_by_file):
+    """Formats the imports of each file into the source of the generated module.
+
+    Args:
+        imports_by_file (list[tuple[str, list[str]]]): The relative path and import
+            statements of each file with matching imports.
+    """
+
+    blocks = [
+        f"\n# {relative_path}\n" + "\n".join(imports) + "\n"
+        for relative_path, imports in imports_by_file
+    ]
+    return "".join(blocks)
+
+
+def find_and_copy_imports(
+    input_dir, output_path, library, nested=False, use_index=True
+):
+    """Finds all imports from a library and writes them to the output __init__.py.
+
+    The extracted imports are kept in a persistent index keyed by each file's
+    mtime, size and hash, so only files that changed since the last scan are parsed.
+
+    Args:
+        input_dir (Path): The directory to search for Python files.
+        output_path (Path): The directory to write the __init__.py to.
+        library (str): The library to search for in the imports. E.g. 'qtpy'.
+        nested (bool): If True, also copy imports nested in conditionals,
+            try-blocks and functions. Otherwise only module-level imports.
+        use_index (bool): If False, the index is discarded and every file rescanned.
+    """
 
     # Find all Python files in the input directory
-    for python_file in input_dir.rglob("*.py"):
-        with python_file.open("r") as infile:
-            lines = infile.readlines()
-
-        # Find and collect multi-line imports that start with 'from qtpy'
-        matching_imports = []
-        multi_line_import = False
-        current_import = ""
-
-        # Find imports from the library
-        for line in lines:
-            if multi_line_import:
-                current_import += line.strip()
-                if line.strip().endswith(")"):
-                    matching_imports.append(current_import)
-                    multi_line_import = False
-                    current_import = ""
-                continue
-
-            if is_import(line):
-                # Determine if the import is a multi-line import
-                if line.strip().endswith("("):
-                    multi_line_import = True
-                    current_import = line.strip()
-                else:
-                    matching_imports.append(line.strip())
-
-        # Only write to the output file if there are matching lines
-        if matching_imports:
-            relative_path = python_file.relative_to(input_dir)
-            with init_path.open("a") as initfile:
-                initfile.write(f"\n# {relative_path}\n")
-                initfile.write("\n".join(matching_imports) + "\n")
+    python_files = sorted(input_dir.rglob("*.py"))
+    scan_key = f"{library}:{'nested' if nested else 'top'}"
+
+    # Only scan files that are new or changed since the last scan
+    if use_index:
+        index = load_import_index(input_dir)
+    else:
+        index = {"version": IMPORT_INDEX_VERSION, "files": {}}
+    stale_files = find_stale_files(index, input_dir, python_files, scan_key)
+    print(f"Scanning {len(stale_files)} of {len(python_files)} files for imports...")
+    results = scan_files(stale_files, library=library, nested=nested)
+    for python_file, (imports, error) in zip(stale_files, results):
+        if error is not None:
+            print(f"Skipping [{python_file.relative_to(input_dir)}]: {error}")
+        record_imports(index, input_dir, python_file, scan_key, imports, error)
+    save_import_index(input_dir, index)
+
+    # Rebuild the imports of all files from the index
+    imports_by_file = []
+    for python_file in python_files:
+        relative_path = python_file.relative_to(input_dir)
+        imports = index["files"][relative_path.as_posix()]["imports"][scan_key]
+        # Only write to the output file if there are matching imports
+        if imports:
+            imports_by_file.append((relative_path, imports))
 
+    # Create __init__.py file in output directory with all imports in a single write
+    init_path = output_path / "__init__.py"
+    init_path.write_text(format_imports_module(imports_by_file))
+
+
+def build_module_graph(input_dir, package, use_index=True):
+    """Builds the import graph of the repo's own modules.
+
+    The imports of each file are kept in the import index (see
+    `find_and_copy_imports`), so only files that changed since the last build are
+    parsed.
+
+    Args:
+        input_dir (Path): The directory of the repo's package.
+        package (str): The name of the repo's package. E.g. 'sleap'.
+        use_index (bool): If False, the index is discarded and every file rescanned.
+
+    Returns:
+        dict: The module graph (see `resolve_module_graph`).
+    """
+
+    input_dir = Path(input_dir)
+    python_files = sorted(input_dir.rglob("*.py"))
+    scan_key = f"modules:{package}"
+
+    if use_index:
+        index = load_import_index(input_dir)
+    else:
+        index = {"version": IMPORT_INDEX_VERSION, "files": {}}
+    stale_files = find_stale_files(index, input_dir, python_files, scan_key)
+    print(f"Scanning {len(stale_files)} of {len(python_files)} files for modules...")
+    scan = partial(scan_module_file, input_dir=input_dir, package=package)
+    for python_file, (imports, error) in zip(stale_files, map_files(scan, stale_files)):
+        if error is not None:
+            print(f"Skipping [{python_file.relative_to(input_dir)}]: {error}")
+        record_imports(index, input_dir, python_file, scan_key, imports, error)
+    save_import_index(input_dir, index)
+
+    return resolve_module_graph(
+        package,
+        {path: entry["imports"][scan_key] for path, entry in index["files"].items()},
+    )
+
+
+def copy_import_closure(
+    input_dir,
+    output_path,
+    package,
+    entries,
+    mode=DEFAULT_WORKSPACE_MODE,
+    exclude=(),
+    use_index=True,
+):
+    """Copies the modules of the repo that are needed to import the entry modules.
+
+    Along with the modules, the other files in their directories (e.g. resources and
+    extension modules) are copied. The entry modules are imported at the end of the
+    copied package's __init__.py, so importing the package imports them. The graph
+    of the copied modules is written to module_graph.json.
+
+    Args:
+        input_dir (Path): The directory of the repo's package.
+        output_path (Path): The directory to copy the modules to.
+        package (str): The name of the repo's package. E.g. 'sleap'.
+        entries (list[str]): The entry modules, e.g. 'sleap.gui.app', 'gui.app' or
+            'gui/app.py'.
+        mode (str): The workspace mode. The files are reflinked or copied in the
+            "reflink" and "copy" modes, and hardlinked (or copied) otherwise.
+        exclude (list[str]): Additional .gitignore-style patterns of (non-module)
+            files that are not copied.
+        use_index (bool): If False, every file is rescanned for imports.
+    """
+
+    input_dir = Path(input_dir).absolute()
+    graph = build_module_graph(input_dir, package=package, use_index=use_index)
+    entries = [normalize_entry(entry, package) for entry in entries]
+    closure = find_closure(graph, entries)
+    print(f"\t... {len(closure)} of {len(graph)} modules are needed")
+
+    copy_function = {"reflink": reflink_or_copy, "copy": shutil.copy2}.get(
+        mode, hardlink_or_copy
+    )
+    directories = set()
+    for module in closure:
+        relative_path = Path(graph[module]["path"])
+        (output_path / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        copy_function(input_dir / relative_path, output_path / relative_path)
+        directories.add(relative_path.parent)
+
+    # Copy the package data next to the modules (but not the other modules)
+    ignore = make_ignore(input_dir, exclude=exclude)
+    for directory in sorted(directories):
+        names = [
+            path.name
+            for path in (input_dir / directory).iterdir()
+            if path.is_file() and path.suffix != ".py"
+        ]
+        for name in sorted(set(names) - ignore(input_dir / directory, names)):
+            copy_function(input_dir / directory / name, output_path / directory / name)
+
+    # Import the entry modules with the package (the copy is not linked to the source)
+    init_path = output_path / "__init__.py"
+    source = init_path.read_text() if init_path.exists() else ""
+    init_path.unlink(missing_ok=True)
+    entry_imports = "".join(
+        f"import {entry}\n" for entry in entries if entry != package
+    )
+    if entry_imports:
+        source += f"\n# Entry points of the experiment\n{entry_imports}"
+    init_path.write_text(source)
+
+    MODULE_GRAPH.write_text(
+        format_graph_json(subgraph(graph, closure), package=package, entries=entries)
+    )
+
+
+def show_module_graph(
+    input_dir, package, entries=(), library=None, output_format="dot", output=None
+):
+    """Exports the import graph of the repo's modules (or of the closure of entries).
+
+    Args:
+        input_dir (Path): The directory of the repo's package.
+        package (str): The name of the repo's package. E.g. 'sleap'.
+        entries (list[str]): If given, only the modules needed to import these entry
+            modules are exported.
+        library (str): A library to highlight the modules that (transitively)
+            import, e.g. 'qtpy'.
+        output_format (str): "dot" (Graphviz) or "json".
+        output (Path): The file to write the graph to. If None, it is printed.
+    """
+
+    graph = build_module_graph(input_dir, package=package)
+    entries = [normalize_entry(entry, package) for entry in entries]
+    if entries:
+        graph = subgraph(graph, find_closure(graph, entries))
+
+    formatter = format_graph_dot if output_format == "dot" else format_graph_json
+    text = formatter(graph, package=package, entries=entries, library=library)
+    if output is None:
+        print(text)
+    else:
+        Path(output).write_text(text)
+        print(f"\nWrote the graph of {len(graph)} modules to [{output}]")
@@ -1,104 +1,199 @@
 
+import os
+import re
 import subprocess
-
-from envexp_utils.file import ROOT_DIR
-from envexp_utils.log import close_logger_handlers, wait_for_log_update, logger
+from pathlib import Path
+
+from envexp_utils.artifacts import (
+    ARTIFACT_MANIFEST,
+    DEFAULT_ARTIFACT_BUDGET_GB,
+    compact_artifacts,
+)
+from envexp_utils.bisection import BISECT_DIR, BISECT_RESULTS
+from envexp_utils.env_diff import INVENTORY_FILES
+from envexp_utils.file import EXP_DIR, ROOT_DIR
+from envexp_utils.history import record_run
+from envexp_utils.lockfile import LOCKFILE
+from envexp_utils.log import LOGFILE, STDERR_DIR, close_logfile
+from envexp_utils.matrix import MATRIX_DIR, MATRIX_RESULTS
+from envexp_utils.module_graph import MODULE_GRAPH
+from envexp_utils.pool import POOL_DEFINITIONS_DIR
+from envexp_utils.report import RUN_REPORT
 
 # Configure gitignore
 GITIGNORE_PATH = ROOT_DIR / ".gitignore"
 GITIGNORE_FLAG = "# added by envexp\n"
+# Untracked ignore file of the clone, so ignoring the copied repo changes no file
+EXCLUDE_PATH = ROOT_DIR / ".git" / "info" / "exclude"
+EXCLUDE_BLOCK_PATTERN = re.compile(r"\n?" + re.escape(GITIGNORE_FLAG) + r"[^\n]*\n?")
+
+# Configure the result files of a run that are committed (and nothing else)
+RESULT_PATHS = (
+    LOGFILE,
+    RUN_REPORT,
+    LOCKFILE,
+    *(ROOT_DIR / name for name in INVENTORY_FILES),
+    EXP_DIR / "environment.yml",
+    EXP_DIR / "user_test_code.py",
+    GITIGNORE_PATH,
+    MATRIX_RESULTS,
+    MATRIX_DIR,
+    BISECT_RESULTS,
+    BISECT_DIR,
+    POOL_DEFINITIONS_DIR,
+    MODULE_GRAPH,
+    ARTIFACT_MANIFEST,
+)
+# The result files that are stored in the artifact store (not committed) when compact
+ARTIFACT_PATHS = (
+    LOGFILE,
+    *(ROOT_DIR / name for name in INVENTORY_FILES),
+    STDERR_DIR,
+)
+
 
 def gitignore_repo(repo_name):
-    """Appends the repo name to the .gitignore file.
+    """Ignores the copied repo in the (untracked) exclude file of the clone.
 
     Args:
-        repo_name (str): The name of the repo to append to the .gitignore file.
+        repo_name (str): The name of the repo to ignore.
     """
 
-    # Ensure the .gitignore file ends with a newline
-    with GITIGNORE_PATH.open("rb+") as file:
-        file.seek(-1, 2)  # Move the cursor to the last byte in the file
-        last_char = file.read(1)
-        if last_char != b"\n":
-            file.write(b"\n")
-
-    with GITIGNORE_PATH.open("a") as gitignore:
-        gitignore.write(f"\n{GITIGNORE_FLAG}{repo_name}/\n")
-
-    assume_unchanged_gitignore()
+    EXCLUDE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with EXCLUDE_PATH.open("a") as exclude:
+        # No trailing slash, so that a symlinked workspace is ignored as well
+        exclude.write(f"\n{GITIGNORE_FLAG}{repo_name}\n")
     return
 
 
-def assume_unchanged_gitignore():
-    """Assumes the .gitignore file is unchanged."""
+def un_gitignore_prev_repo():
+    """Removes the previous repo name from the exclude file (and .gitignore).
 
-    subprocess.run(
-        "git update-index --assume-unchanged .gitignore", shell=True, cwd=ROOT_DIR
-    )
+    Older versions of envexp added the repo name to .gitignore, so those blocks are
+    removed as well.
+    """
 
+    for path in (EXCLUDE_PATH, GITIGNORE_PATH):
+        if not path.exists():
+            continue
+        text = path.read_text()
+        if GITIGNORE_FLAG in text:
+            path.write_text(EXCLUDE_BLOCK_PATTERN.sub("", text).rstrip("\n") + "\n")
+    return
 
-def no_assume_unchanged_gitignore():
-    """Removes the assume-unchanged flag from the .gitignore file."""
 
-    subprocess.run(
-        "git update-index --no-assume-unchanged .gitignore", shell=True, cwd=ROOT_DIR
-    )
+def list_result_files():
+    """Returns the result files to commit, relative to the root directory.
 
+    Only the known result paths are visited (directories recursively), so the cost
+    does not grow with the size of the copied repo.
+    """
 
-def un_gitignore_prev_repo():
-    """Removes the previous repo name from the .gitignore file."""
+    files = []
+    for path in RESULT_PATHS:
+        if path.is_dir():
+            files += [
+                Path(root, name) for root, _, names in os.walk(path) for name in names
+            ]
+        else:
+            files.append(path)
+    return sorted({file.relative_to(ROOT_DIR).as_posix() for file in files})
 
-    def is_gitignore_block(prev_line, line, next_line):
-        """Determines if the line is part of the gitignore block.
 
-        Args:
-            prev_line (str): The previous line.
-            next_line (str): The next line.
-        """
+def run_git(*args, input=None, check=True):
+    """Runs a git command in the root directory and returns its stripped output.
 
-        if (
-            (GITIGNORE_FLAG in prev_line)
-            or (GITIGNORE_FLAG in line)
-            or (GITIGNORE_FLAG in next_line)
-        ):
-            return True
-        return False
+    Args:
+        args (str): The git command and its arguments.
+        input (str): The input to pass to the command's stdin.
+        check (bool): Whether to raise an exception if the command fails.
+    """
 
-    with GITIGNORE_PATH.open("r") as gitignore:
-        lines = gitignore.readlines()
+    output = subprocess.run(
+        ["git", *args], input=input, capture_output=True, text=True, cwd=ROOT_DIR
+    )
+    if check and output.returncode != 0:
+        raise Exception(f"git {args[0]} failed:\n{output.stderr}")
+    return output.stdout.strip()
 
-    with GITIGNORE_PATH.open("w") as gitignore:
-        # Write the first line (we assume it's not part of the block)
-        gitignore.write(lines[0])
 
-        # Only write lines that are not part of the envexp gitignore block
-        for line_idx, line in enumerate(lines[1:-1]):
+def commit_changes(commit_message: str, compacted=()):
+    """Commits the result files of the run with git plumbing commands.
 
-            prev_line = lines[line_idx]
-            next_line = lines[line_idx + 2]
-            if is_gitignore_block(prev_line, line, next_line):
-                continue
+    The result files (and the tracked files under the result directories, so removed
+    files are staged as removed) are written to the index in a single
+    `git update-index` session, and the commit is created from the index with
+    `git write-tree` and `git commit-tree` (without running commit hooks).
 
-            gitignore.write(line)
-        # Write the last line if it's not part of the block
-        if not is_gitignore_block(prev_line=line, line=next_line, next_line=lines[-1]):
-            gitignore.write(lines[-1])
+    Args:
+        commit_message (str): The commit message.
+        compacted (list[str]): Result files (relative to the root directory) that
+            are in the artifact store instead, so they are removed from the index
+            (but kept on disk).
+    """
 
-    return
+    result_paths = [path.relative_to(ROOT_DIR).as_posix() for path in RESULT_PATHS]
+    tracked = {
+        path for path in run_git("ls-files", "-z", "--", *result_paths).split("\0")
+    }
+    tracked.discard("")
+    paths = sorted((set(list_result_files()) | tracked) - set(compacted))
+
+    # Untrack the compacted files committed by earlier runs (they stay on disk)
+    removed = sorted(tracked & set(compacted))
+    if removed:
+        run_git(
+            "update-index",
+            "--force-remove",
+            "-z",
+            "--stdin",
+            input="".join(f"{path}\0" for path in removed),
+        )
+
+    # Stage the result files (or their removal) in one index-writing session
+    run_git(
+        "update-index",
+        "--add",
+        "--remove",
+        "-z",
+        "--stdin",
+        input="".join(f"{path}\0" for path in paths),
+    )
+    tree = run_git("write-tree")
 
+    # The first commit of a repository has no parent
+    head = run_git("rev-parse", "--verify", "-q", "HEAD", check=False)
+    parents = ["-p", head] if head else []
+    # Pass the message through stdin (not a shell) so it may span lines
+    commit = run_git("commit-tree", tree, *parents, "-F", "-", input=commit_message)
+    subject = commit_message.splitlines()[0] if commit_message else ""
+    # Only move HEAD if it was not moved in the meantime (the old value is checked)
+    run_git("update-ref", "-m", f"commit: {subject}", "HEAD", commit, head)
+    print(f"\nCommitted {len(paths)} result files [{commit[:7]}] {subject}")
 
-def commit_changes(commit_message: str):
-    """Commits the changes to the root directory."""
 
-    # Commit the changes to the root directory
-    subprocess.run("git add .", shell=True, cwd=ROOT_DIR)
-    subprocess.run(f'git commit -m "{commit_message}"', shell=True)
+def commit_experiment(
+    commit_message: str, compact=False, budget_gb=DEFAULT_ARTIFACT_BUDGET_GB
+):
+    """Commits the changes to the root directory.
 
-def commit_experiment(commit_message: str):
-    """Commits the changes to the root directory."""
+    Args:
+        commit_message (str): The commit message.
+        compact (bool): If True, the log, inventories and split out stderr are
+            stored in the artifact store and only their manifest is committed.
+        budget_gb (float): The disk budget of the artifact store in GB.
+    """
 
-    close_logger_handlers(logger)
-    wait_for_log_update()
-    commit_changes(commit_message=commit_message)
-    no_assume_unchanged_gitignore()
-    return
\ No newline at end of file
+    # The log is flushed and fsynced (and moved into place) before it is committed
+    close_logfile()
+    compacted = []
+    if compact:
+        compacted = compact_artifacts(ARTIFACT_PATHS, budget_gb=budget_gb)
+        for path in compacted:
+            gitignore_repo(f"/{path}")
+    else:
+        # The manifest of an earlier compact run does not describe this run
+        ARTIFACT_MANIFEST.unlink(missing_ok=True)
+    commit_changes(commit_message=commit_message, compacted=compacted)
+    record_run()
+    return
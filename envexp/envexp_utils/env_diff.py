@@ -0,0 +1,297 @@
+"""Defines functions for diffing the environments of two experiment commits."""
+
+import json
+import re
+import subprocess
+from functools import cmp_to_key
+
+from envexp_utils.artifacts import ARTIFACT_MANIFEST, read_manifest_file
+from envexp_utils.bisection import parse_package_list
+from envexp_utils.file import ROOT_DIR
+from envexp_utils.inventory import canonicalize_name
+from envexp_utils.log import logger
+
+# Configure the committed inventory files (relative to the root directory)
+INVENTORY_FILES = ("inventory.json", "mamba_list.txt", "pipdeptree.txt")
+
+# Version segments that sort before and after every other segment (like conda)
+PRE_RELEASE_SEGMENTS = {"dev": -2}
+POST_RELEASE_SEGMENTS = {"post": 2}
+
+
+def read_git_blobs(specs, cwd=ROOT_DIR):
+    """Reads many files from git objects with a single `git cat-file --batch`.
+
+    Args:
+        specs (list[str]): The objects to read, e.g. 'HEAD~1:mamba_list.txt'.
+        cwd (Path): The directory of the git repository.
+
+    Returns:
+        dict: Mapping of each spec to its contents (or None if it is missing).
+    """
+
+    output = subprocess.run(
+        ["git", "cat-file", "--batch"],
+        input="".join(f"{spec}\n" for spec in specs).encode(),
+        capture_output=True,
+        cwd=cwd,
+    )
+    if output.returncode != 0:
+        raise Exception(output.stderr.decode(errors="replace"))
+
+    blobs = {}
+    data = output.stdout
+    position = 0
+    for spec in specs:
+        header_end = data.index(b"\n", position)
+        header = data[position:header_end].decode().split()
+        position = header_end + 1
+        # Missing objects are reported as '<spec> missing' (or 'ambiguous')
+        if len(header) != 3:
+            blobs[spec] = None
+            continue
+        size = int(header[2])
+        blobs[spec] = data[position : position + size].decode(errors="replace")
+        position += size + 1  # The contents are followed by a newline
+    return blobs
+
+
+def read_run_files(specs, cwd=ROOT_DIR):
+    """Reads files committed with runs, falling back to their compacted artifacts.
+
+    Files of runs committed with --compact-artifacts are not in git, so they are read
+    from the artifact store through the manifest committed with the run.
+
+    Args:
+        specs (list[str]): The files to read, e.g. 'HEAD~1:mamba_list.txt'.
+        cwd (Path): The directory of the git repository.
+
+    Returns:
+        dict: Mapping of each spec to its contents (or None if it is missing).
+    """
+
+    blobs = read_git_blobs(specs, cwd=cwd)
+    missing = [spec for spec in specs if blobs[spec] is None]
+    manifest_name = ARTIFACT_MANIFEST.relative_to(ROOT_DIR).as_posix()
+    revs = sorted({spec.split(":", 1)[0] for spec in missing})
+    if not revs:
+        return blobs
+
+    manifests = read_git_blobs([f"{rev}:{manifest_name}" for rev in revs], cwd=cwd)
+    for spec in missing:
+        rev, path = spec.split(":", 1)
+        manifest = manifests[f"{rev}:{manifest_name}"]
+        if manifest is not None:
+            blobs[spec] = read_manifest_file(manifest, path)
+    return blobs
+
+
+def parse_dependency_tree(text):
+    """Parses the dependency edges of a pipdeptree.txt (indented by two spaces)."""
+
+    edges = set()
+    parents = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        depth = (len(line) - len(line.lstrip(" "))) // 2
+        requirement = line.strip()
+        if "#egg=" in requirement:
+            # E.g. '-e git+https://...#egg=experiment&subdirectory=envexp'
+            name = requirement.split("#egg=", 1)[1].split("&", 1)[0]
+        elif requirement.startswith("-e "):
+            # Editable requirements are written as a path, e.g. '-e /path/to/repo'
+            name = requirement.rstrip("/\\").replace("\\", "/").rsplit("/", 1)[-1]
+        else:
+            name = re.split(r"==| @ ", requirement, maxsplit=1)[0]
+        name = canonicalize_name(name)
+        del parents[depth:]
+        if parents:
+            edges.add((parents[-1], name))
+        parents.append(name)
+    return edges
+
+
+def parse_inventory(files):
+    """Parses the committed inventory files of a run into packages and edges.
+
+    Args:
+        files (dict): Mapping of the names in INVENTORY_FILES to their contents (or
+            None if the file is missing). The inventory.json is used if present,
+            otherwise mamba_list.txt and pipdeptree.txt.
+
+    Returns:
+        tuple[dict, set]: Mapping of package name to a dict with version, build and
+            channel, and the set of (package, dependency) edges.
+    """
+
+    if files.get("inventory.json"):
+        inventory = json.loads(files["inventory.json"])
+        packages = {
+            record["name"]: {
+                "version": record["version"],
+                "build": record["build"],
+                "channel": record["channel"],
+            }
+            for record in inventory["conda"]
+        }
+        edges = {
+            (canonicalize_name(record["name"]), canonicalize_name(depend))
+            for record in inventory["conda"]
+            for depend in record["depends"]
+        }
+        edges |= {
+            (canonicalize_name(dist["name"]), canonicalize_name(requirement))
+            for dist in inventory["pip"]
+            for requirement in dist["requires"]
+        }
+        return packages, edges
+
+    packages = parse_package_list(files.get("mamba_list.txt") or "")
+    edges = parse_dependency_tree(files.get("pipdeptree.txt") or "")
+    return packages, edges
+
+
+def version_segments(version):
+    """Splits a version into comparable (rank, value) segments.
+
+    Numeric segments are compared numerically, letters (e.g. pre-releases like 'rc')
+    sort before numbers, 'dev' sorts before and 'post' after everything else.
+    """
+
+    epoch, _, version = version.lower().rpartition("!")
+    segments = [(1, int(epoch))] if epoch.isdigit() else [(1, 0)]
+    for part in re.split(r"[._+-]", version):
+        for segment in re.findall(r"\d+|[a-z]+", part):
+            if segment.isdigit():
+                segments.append((1, int(segment)))
+            elif segment in PRE_RELEASE_SEGMENTS:
+                segments.append((PRE_RELEASE_SEGMENTS[segment], ""))
+            elif segment in POST_RELEASE_SEGMENTS:
+                segments.append((POST_RELEASE_SEGMENTS[segment], ""))
+            else:
+                segments.append((0, segment))
+    return segments
+
+
+def compare_versions(version_a, version_b):
+    """Compares two versions (similar to conda's VersionOrder).
+
+    E.g. 1.0dev < 1.0rc1 < 1.0 == 1.0.0 < 1.0.post1 < 1.1.
+
+    Returns:
+        int: -1 if version_a is older, 1 if it is newer and 0 if they are equal.
+    """
+
+    segments_a = version_segments(version_a)
+    segments_b = version_segments(version_b)
+    # Pad the shorter version with zeros, so a release sorts after its pre-releases
+    length = max(len(segments_a), len(segments_b))
+    segments_a += [(1, 0)] * (length - len(segments_a))
+    segments_b += [(1, 0)] * (length - len(segments_b))
+    return (segments_a > segments_b) - (segments_a < segments_b)
+
+
+# Key to sort versions by, e.g. sorted(versions, key=version_key)
+version_key = cmp_to_key(compare_versions)
+
+
+def diff_environments(packages_a, edges_a, packages_b, edges_b):
+    """Diffs the packages and dependency edges of two environments.
+
+    Returns:
+        dict: The 'added', 'removed', 'upgraded', 'downgraded' and 'rebuilt'
+            (same version, different build or channel) packages and the 'added_edges'
+            and 'removed_edges'.
+    """
+
+    diff = {
+        "added": sorted(set(packages_b) - set(packages_a)),
+        "removed": sorted(set(packages_a) - set(packages_b)),
+        "upgraded": [],
+        "downgraded": [],
+        "rebuilt": [],
+        "added_edges": sorted(edges_b - edges_a),
+        "removed_edges": sorted(edges_a - edges_b),
+    }
+    for name in sorted(set(packages_a) & set(packages_b)):
+        package_a, package_b = packages_a[name], packages_b[name]
+        if package_a == package_b:
+            continue
+        order = compare_versions(package_a["version"], package_b["version"])
+        if order < 0:
+            diff["upgraded"].append(name)
+        elif order > 0:
+            diff["downgraded"].append(name)
+        else:
+            diff["rebuilt"].append(name)
+    return diff
+
+
+def format_environment_diff(diff, packages_a, packages_b):
+    """Formats an environment diff as a human-readable report."""
+
+    def describe(package):
+        return f"{package['version']} ({package['build']}, {package['channel']})"
+
+    def describe_new(name):
+        return f"{name} {describe(packages_b[name])}"
+
+    def describe_old(name):
+        return f"{name} {describe(packages_a[name])}"
+
+    def describe_change(name):
+        return f"{name} {describe(packages_a[name])} -> {describe(packages_b[name])}"
+
+    def describe_edge(edge):
+        return " -> ".join(edge)
+
+    lines = []
+    sections = [
+        ("Added", "added", describe_new),
+        ("Removed", "removed", describe_old),
+        ("Upgraded", "upgraded", describe_change),
+        ("Downgraded", "downgraded", describe_change),
+        ("Rebuilt", "rebuilt", describe_change),
+        ("Added dependency edges", "added_edges", describe_edge),
+        ("Removed dependency edges", "removed_edges", describe_edge),
+    ]
+    for title, key, describe_item in sections:
+        if not diff[key]:
+            continue
+        lines.append(f"{title} ({len(diff[key])}):")
+        lines += [f"  {describe_item(item)}" for item in diff[key]]
+    return "\n".join(lines) if lines else "No differences."
+
+
+def diff_revisions(rev_a, rev_b):
+    """Diffs the environments committed at two revisions.
+
+    Args:
+        rev_a (str): The old revision, e.g. the hash of a 'P:' commit.
+        rev_b (str): The new revision, e.g. the hash of an 'F:' commit.
+
+    Returns:
+        dict: The environment diff (see `diff_environments`).
+    """
+
+    specs = [f"{rev}:{name}" for rev in (rev_a, rev_b) for name in INVENTORY_FILES]
+    blobs = read_run_files(specs)
+
+    files = []
+    for rev in (rev_a, rev_b):
+        files.append({name: blobs[f"{rev}:{name}"] for name in INVENTORY_FILES})
+        if not any(files[-1].values()):
+            raise ValueError(f"No environment inventory is committed at {rev}.")
+    # Only compare the inventory.json if both revisions have one (for equal edges)
+    if not all(rev_files["inventory.json"] for rev_files in files):
+        for rev_files in files:
+            rev_files["inventory.json"] = None
+    parsed = [parse_inventory(rev_files) for rev_files in files]
+    (packages_a, edges_a), (packages_b, edges_b) = parsed
+
+    diff = diff_environments(packages_a, edges_a, packages_b, edges_b)
+    report = format_environment_diff(diff, packages_a, packages_b)
+    logger.info(f"Environment diff {rev_a}..{rev_b}:\n{report}")
+    print(f"\nEnvironment diff {rev_a}..{rev_b}:\n{report}")
+    return diff
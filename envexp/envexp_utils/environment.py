@@ -1,80 +1,387 @@
 """Defines functions for managing the environment."""
 
+import hashlib
+import platform
+import re
 import subprocess
+from pathlib import Path
 
-from envexp_utils.file import EXP_DIR
-from envexp_utils.log import log_dependencies, run_and_log
+from envexp_utils.executable import supports
+from envexp_utils.file import EXP_DIR, ROOT_DIR
+from envexp_utils.interpreter import get_environment_prefix, get_python_command
+from envexp_utils.inventory import read_conda_records, requirement_name
+from envexp_utils.lockfile import (
+    LOCKFILE,
+    lockfile_create_command,
+    read_lockfile_hash,
+    write_lockfile,
+)
+from envexp_utils.log import RunError, log_dependencies, quote_argument, run_and_log
+from envexp_utils.offline import (
+    WHEELS_DIR,
+    offline_environment_file,
+    offline_variables,
+)
+from envexp_utils.report import timed_phase
 
-def determine_conda():
-    """Determines the conda executable to use (i.e. mm, mamba, or conda)."""
+def normalize_environment_text(text):
+    """Returns environment file contents without comments, blank lines or name."""
 
-    print("\nDetermining conda executable...")
+    lines = []
+    for line in text.splitlines():
+        line = re.sub(r"(^|\s)#.*$", "", line).rstrip()
+        # Skip blank lines and the environment name (it does not affect the solve)
+        if not line.strip() or line.startswith("name:"):
+            continue
+        lines.append(line)
+    return "\n".join(lines) + "\n"
 
-    # Check if mamba is installed
-    try:
-        output = subprocess.run("mamba --version", shell=True, capture_output=True)
-        if len(output.stderr) > 0:
-            raise FileNotFoundError("No mamba executable found.")
-        print("\t... using mamba")
-        return "mamba"
-    except Exception as e:
-        pass
 
-    # Check if micromamba is installed
-    try:
-        output = subprocess.run("micromamba --version", shell=True, capture_output=True)
-        if len(output.stderr) > 0:
-            raise FileNotFoundError("No micromamba executable found.")
-        print("\t... using micromamba")
-        return "micromamba"
-    except FileNotFoundError:
-        pass
-
-    # Check if conda is installed
-    try:
-        output = subprocess.run("conda --version", shell=True, capture_output=True)
-        if len(output.stderr) > 0:
-            raise FileNotFoundError("No conda executable found.")
-        print("\t... using conda")
-        return "conda"
-    except FileNotFoundError:
-        pass
+def normalize_environment_file(environment_file=None):
+    """Returns the environment file contents without comments, blank lines or name.
+
+    Args:
+        environment_file (Path): The environment file to normalize. Defaults to
+            envexp/environment.yml.
+    """
+
+    if environment_file is None:
+        environment_file = EXP_DIR / "environment.yml"
+
+    return normalize_environment_text(Path(environment_file).read_text())
+
+
+def hash_environment_file(conda_command=None, environment_file=None):
+    """Hashes the normalized environment file along with the platform and conda flavor.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or
+            conda). If None, the conda flavor is not part of the hash.
+        environment_file (Path): The environment file to hash. Defaults to
+            envexp/environment.yml.
+    """
+
+    hasher = hashlib.sha256()
+    hasher.update(normalize_environment_file(environment_file).encode())
+    hasher.update(f"{platform.system()}-{platform.machine()}".encode())
+    if conda_command is not None:
+        hasher.update(conda_command.encode())
+    return hasher.hexdigest()
+
+
+def read_pip_requirements(environment_file=None):
+    """Returns the requirements listed in the pip section of the environment file."""
 
-    raise FileNotFoundError("No conda executable found.")
+    requirements = []
+    pip_indent = None
+    for line in normalize_environment_file(environment_file).splitlines():
+        indent = len(line) - len(line.lstrip())
+        stripped = line.strip()
+        if pip_indent is not None:
+            if indent > pip_indent and stripped.startswith("- "):
+                requirements.append(stripped[2:].strip())
+                continue
+            pip_indent = None
+        if stripped == "- pip:":
+            pip_indent = indent
+    return requirements
 
-def create_environment(conda_command):
-    """Creates a new conda environment with the required dependencies."""
 
-    print("\n(Re)creating experiment environment...")
+def read_conda_dependencies(environment_file=None):
+    """Returns the channels and the conda dependencies listed in the environment file.
 
-    environment_file = EXP_DIR / "environment.yml"
+    Returns:
+        tuple[list[str], list[str]]: The channels and the conda package specs (the
+            pip section is not included).
+    """
+
+    channels, specs = [], []
+    section = None
+    item_indent = None
+    for line in normalize_environment_file(environment_file).splitlines():
+        indent = len(line) - len(line.lstrip())
+        stripped = line.strip()
+        if indent == 0 and stripped.endswith(":") and not stripped.startswith("- "):
+            section, item_indent = stripped[:-1], None
+            continue
+        if not stripped.startswith("- "):
+            continue
+        # Only the top-level items of a section (e.g. not the nested pip section)
+        if item_indent is None:
+            item_indent = indent
+        if indent != item_indent or stripped == "- pip:":
+            continue
+        if section == "channels":
+            channels.append(stripped[2:].strip())
+        elif section == "dependencies":
+            specs.append(stripped[2:].strip())
+    return channels, specs
+
+
+def install_pip_requirements(
+    conda_command, environment_file=None, env_name="experiment", offline=False
+):
+    """Installs the pip section of the environment file into the environment.
+
+    If offline, pip does not use the package index (or build isolation, which
+    would download the build requirements), only the wheels downloaded by
+    `prefetch_environment`.
+    """
+
+    requirements = read_pip_requirements(environment_file)
+    if not requirements:
+        return
+
+    print("\nInstalling pip requirements...")
+    python, env = get_python_command(conda_command=conda_command, env_name=env_name)
+    quoted = " ".join(quote_argument(requirement) for requirement in requirements)
+    command = f"{python} -m pip install {quoted}"
+    if offline:
+        command += " --no-index --no-build-isolation"
+        command += f" --find-links {quote_argument(WHEELS_DIR.as_posix())}"
+    fail_message = "Failed to install pip requirements!"
+    pass_message = "Pip requirements installed successfully!"
+    run_and_log(
+        command=command,
+        fail_message=fail_message,
+        pass_message=pass_message,
+        env=env,
+    )
+
+
+def create_environment(
+    conda_command,
+    use_lockfile=True,
+    env_name="experiment",
+    environment_file=None,
+    output_dir=None,
+    include_pip=True,
+    offline=False,
+    base_prefix=None,
+    defer_logging=False,
+):
+    """Creates a new conda environment with the required dependencies.
+
+    If the explicit lockfile was written for the current environment.yml, the
+    environment is created from the lockfile and the solver is skipped entirely.
+    Otherwise, the environment is solved and the lockfile is (re)written.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        use_lockfile (bool): Whether to create the environment from the lockfile.
+        env_name (str): The name of the environment to create.
+        environment_file (Path): The environment file to create the environment
+            from. Defaults to envexp/environment.yml.
+        output_dir (Path): The directory to write the lockfile and dependency logs
+            to. Defaults to the root directory.
+        include_pip (bool): If False, pipdeptree.txt is not written.
+        offline (bool): Whether to build only from the managed package directory
+            (see `prefetch_environment`), solving against the local channel.
+        base_prefix (Path): A base environment (see `find_closest_base`) to clone
+            when solving, so only the packages that differ from it are installed.
+        defer_logging (bool): If True, the dependencies are only logged here if
+            creating the environment fails (the caller logs them otherwise, e.g.
+            while the tests run).
+    """
+
+    print(f"\n(Re)creating {env_name} environment...")
+
+    if environment_file is None:
+        environment_file = EXP_DIR / "environment.yml"
+    if output_dir is None:
+        output_dir = ROOT_DIR
+    lockfile = output_dir / LOCKFILE.name
+    yml_hash = hash_environment_file(environment_file=environment_file)
+    from_lockfile = use_lockfile and read_lockfile_hash(lockfile) == yml_hash
 
     # Create a new conda environment with the required dependencies
-    command = f"{conda_command} env create -f {environment_file.as_posix()}"
-    if conda_command == "micromamba":
-        command += " -y"
+    delta_command = None
+    if from_lockfile:
+        print("\t... using explicit lockfile (skipping solve)")
+        command = lockfile_create_command(
+            conda_command, env_name=env_name, lockfile=lockfile
+        )
+    else:
+        solve_file = environment_file
+        if offline:
+            print("\t... solving offline against the local channel")
+            solve_file = offline_environment_file(environment_file)
+        command = f"{conda_command} env create -f {Path(solve_file).as_posix()}"
+        if env_name != "experiment":
+            command += f" -n {env_name}"
+        if conda_command == "micromamba":
+            command += " -y"
+        if base_prefix is not None:
+            with timed_phase("clone_base_environment"):
+                cloned = clone_environment(
+                    conda_command, source=base_prefix, env_name=env_name
+                )
+            if cloned:
+                # Install the delta (the base's extra packages are removed after it)
+                delta_command = (
+                    f"{conda_command} env update -n {env_name} "
+                    f"-f {Path(solve_file).as_posix()} --prune"
+                )
+                if conda_command == "micromamba":
+                    delta_command = (
+                        f"{conda_command} install -n {env_name} "
+                        f"-f {Path(solve_file).as_posix()} -y"
+                    )
+            else:
+                print("\t... failed to clone pool base, creating from scratch")
 
     fail_message = "Failed to create environment!"
     pass_message = "Environment created successfully!"
 
+    created = False
     try:
-        run_and_log(
-            command=command, fail_message=fail_message, pass_message=pass_message
-        )
+        with timed_phase("create_environment"):
+            env = offline_variables() if offline else None
+            if delta_command is None or not install_environment_delta(
+                conda_command,
+                command=delta_command,
+                env_name=env_name,
+                environment_file=environment_file,
+                env=env,
+            ):
+                run_and_log(
+                    command=command,
+                    fail_message=fail_message,
+                    pass_message=pass_message,
+                    env=env,
+                )
+        if from_lockfile:
+            with timed_phase("install_pip_requirements"):
+                install_pip_requirements(
+                    conda_command=conda_command,
+                    environment_file=environment_file,
+                    env_name=env_name,
+                    offline=offline,
+                )
+        else:
+            with timed_phase("write_lockfile"):
+                write_lockfile(
+                    conda_command=conda_command,
+                    yml_hash=yml_hash,
+                    env_name=env_name,
+                    lockfile=lockfile,
+                )
+        created = True
     except Exception as e:
         raise e
     finally:
-        # Log the dependencies
-        log_dependencies(conda_command=conda_command)
+        # Log the dependencies (of the partial environment if creating it failed)
+        if not (created and defer_logging):
+            with timed_phase("log_dependencies"):
+                log_dependencies(
+                    conda_command=conda_command,
+                    env_name=env_name,
+                    output_dir=output_dir,
+                    include_pip=include_pip,
+                )
+
+
+def find_extra_packages(prefix, environment_file=None):
+    """Finds the conda packages of an environment its environment file does not need.
+
+    A package is needed if the environment file lists it or a needed package depends
+    on it (pip is always needed, as conda installs it with python).
+
+    Returns:
+        list[str]: The sorted names of the extra packages, or None if the packages
+            of the environment cannot be read.
+    """
+
+    if prefix is None or not (Path(prefix) / "conda-meta").is_dir():
+        return None
+    records, _ = read_conda_records(prefix)
+    depends = {record["name"].lower(): record["depends"] for record in records}
+
+    _, specs = read_conda_dependencies(environment_file)
+    stack = ["pip"]
+    for spec in specs:
+        name = requirement_name(spec.rsplit("::", 1)[-1])
+        if name is not None:
+            stack.append(name.lower())
+
+    needed = set()
+    while stack:
+        name = stack.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        stack += [depend.lower() for depend in depends.get(name, [])]
+    return sorted(set(depends) - needed)
+
+
+def install_environment_delta(
+    conda_command, command, env_name="experiment", environment_file=None, env=None
+):
+    """Installs the delta of an environment file into a cloned pool base.
+
+    `micromamba install -f` does not prune (and `env update --prune` may not), so the
+    base's packages that the environment file does not need are removed afterwards.
+    Otherwise they would be left in the environment (and its lockfile).
+
+    Returns:
+        bool: True if the environment now has only the packages the environment file
+            needs. If False, the environment was removed to be created from scratch.
+    """
+
+    try:
+        run_and_log(
+            command=command,
+            fail_message="Failed to install the delta into the pool base!",
+            pass_message="Delta installed into the pool base!",
+            env=env,
+        )
+        prefix = get_environment_prefix(conda_command=conda_command, env_name=env_name)
+        extras = find_extra_packages(prefix, environment_file=environment_file)
+        if extras:
+            print(f"\t... removing {len(extras)} unneeded packages of the pool base")
+            quoted = " ".join(quote_argument(name) for name in extras)
+            run_and_log(
+                command=f"{conda_command} remove -n {env_name} --force -y {quoted}",
+                fail_message="Failed to remove the unneeded packages of the pool base!",
+                pass_message="Unneeded packages of the pool base removed!",
+                env=env,
+            )
+            extras = find_extra_packages(prefix, environment_file=environment_file)
+    except (RunError, TimeoutError):
+        extras = None
+
+    if extras == []:
+        return True
+    print("\t... failed to prune the pool base, creating from scratch")
+    remove_environment(conda_command, env_name=env_name)
+    return False
+
+
+def clone_environment(conda_command, source, env_name=None, prefix=None):
+    """Clones an environment prefix to a named environment or another prefix.
+
+    Returns:
+        bool: True if the clone succeeded.
+    """
+
+    if not supports(conda_command, "clone"):
+        return False
+
+    target = f"-n {env_name}" if prefix is None else f'-p "{Path(prefix).as_posix()}"'
+    command = (
+        f'{conda_command} create {target} --clone "{Path(source).as_posix()}" -y'
+    )
+    output = subprocess.run(command, shell=True, capture_output=True)
+    return output.returncode == 0
 
 
-def remove_environment(conda_command):
+def remove_environment(conda_command, env_name="experiment"):
     """Removes the conda environment created for the experiment."""
 
-    print("\nRemoving experiment environment...")
+    print(f"\nRemoving {env_name} environment...")
 
     # Remove the conda environment
-    command = f"{conda_command} env remove -n experiment"
+    command = f"{conda_command} env remove -n {env_name}"
     if conda_command == "micromamba":
         command += " -y"
     subprocess.run(f"{command}", shell=True)
\ No newline at end of file
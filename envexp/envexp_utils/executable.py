@@ -0,0 +1,187 @@
+"""Defines functions for finding the conda executable and what it supports.
+
+The candidates are found on the PATH (without spawning a shell) and probed
+concurrently. The results are cached per user and reprobed only when the path or
+modification time of an executable changes.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from envexp_utils.file import CACHE_DIR
+
+# Configure the conda executables to look for (in order of preference)
+CONDA_CANDIDATES = ("mamba", "micromamba", "conda")
+CONDA_STATE = CACHE_DIR / "conda.json"
+CONDA_STATE_VERSION = 2
+PROBE_TIMEOUT = 60  # Seconds after which a hung probe counts as a failure
+
+VERSION_PATTERN = re.compile(r"(\d+(?:\.\d+)+)")
+# Options of `<conda> create --help` that envexp relies on, by capability (every
+# option of a capability must be listed)
+CAPABILITY_OPTIONS = {
+    "clone": ("--clone",),
+    "dry_run_json": ("--dry-run", "--json"),
+}
+
+
+def load_conda_state():
+    """Loads the cached probe results, keyed by executable name."""
+
+    if not CONDA_STATE.exists():
+        return {}
+    try:
+        state = json.loads(CONDA_STATE.read_text())
+    except json.JSONDecodeError:
+        return {}
+    if state.get("version") != CONDA_STATE_VERSION:
+        return {}
+    return state["executables"]
+
+
+def save_conda_state(executables):
+    """Saves the probe results."""
+
+    CONDA_STATE.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = CONDA_STATE.with_suffix(".tmp")
+    tmp_path.write_text(
+        json.dumps(
+            {"version": CONDA_STATE_VERSION, "executables": executables}, indent=2
+        )
+    )
+    os.replace(tmp_path, CONDA_STATE)
+
+
+def run_probe(path, *args):
+    """Runs an executable with arguments (without a shell).
+
+    Returns:
+        str: The stdout, or None if the executable failed (by its return code).
+    """
+
+    try:
+        output = subprocess.run(
+            [path, *args], capture_output=True, text=True, timeout=PROBE_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if output.returncode != 0:
+        return None
+    return output.stdout
+
+
+def has_option(help_output, option):
+    """Returns whether the help output lists an option (not just a longer one)."""
+
+    pattern = rf"(?<![\w-]){re.escape(option)}(?![\w-])"
+    return re.search(pattern, help_output) is not None
+
+
+def probe_conda(path):
+    """Probes the version and capabilities of a conda executable.
+
+    Returns:
+        dict: Whether the executable works ('ok'), its 'version' and 'capabilities'.
+    """
+
+    version_output = run_probe(path, "--version")
+    if version_output is None:
+        return {"ok": False, "version": None, "capabilities": {}}
+
+    version = VERSION_PATTERN.search(version_output)
+    help_output = run_probe(path, "create", "--help") or ""
+    return {
+        "ok": True,
+        "version": version[1] if version else None,
+        "capabilities": {
+            capability: all(has_option(help_output, option) for option in options)
+            for capability, options in CAPABILITY_OPTIONS.items()
+        },
+    }
+
+
+def find_conda_executables(use_cache=True):
+    """Finds and probes (or looks up the cached probes of) the conda executables.
+
+    Args:
+        use_cache (bool): Whether to reuse the cached probe results.
+
+    Returns:
+        dict: Mapping of each candidate found on the PATH to its 'path', 'mtime'
+            and probe results (see `probe_conda`), in order of preference.
+    """
+
+    cached = load_conda_state() if use_cache else {}
+    executables, to_probe = {}, []
+    for name in CONDA_CANDIDATES:
+        path = shutil.which(name)
+        if path is None:
+            continue
+        mtime = os.stat(path).st_mtime
+        entry = cached.get(name)
+        if entry is not None and entry["path"] == path and entry["mtime"] == mtime:
+            executables[name] = entry
+        else:
+            executables[name] = {"path": path, "mtime": mtime}
+            to_probe.append(name)
+
+    if to_probe:
+        with ThreadPoolExecutor(max_workers=len(to_probe)) as executor:
+            probes = executor.map(
+                probe_conda, [executables[name]["path"] for name in to_probe]
+            )
+            for name, probe in zip(to_probe, probes):
+                executables[name].update(probe)
+        save_conda_state({**cached, **executables})
+    return executables
+
+
+def determine_conda(use_cache=True):
+    """Determines the conda executable to use (i.e. mamba, micromamba, or conda).
+
+    Args:
+        use_cache (bool): Whether to reuse the cached probe results.
+
+    Returns:
+        str: The name of the first working executable in CONDA_CANDIDATES.
+    """
+
+    print("\nDetermining conda executable...")
+
+    for name, executable in find_conda_executables(use_cache=use_cache).items():
+        if executable["ok"]:
+            print(f"\t... using {name} {executable['version'] or ''}".rstrip())
+            return name
+
+    raise FileNotFoundError("No conda executable found.")
+
+
+def get_conda_info(conda_command):
+    """Returns the cached path, version and capabilities of a conda executable.
+
+    Returns:
+        dict: The probe results (see `find_conda_executables`), or None if the
+            executable was not probed.
+    """
+
+    return load_conda_state().get(conda_command)
+
+
+def supports(conda_command, capability):
+    """Returns whether a conda executable supports a capability.
+
+    Executables (or capabilities) that were not probed are assumed to support it.
+
+    Args:
+        conda_command (str): The conda command (i.e. micromamba, mamba, or conda)
+        capability (str): A capability in CAPABILITY_OPTIONS, e.g. 'clone'.
+    """
+
+    info = get_conda_info(conda_command)
+    if info is None or not info.get("ok"):
+        return True
+    return info["capabilities"].get(capability, True)
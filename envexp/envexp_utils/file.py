@@ -1,8 +1,12 @@
 """File constants."""
 
+import os
 from pathlib import Path
 
 # Configure commonly reused paths
 FILE_PATH = Path(__file__)
 EXP_DIR = FILE_PATH.parent.parent
-ROOT_DIR = EXP_DIR.parent.absolute()
\ No newline at end of file
+ROOT_DIR = EXP_DIR.parent.absolute()
+
+# Configure per-user state directory (e.g. cached environments)
+CACHE_DIR = Path(os.environ.get("ENVEXP_CACHE_DIR", Path.home() / ".envexp"))
@@ -0,0 +1,389 @@
+"""Defines a local SQLite index of the experiment runs committed to git."""
+
+import json
+import re
+import sqlite3
+import subprocess
+from contextlib import closing
+
+from envexp_utils.env_diff import (
+    INVENTORY_FILES,
+    compare_versions,
+    parse_inventory,
+    read_run_files,
+)
+from envexp_utils.file import ROOT_DIR
+from envexp_utils.log import logger
+from envexp_utils.report import RUN_REPORT
+from envexp_utils.signature import describe_signature
+
+# Configure the history index (not committed, see .gitignore)
+HISTORY_DB = ROOT_DIR / "history.sqlite"
+HISTORY_SCHEMA_VERSION = 3
+
+# The files each run is indexed from (relative to the root directory)
+RUN_REPORT_FILE = RUN_REPORT.relative_to(ROOT_DIR).as_posix()
+
+# Experiment commits are prefixed with the result of the run
+RUN_STATUSES = {"P:": "passed", "F:": "failed"}
+PACKAGE_SPEC_PATTERN = re.compile(
+    r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:(==|!=|>=|<=|>|<)\s*(\S+))?\s*$"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    commit_sha TEXT PRIMARY KEY,
+    committed TEXT,
+    subject TEXT,
+    status TEXT,
+    yml_hash TEXT,
+    platform TEXT,
+    conda_command TEXT,
+    total_wall_s REAL,
+    failure_signature TEXT
+);
+CREATE TABLE IF NOT EXISTS packages (
+    commit_sha TEXT,
+    name TEXT,
+    version TEXT,
+    build TEXT,
+    channel TEXT,
+    PRIMARY KEY (commit_sha, name)
+);
+CREATE INDEX IF NOT EXISTS packages_by_name ON packages (name, commit_sha);
+CREATE TABLE IF NOT EXISTS phases (
+    commit_sha TEXT,
+    name TEXT,
+    status TEXT,
+    wall_s REAL,
+    cpu_s REAL
+);
+CREATE INDEX IF NOT EXISTS phases_by_commit ON phases (commit_sha);
+CREATE TABLE IF NOT EXISTS failures (
+    signature TEXT PRIMARY KEY,
+    exception TEXT,
+    failing_import TEXT,
+    frames TEXT,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_by_status ON runs (status, committed);
+CREATE INDEX IF NOT EXISTS runs_by_signature ON runs (failure_signature, committed);
+"""
+
+
+def connect_history(db_path=None):
+    """Opens (and creates if needed) the history index.
+
+    Args:
+        db_path (Path): The SQLite database file. Defaults to history.sqlite.
+
+    Returns:
+        sqlite3.Connection: The connection, with a `compare_versions` SQL function.
+    """
+
+    if db_path is None:
+        db_path = HISTORY_DB
+
+    connection = sqlite3.connect(db_path)
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version != HISTORY_SCHEMA_VERSION:
+        # The index can always be rebuilt from git, so outdated indexes are dropped
+        connection.executescript(
+            "DROP TABLE IF EXISTS runs; DROP TABLE IF EXISTS packages; "
+            "DROP TABLE IF EXISTS phases; DROP TABLE IF EXISTS failures;"
+        )
+        connection.execute(f"PRAGMA user_version = {HISTORY_SCHEMA_VERSION}")
+    connection.executescript(SCHEMA)
+    connection.create_function(
+        "compare_versions", 2, compare_versions, deterministic=True
+    )
+    return connection
+
+
+def list_run_commits(revisions=("HEAD",)):
+    """Lists the experiment commits (prefixed with P: or F:) reachable from revisions.
+
+    Returns:
+        list[tuple[str, str, str]]: The SHA, commit date and subject of each commit.
+    """
+
+    output = subprocess.run(
+        ["git", "log", "--format=%H%x00%cI%x00%s", *revisions, "--"],
+        capture_output=True,
+        cwd=ROOT_DIR,
+    )
+    if output.returncode != 0:
+        raise Exception(output.stderr.decode(errors="replace"))
+
+    commits = []
+    for line in output.stdout.decode(errors="replace").splitlines():
+        sha, committed, subject = line.split("\0", 2)
+        if subject[:2] in RUN_STATUSES:
+            commits.append((sha, committed, subject))
+    return commits
+
+
+def read_run(sha, committed, subject, blobs):
+    """Reads the indexed fields of a run from the files committed with it.
+
+    Args:
+        sha (str): The SHA of the experiment commit.
+        committed (str): The commit date.
+        subject (str): The subject of the commit message.
+        blobs (dict): Mapping of '<sha>:<path>' to the committed file contents.
+
+    Returns:
+        tuple[dict, dict, list[dict], dict]: The run, its packages, its phases and
+            its failure signature (or None).
+    """
+
+    report = {}
+    if blobs.get(f"{sha}:{RUN_REPORT_FILE}"):
+        try:
+            report = json.loads(blobs[f"{sha}:{RUN_REPORT_FILE}"])
+        except json.JSONDecodeError:
+            pass
+
+    packages, _ = parse_inventory(
+        {name: blobs.get(f"{sha}:{name}") for name in INVENTORY_FILES}
+    )
+    phases = report.get("phases", [])
+    failure = report.get("failure")
+    run = {
+        "commit_sha": sha,
+        "committed": committed,
+        "subject": subject,
+        "status": RUN_STATUSES[subject[:2]],
+        # Recorded at run time (see `hash_environment_file`), missing for older runs
+        "yml_hash": report.get("yml_hash"),
+        "platform": report.get("platform"),
+        "conda_command": report.get("conda_command"),
+        # Nested phases are already part of their top-level phase
+        "total_wall_s": sum(
+            phase["wall_s"] for phase in phases if "/" not in phase["name"]
+        )
+        or None,
+        "failure_signature": failure["signature"] if failure else None,
+    }
+    return run, packages, phases, failure
+
+
+def index_runs(connection, commits):
+    """Indexes experiment commits (reading their files with a single git process,
+    or from the artifact store for runs committed with --compact-artifacts).
+
+    Args:
+        connection (sqlite3.Connection): The history index.
+        commits (list[tuple[str, str, str]]): The SHA, commit date and subject of
+            each experiment commit.
+    """
+
+    if not commits:
+        return
+
+    files = (*INVENTORY_FILES, RUN_REPORT_FILE)
+    blobs = read_run_files([f"{sha}:{name}" for sha, _, _ in commits for name in files])
+    with connection:
+        for sha, committed, subject in commits:
+            run, packages, phases, failure = read_run(sha, committed, subject, blobs)
+            connection.execute("DELETE FROM packages WHERE commit_sha = ?", (sha,))
+            connection.execute("DELETE FROM phases WHERE commit_sha = ?", (sha,))
+            connection.execute(
+                f"INSERT OR REPLACE INTO runs ({', '.join(run)}) "
+                f"VALUES ({', '.join('?' * len(run))})",
+                tuple(run.values()),
+            )
+            connection.executemany(
+                "INSERT INTO packages VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        sha,
+                        name,
+                        package["version"],
+                        package["build"],
+                        package["channel"],
+                    )
+                    for name, package in packages.items()
+                ],
+            )
+            connection.executemany(
+                "INSERT INTO phases VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        sha,
+                        phase["name"],
+                        phase.get("status"),
+                        phase.get("wall_s"),
+                        phase.get("cpu_s"),
+                    )
+                    for phase in phases
+                ],
+            )
+            if failure is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?)",
+                    (
+                        failure["signature"],
+                        failure["exception"],
+                        failure["import"],
+                        json.dumps(failure["frames"]),
+                        failure["message"],
+                    ),
+                )
+
+
+def backfill_history(db_path=None):
+    """Indexes the experiment commits in git history that are not indexed yet.
+
+    Returns:
+        int: The number of newly indexed runs.
+    """
+
+    with closing(connect_history(db_path)) as connection:
+        indexed = {sha for (sha,) in connection.execute("SELECT commit_sha FROM runs")}
+        commits = [commit for commit in list_run_commits() if commit[0] not in indexed]
+        index_runs(connection, commits)
+    return len(commits)
+
+
+def record_run(db_path=None):
+    """Indexes the experiment commit at HEAD (called right after committing)."""
+
+    try:
+        with closing(connect_history(db_path)) as connection:
+            index_runs(connection, list_run_commits(["-1", "HEAD"]))
+    except Exception as e:
+        # The index can be backfilled later, so do not fail the run over it
+        logger.warning(f"Could not add the run to the history index: {e}")
+
+
+def parse_package_spec(spec):
+    """Parses a package spec like 'numpy>=2' into (name, operator, version)."""
+
+    match = PACKAGE_SPEC_PATTERN.match(spec)
+    if match is None:
+        raise ValueError(f"Invalid package spec: {spec!r}. E.g. 'numpy>=2' or 'qtpy'.")
+    name, operator, version = match.groups()
+    return name.lower(), operator, version
+
+
+def query_history(
+    package_specs=(), status=None, signature=None, limit=None, db_path=None
+):
+    """Queries the runs by installed package versions and status.
+
+    Args:
+        package_specs (list[str]): Specs that every returned run must satisfy, e.g.
+            'numpy>=2' or 'qtpy' (installed at any version).
+        status (str): Only return runs with this status ('passed' or 'failed').
+        signature (str): Only return runs that failed with this failure signature.
+        limit (int): The maximum number of (most recent) runs to return.
+        db_path (Path): The SQLite database file. Defaults to history.sqlite.
+
+    Returns:
+        list[dict]: The matching runs, most recent first.
+    """
+
+    conditions, parameters = [], []
+    for spec in package_specs:
+        name, operator, version = parse_package_spec(spec)
+        condition = "p.name = ?"
+        parameters.append(name)
+        if operator is not None:
+            condition += f" AND compare_versions(p.version, ?) {operator} 0"
+            parameters.append(version)
+        conditions.append(
+            "EXISTS (SELECT 1 FROM packages p "
+            f"WHERE p.commit_sha = runs.commit_sha AND {condition})"
+        )
+    if status is not None:
+        conditions.append("runs.status = ?")
+        parameters.append(status)
+    if signature is not None:
+        conditions.append("runs.failure_signature = ?")
+        parameters.append(signature)
+
+    query = "SELECT * FROM runs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY committed DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        parameters.append(limit)
+
+    with closing(connect_history(db_path)) as connection:
+        connection.row_factory = sqlite3.Row
+        return [dict(row) for row in connection.execute(query, parameters)]
+
+
+def find_failure_cluster(signature, db_path=None):
+    """Finds the earlier runs that failed with the same signature.
+
+    Returns:
+        tuple[int, str]: The number of earlier runs and the SHA of the first one.
+    """
+
+    backfill_history(db_path)
+    with closing(connect_history(db_path)) as connection:
+        count, first_sha = connection.execute(
+            "SELECT COUNT(*), MIN(committed || ' ' || commit_sha) FROM runs "
+            "WHERE failure_signature = ?",
+            (signature,),
+        ).fetchone()
+    return count, first_sha.split(" ", 1)[1] if first_sha else None
+
+
+def describe_failure_cluster(failure):
+    """Labels a failure with how often (and since when) it has been seen before.
+
+    Args:
+        failure (dict): The failure signature (see `failure_signature`).
+
+    Returns:
+        str: E.g. 'Failure a1b2c3 ModuleNotFoundError importing qtpy: seen 3 times
+            before, first in commit 1a2b3c4d5e'.
+    """
+
+    try:
+        count, first_sha = find_failure_cluster(failure["signature"])
+    except Exception as e:
+        logger.warning(f"Could not look up the failure in the history index: {e}")
+        count, first_sha = 0, None
+
+    description = f"Failure {describe_signature(failure)}: "
+    if count:
+        description += f"seen {count} times before, first in commit {first_sha[:10]}"
+    else:
+        description += "new failure signature"
+    logger.info(description)
+    print(f"\n{description}")
+    return description
+
+
+def format_history(runs):
+    """Formats runs as a table of commit, date, status, duration, failure, subject."""
+
+    if not runs:
+        return "No matching runs."
+    lines = []
+    for run in runs:
+        duration = "" if run["total_wall_s"] is None else f"{run['total_wall_s']:.0f}s"
+        lines.append(
+            f"{run['commit_sha'][:10]}  {run['committed'][:19]}  "
+            f"{run['status']:<6}  {duration:>6}  {run['failure_signature'] or '':<12}  "
+            f"{run['subject']}"
+        )
+    return "\n".join(lines)
+
+
+def show_history(package_specs=(), status=None, signature=None, limit=None):
+    """Backfills the history index and prints the runs matching the query."""
+
+    newly_indexed = backfill_history()
+    if newly_indexed:
+        print(f"\nIndexed {newly_indexed} new runs from git history.")
+    runs = query_history(
+        package_specs=package_specs, status=status, signature=signature, limit=limit
+    )
+    print(f"\n{format_history(runs)}")
+    return runs
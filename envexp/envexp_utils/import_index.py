@@ -0,0 +1,104 @@
+"""Defines a persistent index of the imports extracted from each Python file."""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from envexp_utils.file import CACHE_DIR
+
+# Configure the import index
+IMPORT_INDEX_DIR = CACHE_DIR / "import_index"
+IMPORT_INDEX_VERSION = 1
+
+
+def import_index_path(input_dir):
+    """Returns the path of the import index for a source directory."""
+
+    dir_hash = hashlib.sha1(Path(input_dir).absolute().as_posix().encode()).hexdigest()
+    return IMPORT_INDEX_DIR / f"{Path(input_dir).name}-{dir_hash[:12]}.json"
+
+
+def load_import_index(input_dir):
+    """Loads the import index of a source directory (or an empty index)."""
+
+    index_path = import_index_path(input_dir)
+    empty_index = {"version": IMPORT_INDEX_VERSION, "files": {}}
+    if not index_path.exists():
+        return empty_index
+    try:
+        index = json.loads(index_path.read_text())
+    except json.JSONDecodeError:
+        return empty_index
+    if index.get("version") != IMPORT_INDEX_VERSION:
+        return empty_index
+    return index
+
+
+def save_import_index(input_dir, index):
+    """Saves the import index of a source directory."""
+
+    index_path = import_index_path(input_dir)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(index, separators=(",", ":")))
+    os.replace(tmp_path, index_path)
+
+
+def file_digest(path):
+    """Returns the sha256 hex digest of a file."""
+
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def find_stale_files(index, input_dir, python_files, scan_key):
+    """Finds the files whose imports for the scan key are missing or out of date.
+
+    Files whose mtime and size are unchanged are trusted without being read. Files
+    whose mtime or size changed but whose content hash is unchanged are updated in
+    place. Entries of files that no longer exist are dropped from the index.
+
+    Args:
+        index (dict): The import index (updated in place).
+        input_dir (Path): The source directory the index is for.
+        python_files (list[Path]): All Python files currently in the source directory.
+        scan_key (str): The key of the extracted imports, e.g. 'qtpy:top'.
+
+    Returns:
+        list[Path]: The files that need to be (re)scanned.
+    """
+
+    old_files = index["files"]
+    new_files = {}
+    stale_files = []
+    for python_file in python_files:
+        relative_path = python_file.relative_to(input_dir).as_posix()
+        stat = python_file.stat()
+        entry = old_files.get(relative_path)
+
+        if entry is None or (
+            entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size
+        ):
+            digest = file_digest(python_file)
+            if entry is None or entry["sha256"] != digest:
+                entry = {"sha256": digest, "imports": {}, "errors": {}}
+            entry["mtime_ns"] = stat.st_mtime_ns
+            entry["size"] = stat.st_size
+
+        new_files[relative_path] = entry
+        if scan_key not in entry["imports"]:
+            stale_files.append(python_file)
+
+    index["files"] = new_files
+    return stale_files
+
+
+def record_imports(index, input_dir, python_file, scan_key, imports, error=None):
+    """Records the imports (or scan error) of a file for the scan key."""
+
+    entry = index["files"][python_file.relative_to(input_dir).as_posix()]
+    entry["imports"][scan_key] = imports
+    if error is None:
+        entry["errors"].pop(scan_key, None)
+    else:
+        entry["errors"][scan_key] = error
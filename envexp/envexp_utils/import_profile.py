@@ -0,0 +1,187 @@
+"""Defines functions for profiling the import time of the tested repo."""
+
+import json
+import os
+import re
+import subprocess
+
+from envexp_utils.file import EXP_DIR, ROOT_DIR
+from envexp_utils.interpreter import get_python_command
+from envexp_utils.log import logger
+from envexp_utils.report import RUN_REPORT, add_to_report
+from envexp_utils.test import pythonpath_variables
+
+# Configure import profiling
+TOP_OFFENDERS = 20
+REGRESSION_RATIO = 1.2  # Flag modules whose cumulative time grew by more than 20%...
+REGRESSION_MIN_US = 5000  # ...and by more than 5 ms
+
+IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+
+def parse_importtime(output):
+    """Parses the output of `python -X importtime` into a tree of modules.
+
+    Args:
+        output (str): The stderr of `python -X importtime`.
+
+    Returns:
+        list[dict]: The top-level imports, each with the module name, self and
+            cumulative time (in microseconds) and the nested imports as children.
+    """
+
+    # Imports are printed after their nested imports, indented by two spaces a level
+    pending = {}
+    for line in output.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, module = match.groups()
+        depth = (len(indent) - 1) // 2
+        node = {
+            "module": module,
+            "self_us": int(self_us),
+            "cumulative_us": int(cumulative_us),
+            "children": pending.pop(depth + 1, []),
+        }
+        pending.setdefault(depth, []).append(node)
+
+    return pending.get(0, [])
+
+
+def flatten_tree(tree):
+    """Flattens an import tree into a list of modules (without children)."""
+
+    modules = []
+    stack = list(tree)
+    while stack:
+        node = stack.pop()
+        modules.append(
+            {key: value for key, value in node.items() if key != "children"}
+        )
+        stack.extend(node["children"])
+    return modules
+
+
+def load_previous_import_profile():
+    """Loads the import profile from the run report of the previous committed run."""
+
+    output = subprocess.run(
+        ["git", "show", f"HEAD:{RUN_REPORT.relative_to(ROOT_DIR).as_posix()}"],
+        capture_output=True,
+        cwd=ROOT_DIR,
+    )
+    if output.returncode != 0:
+        return None
+    try:
+        return json.loads(output.stdout.decode()).get("import_profile")
+    except json.JSONDecodeError:
+        return None
+
+
+def find_regressions(profile, previous_profile):
+    """Finds the modules whose cumulative import time regressed since the last run."""
+
+    if not previous_profile:
+        return []
+
+    previous_times = {
+        module["module"]: module["cumulative_us"]
+        for module in previous_profile["top_cumulative"]
+    }
+    previous_times["<total>"] = previous_profile["total_us"]
+    current_times = {
+        module["module"]: module["cumulative_us"]
+        for module in profile["top_cumulative"]
+    }
+    current_times["<total>"] = profile["total_us"]
+
+    regressions = []
+    for module, current_us in current_times.items():
+        previous_us = previous_times.get(module)
+        if previous_us is None:
+            continue
+        if (
+            current_us > previous_us * REGRESSION_RATIO
+            and current_us - previous_us > REGRESSION_MIN_US
+        ):
+            regressions.append(
+                {
+                    "module": module,
+                    "previous_us": previous_us,
+                    "cumulative_us": current_us,
+                }
+            )
+    return regressions
+
+
+def format_import_profile(profile):
+    """Formats the top offenders and regressions of an import profile."""
+
+    total_ms = profile["total_us"] / 1e3
+    lines = [f"Import time of {profile['repo_name']}: {total_ms:.1f} ms"]
+    lines.append("Top imports by cumulative time:")
+    for module in profile["top_cumulative"][:10]:
+        lines.append(f"  {module['cumulative_us'] / 1e3:8.1f} ms  {module['module']}")
+    for regression in profile["regressions"]:
+        lines.append(
+            f"REGRESSION {regression['module']}: "
+            f"{regression['previous_us'] / 1e3:.1f} ms -> "
+            f"{regression['cumulative_us'] / 1e3:.1f} ms"
+        )
+    return "\n".join(lines)
+
+
+def profile_imports(conda_command, repo_name, env_name="experiment", pythonpath=None):
+    """Profiles the import of the repo with `python -X importtime`.
+
+    The top offenders (by cumulative and self time) and any regressions against the
+    previous committed run are added to the run report.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        repo_name (str): The name of the repo to profile the import of. E.g. 'sleap'.
+        env_name (str): The name of the environment to profile the import in.
+        pythonpath (Path): A directory to add to PYTHONPATH to import the repo from.
+
+    Returns:
+        str: A summary of the top offenders and regressions.
+    """
+
+    print(f"\nProfiling import time of [{repo_name}]...")
+
+    python, env = get_python_command(conda_command=conda_command, env_name=env_name)
+    output = subprocess.run(
+        f'{python} -X importtime -c "import {repo_name}"',
+        shell=True,
+        capture_output=True,
+        cwd=EXP_DIR,
+        env={**os.environ, **env, **pythonpath_variables(pythonpath)},
+    )
+    tree = parse_importtime(output.stderr.decode(errors="replace"))
+    # Skip the imports of the interpreter startup (e.g. site and encodings)
+    tree = [node for node in tree if node["module"] == repo_name] or tree
+    modules = flatten_tree(tree)
+
+    profile = {
+        "repo_name": repo_name,
+        "total_us": sum(node["cumulative_us"] for node in tree),
+        "top_cumulative": sorted(
+            modules, key=lambda module: module["cumulative_us"], reverse=True
+        )[:TOP_OFFENDERS],
+        "top_self": sorted(
+            modules, key=lambda module: module["self_us"], reverse=True
+        )[:TOP_OFFENDERS],
+    }
+    profile["regressions"] = find_regressions(
+        profile, load_previous_import_profile()
+    )
+    add_to_report("import_profile", profile)
+
+    summary = format_import_profile(profile)
+    if profile["regressions"]:
+        logger.warning(summary)
+    else:
+        logger.info(summary)
+    print(summary)
+    return summary
@@ -0,0 +1,106 @@
+"""Defines functions for running the experiment environment's python directly."""
+
+import json
+import os
+import platform
+import subprocess
+from pathlib import Path
+
+# Cache of resolved python executables by (conda command, environment name)
+_PYTHON_PATHS = {}
+
+
+def get_environment_prefix(conda_command, env_name="experiment"):
+    """Returns the prefix of the named environment, or None if it does not exist."""
+
+    output = subprocess.run(
+        f"{conda_command} env list --json", shell=True, capture_output=True
+    )
+    try:
+        envs = json.loads(output.stdout.decode())["envs"]
+    except (json.JSONDecodeError, KeyError):
+        return None
+
+    for env in envs:
+        if Path(env).name == env_name:
+            return Path(env)
+    return None
+
+
+def get_python_path(prefix):
+    """Returns the python executable of an environment prefix."""
+
+    if platform.system() == "Windows":
+        return Path(prefix) / "python.exe"
+    return Path(prefix) / "bin" / "python"
+
+
+def get_python_prefix(python_path):
+    """Returns the environment prefix of a python executable."""
+
+    if platform.system() == "Windows":
+        return Path(python_path).parent
+    return Path(python_path).parent.parent
+
+
+def get_environment_python(conda_command, env_name="experiment"):
+    """Resolves (once) the python executable of the named environment.
+
+    Returns:
+        Path: The python executable, or None if the environment does not exist.
+    """
+
+    key = (conda_command, env_name)
+    python_path = _PYTHON_PATHS.get(key)
+    if python_path is not None and python_path.exists():
+        return python_path
+
+    prefix = get_environment_prefix(conda_command=conda_command, env_name=env_name)
+    if prefix is None or not get_python_path(prefix).exists():
+        return None
+    _PYTHON_PATHS[key] = get_python_path(prefix)
+    return _PYTHON_PATHS[key]
+
+
+def get_activation_variables(python_path):
+    """Returns the environment variables `conda activate` would set for the python.
+
+    Only the variables needed to find the environment's executables and libraries
+    are set (activation scripts of individual packages are not run).
+    """
+
+    prefix = get_python_prefix(python_path)
+    if platform.system() == "Windows":
+        bin_dirs = [
+            prefix,
+            prefix / "Library" / "mingw-w64" / "bin",
+            prefix / "Library" / "usr" / "bin",
+            prefix / "Library" / "bin",
+            prefix / "Scripts",
+            prefix / "bin",
+        ]
+    else:
+        bin_dirs = [prefix / "bin"]
+
+    paths = [str(bin_dir) for bin_dir in bin_dirs] + [os.environ.get("PATH", "")]
+    return {
+        "PATH": os.pathsep.join(path for path in paths if path),
+        "CONDA_PREFIX": str(prefix),
+        "CONDA_DEFAULT_ENV": prefix.name,
+    }
+
+
+def get_python_command(conda_command, env_name="experiment"):
+    """Returns the command prefix (and environment variables) to run python with.
+
+    The environment's python is called directly, which avoids the activation
+    overhead of `conda run`. If it cannot be resolved, `conda run` is used instead.
+
+    Returns:
+        tuple[str, dict]: The command prefix and the environment variables to set.
+    """
+
+    python_path = get_environment_python(conda_command=conda_command, env_name=env_name)
+    if python_path is None:
+        return f"{conda_command} run -n {env_name} python", {}
+    return f'"{python_path}"', get_activation_variables(python_path)
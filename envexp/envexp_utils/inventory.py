@@ -0,0 +1,260 @@
+"""Defines functions for reading the packages installed in an environment from disk.
+
+The conda packages are read from the `conda-meta/*.json` records and the Python
+distributions from the `*.dist-info` metadata of the environment prefix, so no
+process has to be started in (or activated for) the environment.
+"""
+
+import json
+import re
+from email.parser import HeaderParser
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+
+# Configure the inventory outputs
+INVENTORY_VERSION = 1
+DEFAULT_CHANNEL_URL = "https://conda.anaconda.org/"
+CONDA_LIST_HEADER = (
+    "#\n# Name                    Version                   Build  Channel\n"
+)
+
+
+def canonicalize_name(name):
+    """Canonicalizes a distribution name (e.g. 'Foo_Bar' -> 'foo-bar')."""
+
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def requirement_name(requirement):
+    """Returns the name of a requirement, or None if it only applies to an extra."""
+
+    if ";" in requirement and "extra" in requirement.split(";", 1)[1]:
+        return None
+    match = re.match(r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)", requirement)
+    return match.group(1) if match else None
+
+
+def channel_name(channel):
+    """Shortens a channel URL like `mamba list` does (e.g. to 'conda-forge')."""
+
+    if not channel:
+        return ""
+    # Strip the platform subdirectory, e.g. .../conda-forge/linux-64
+    channel = channel.rstrip("/")
+    if "://" in channel:
+        channel = channel.rsplit("/", 1)[0]
+    if channel.startswith(DEFAULT_CHANNEL_URL):
+        channel = channel[len(DEFAULT_CHANNEL_URL) :]
+    return channel
+
+
+def read_conda_records(prefix):
+    """Reads the conda package records of an environment.
+
+    Args:
+        prefix (Path): The prefix of the environment.
+
+    Returns:
+        tuple[list[dict], set[str]]: The name, version, build, channel and dependency
+            names of each package, and the names of the metadata directories (e.g.
+            'pip-24.0.dist-info') that were installed by conda.
+    """
+
+    records = []
+    conda_metadata_dirs = set()
+    for record_path in sorted((Path(prefix) / "conda-meta").glob("*.json")):
+        try:
+            record = json.loads(record_path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            continue
+        if "name" not in record:
+            continue
+
+        records.append(
+            {
+                "name": record["name"],
+                "version": record.get("version", ""),
+                "build": record.get("build", ""),
+                "channel": channel_name(record.get("channel")),
+                "depends": sorted(
+                    {depend.split()[0] for depend in record.get("depends", [])}
+                ),
+            }
+        )
+        for file in record.get("files", []):
+            for part in Path(file).parts:
+                if part.endswith((".dist-info", ".egg-info")):
+                    conda_metadata_dirs.add(part)
+                    break
+
+    records.sort(key=lambda record: record["name"])
+    return records, conda_metadata_dirs
+
+
+def find_site_packages(prefix):
+    """Returns the site-packages directories of an environment."""
+
+    prefix = Path(prefix)
+    return sorted(prefix.glob("lib/python*/site-packages")) + sorted(
+        prefix.glob("Lib/site-packages")
+    )
+
+
+def freeze_requirement(name, version, dist_info):
+    """Returns the distribution as `pip freeze` would (i.e. with its direct URL)."""
+
+    try:
+        direct_url = json.loads((dist_info / "direct_url.json").read_text())
+    except (OSError, json.JSONDecodeError):
+        return f"{name}=={version}"
+
+    url = direct_url.get("url", "")
+    if direct_url.get("dir_info", {}).get("editable"):
+        parsed = urlparse(url)
+        if parsed.scheme == "file":
+            return f"-e {Path(unquote(parsed.path))}"
+        return f"-e {url}"
+    return f"{name} @ {url}"
+
+
+def read_distributions(prefix):
+    """Reads the Python distributions installed in an environment.
+
+    Args:
+        prefix (Path): The prefix of the environment.
+
+    Returns:
+        list[dict]: The name, version, `pip freeze` requirement, required distribution
+            names and metadata directory of each distribution.
+    """
+
+    parser = HeaderParser()
+    distributions = {}
+    for site_packages in find_site_packages(prefix):
+        for dist_info in sorted(site_packages.glob("*.dist-info")):
+            try:
+                with (dist_info / "METADATA").open(encoding="utf-8") as file:
+                    metadata = parser.parse(file)
+            except OSError:
+                continue
+            name, version = metadata["Name"], metadata["Version"]
+            if name is None or canonicalize_name(name) in distributions:
+                continue
+
+            requires = [
+                requirement_name(requirement)
+                for requirement in metadata.get_all("Requires-Dist", [])
+            ]
+            distributions[canonicalize_name(name)] = {
+                "name": name,
+                "version": version,
+                "freeze": freeze_requirement(name, version, dist_info),
+                "requires": sorted({req for req in requires if req is not None}),
+                "metadata_dir": dist_info.name,
+            }
+    return sorted(distributions.values(), key=lambda dist: dist["name"].lower())
+
+
+def read_inventory(prefix):
+    """Reads the conda packages and Python distributions of an environment.
+
+    Args:
+        prefix (Path): The prefix of the environment.
+
+    Returns:
+        dict: The conda packages (under 'conda') and Python distributions (under
+            'pip'). Distributions that were not installed by conda are also listed
+            under 'conda' with the 'pypi' channel (like `mamba list` does).
+    """
+
+    records, conda_metadata_dirs = read_conda_records(prefix)
+    distributions = read_distributions(prefix)
+    for dist in distributions:
+        if dist["metadata_dir"] not in conda_metadata_dirs:
+            records.append(
+                {
+                    "name": canonicalize_name(dist["name"]),
+                    "version": dist["version"],
+                    "build": "pypi_0",
+                    "channel": "pypi",
+                    "depends": dist["requires"],
+                }
+            )
+    records.sort(key=lambda record: record["name"])
+
+    return {
+        "version": INVENTORY_VERSION,
+        "prefix": str(prefix),
+        "conda": records,
+        "pip": distributions,
+    }
+
+
+def format_conda_list(inventory):
+    """Formats the conda packages of an inventory like `mamba list`."""
+
+    lines = [f"# packages in environment at {inventory['prefix']}:\n"]
+    lines.append(CONDA_LIST_HEADER)
+    for record in inventory["conda"]:
+        lines.append(
+            f"{record['name']:<25} {record['version']:<20} {record['build']:>10}    "
+            f"{record['channel']}\n"
+        )
+    return "".join(lines)
+
+
+def format_dependency_tree(distributions):
+    """Formats distributions as a dependency tree (like `pipdeptree -f`).
+
+    Args:
+        distributions (list[dict]): The name, version and required distribution names
+            (and optionally the `pip freeze` requirement) of each distribution.
+
+    Returns:
+        str: Each distribution that no other distribution requires as `name==version`
+            with its requirements nested below it (indented by two spaces per level).
+    """
+
+    by_name = {canonicalize_name(dist["name"]): dist for dist in distributions}
+    required = {
+        canonicalize_name(req) for dist in distributions for req in dist["requires"]
+    }
+
+    lines = []
+
+    def add(dist, depth, ancestors):
+        freeze = dist.get("freeze") or f"{dist['name']}=={dist['version']}"
+        lines.append(f"{'  ' * depth}{freeze}")
+        for req in dist["requires"]:
+            child = by_name.get(canonicalize_name(req))
+            # Skip requirements that are not installed and dependency cycles
+            if child is None or canonicalize_name(req) in ancestors:
+                continue
+            add(child, depth + 1, ancestors | {canonicalize_name(req)})
+
+    for name, dist in sorted(by_name.items()):
+        if name not in required:
+            add(dist, 0, {name})
+    return "\n".join(lines) + "\n"
+
+
+def write_inventory(prefix, output_dir, include_pip=True):
+    """Writes mamba_list.txt, pipdeptree.txt and inventory.json for an environment.
+
+    Args:
+        prefix (Path): The prefix of the environment.
+        output_dir (Path): The directory to write the files to.
+        include_pip (bool): If False, pipdeptree.txt is not written.
+
+    Returns:
+        dict: The inventory of the environment.
+    """
+
+    inventory = read_inventory(prefix)
+    (output_dir / "mamba_list.txt").write_text(format_conda_list(inventory))
+    if include_pip:
+        (output_dir / "pipdeptree.txt").write_text(
+            format_dependency_tree(inventory["pip"])
+        )
+    (output_dir / "inventory.json").write_text(json.dumps(inventory, indent=2) + "\n")
+    return inventory
@@ -0,0 +1,91 @@
+"""Defines functions for the explicit lockfile of the experiment environment."""
+
+import subprocess
+
+from envexp_utils.file import ROOT_DIR
+
+# Configure the explicit lockfile
+LOCKFILE = ROOT_DIR / "explicit.txt"
+LOCKFILE_HASH_PREFIX = "# envexp-yml-hash: "
+
+
+def parse_package_filename(filename):
+    """Parses 'name-version-build.conda' (or .tar.bz2) into (name, version, build)."""
+
+    for extension in (".conda", ".tar.bz2"):
+        if filename.endswith(extension):
+            filename = filename[: -len(extension)]
+            break
+    name, version, build = filename.rsplit("-", 2)
+    return name, version, build
+
+
+def read_lockfile_package_names(lockfile=None):
+    """Returns the names of the packages in the lockfile (even if it is outdated)."""
+
+    if lockfile is None:
+        lockfile = LOCKFILE
+    if not lockfile.exists():
+        return set()
+
+    names = set()
+    for line in lockfile.read_text().splitlines():
+        if "://" in line and not line.startswith("#"):
+            package_filename = line.split("#")[0].rsplit("/", 1)[-1]
+            names.add(parse_package_filename(package_filename)[0])
+    return names
+
+
+def read_lockfile_hash(lockfile=None):
+    """Returns the environment.yml hash the lockfile was written for (if any)."""
+
+    if lockfile is None:
+        lockfile = LOCKFILE
+    if not lockfile.exists():
+        return None
+
+    with lockfile.open("r") as f:
+        first_line = f.readline().strip()
+    if not first_line.startswith(LOCKFILE_HASH_PREFIX):
+        return None
+    return first_line[len(LOCKFILE_HASH_PREFIX) :]
+
+
+def write_lockfile(conda_command, yml_hash, env_name="experiment", lockfile=None):
+    """Writes an explicit lockfile (exact URLs and hashes) of the environment.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        yml_hash (str): The hash of the environment.yml the environment was solved for.
+        env_name (str): The name of the environment to lock.
+        lockfile (Path): The lockfile to write. Defaults to explicit.txt.
+    """
+
+    if lockfile is None:
+        lockfile = LOCKFILE
+
+    print("\nWriting explicit lockfile...")
+
+    if conda_command == "micromamba":
+        command = f"{conda_command} env export -n {env_name} --explicit --md5"
+    else:
+        command = f"{conda_command} list -n {env_name} --explicit --md5"
+
+    output = subprocess.run(command, shell=True, capture_output=True)
+    explicit = output.stdout.decode().replace("\r", "")
+    if output.returncode != 0 or "@EXPLICIT" not in explicit:
+        print("\t... failed to write lockfile")
+        return
+
+    lockfile.parent.mkdir(parents=True, exist_ok=True)
+    with lockfile.open("w") as f:
+        f.write(f"{LOCKFILE_HASH_PREFIX}{yml_hash}\n")
+        f.write(explicit)
+
+
+def lockfile_create_command(conda_command, env_name="experiment", lockfile=None):
+    """Returns the command that creates the environment from the lockfile."""
+
+    if lockfile is None:
+        lockfile = LOCKFILE
+    return f'{conda_command} create -n {env_name} --file "{lockfile.as_posix()}" -y'
@@ -1,82 +1,245 @@
 """Utility functions for logging."""
 
+import contextvars
 import logging
+import os
+import signal
 import subprocess
 import platform
+import shlex
+import shutil
+import sys
+import threading
 import time
+from collections import deque
+from pathlib import Path
 
 from pygments import highlight
 from pygments.formatters import TerminalFormatter
 from pygments.lexers import PythonLexer
 
 from envexp_utils.file import EXP_DIR, ROOT_DIR
+from envexp_utils.interpreter import get_environment_python, get_python_prefix
+from envexp_utils.inventory import write_inventory
+from envexp_utils.report import record_child_usage
 
 # Configure the logging module to write logs to a file
 LOGFILE = ROOT_DIR / "test.log"
-logging.basicConfig(
-    filename=LOGFILE,
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(name)s %(message)s",
-)
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
+
+class LogSink(logging.FileHandler):
+    """Writes the log file, flushing and fsyncing it on close and signaling that.
+
+    Args:
+        filename (Path): The log file.
+        atomic (bool): If True, the log is written to a temporary file next to the
+            log file, which replaces the log file on close. The log file is then
+            never seen half-written (but only updated at the end of the run).
+    """
+
+    def __init__(self, filename, atomic=False):
+        self.target = Path(filename)
+        self.atomic = atomic
+        self.closed = threading.Event()
+        if atomic:
+            filename = self.target.with_name(f"{self.target.name}.tmp")
+        super().__init__(filename, mode="w" if atomic else "a")
+
+    def reset(self):
+        """Truncates the log (e.g. at the start of a run)."""
+
+        self.acquire()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.seek(0)
+            self.stream.truncate()
+        finally:
+            self.release()
+
+    def close(self):
+        """Flushes, fsyncs and closes the log (moving it into place if atomic)."""
+
+        self.acquire()
+        try:
+            if self.stream is not None and not self.stream.closed:
+                self.stream.flush()
+                os.fsync(self.stream.fileno())
+            super().close()
+            if self.atomic and Path(self.baseFilename).exists():
+                os.replace(self.baseFilename, self.target)
+                fsync_directory(self.target.parent)
+        finally:
+            self.release()
+        self.closed.set()
+
+
+def fsync_directory(directory):
+    """Fsyncs a directory, so a rename in it is durable (not supported on Windows)."""
+
+    if platform.system() == "Windows":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+log_sink = LogSink(LOGFILE)
+logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, handlers=[log_sink])
 logger = logging.getLogger(__name__)
+output_logger = logger.getChild("output")
+
+# Configure streaming of subprocess output
+ERROR_TAIL_LINES = 200  # Lines of stderr kept in memory for the raised error
+MAX_LINE_LENGTH = 64 * 1024  # Longer lines are split while streaming
+WAIT_INTERVAL = 0.05  # Seconds between checks whether a command with a timeout exited
+# Child python processes otherwise block-buffer their output into the pipe
+STREAMING_VARIABLES = {"PYTHONUNBUFFERED": "1"}
+
+# Configure how stderr is split out of the log file with --compact-artifacts
+STDERR_DIR = ROOT_DIR / "stderr"
+STDERR_INLINE_BYTES = 4096  # Smaller stderr stays in the log file
+_compact_artifacts = threading.Event()
+_stderr_lock = threading.Lock()
+
+# Processes started by `run_and_log`, killed if the run is cancelled (e.g. Ctrl-C)
+_child_processes = set()
+_child_processes_lock = threading.Lock()
+_cancelled = threading.Event()
+
+class RunError(Exception):
+    """Raised when a command run by `run_and_log` fails.
+
+    Args:
+        output (str): The tail of the command's stderr (e.g. the child's traceback).
+    """
+
+    def __init__(self, output):
+        super().__init__(output)
+        self.output = output
+
+
+def use_atomic_logfile():
+    """Switches to writing the log file atomically (see `LogSink`)."""
+
+    global log_sink
+
+    atomic_sink = LogSink(LOGFILE, atomic=True)
+    atomic_sink.setFormatter(logging.Formatter(LOG_FORMAT))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(atomic_sink)
+    root_logger.removeHandler(log_sink)
+    log_sink.close()
+    log_sink = atomic_sink
+
+
+def use_compact_artifacts():
+    """Splits large stderr out of the log file and logs references to code files."""
+
+    _compact_artifacts.set()
+
 
 def reset_logfile():
-    """Resets the log file."""
-    
-    with open(LOGFILE, "w") as f:
-        pass
+    """Resets the log file (and the stderr split out of it)."""
 
-def log_dependencies(conda_command):
-    """Logs the dependencies of the experiment environment to file."""
+    log_sink.reset()
+    shutil.rmtree(STDERR_DIR, ignore_errors=True)
 
-    def post_process_file(filename):
-        """Removes empty lines from a file."""
 
-        with open(filename, "r") as f:
-            lines = f.readlines()
+def log_code(message, code, path):
+    """Logs code, or only a reference to its (committed) file with compact artifacts.
 
-        with open(filename, "w") as f:
-            for line in lines:
-                if line.strip():  # only write the line if it's not empty
-                    f.write(line)
+    Args:
+        message (str): The message to log before the code.
+        code (str): The code.
+        path (Path): The file the code is read from.
+    """
 
-    mamba_filename = ROOT_DIR / "mamba_list.txt"
-    pip_filename = ROOT_DIR / "pipdeptree.txt"
+    if _compact_artifacts.is_set():
+        relative_path = Path(path).absolute().relative_to(ROOT_DIR).as_posix()
+        logger.info(f"{message} (see {relative_path}, {len(code)} characters)")
+    else:
+        logger.info(f"{message}:\n{code}")
 
-    # Reset the files
-    for filename in [mamba_filename, pip_filename]:
-        with open(filename, "w") as f:
-            pass
 
-    # mamba list > mamba_list.txt
-    with open(mamba_filename, "w") as f:
-        subprocess.run(
-            f"{conda_command} run -n experiment {conda_command} list",
-            shell=True,
-            stdout=f,
-        )
+def split_stderr(command, lines):
+    """Logs the stderr of a command, or writes it to its own file if it is large.
+
+    Returns:
+        Path: The file the stderr was written to, or None if it was logged.
+    """
 
-    # Find python path of experiment environment
-    which_or_where = "where" if platform.system() == "Windows" else "which"
-    result = subprocess.run(
-        f"{conda_command} run -n experiment {which_or_where} python",
-        shell=True,
-        capture_output=True,
+    text = "".join(f"{line}\n" for line in lines)
+    if len(text.encode()) <= STDERR_INLINE_BYTES:
+        for line in lines:
+            output_logger.warning(line)
+        return None
+
+    with _stderr_lock:
+        STDERR_DIR.mkdir(parents=True, exist_ok=True)
+        path = STDERR_DIR / f"{len(list(STDERR_DIR.iterdir())) + 1:03d}.txt"
+        path.write_text(f"$ {command}\n{text}")
+    output_logger.warning(
+        f"stderr ({len(lines)} lines) split out to "
+        f"{path.relative_to(ROOT_DIR).as_posix()}"
     )
-    python_path = result.stdout.decode().strip().split("\r")[0]
+    return path
 
-    # pipdeptree -f > pipdeptree.txt
-    with open(pip_filename, "w") as f:
-        # Run pipdeptree in the envexp environment on the experiment environment
-        subprocess.run(
-            f"{conda_command} run -n envexp pipdeptree --python {python_path} -f",
-            shell=True,
-            stdout=f,
-        )
 
-    # Remove empty lines from the files
-    for filename in [mamba_filename, pip_filename]:
-        post_process_file(filename)
+def close_logfile(timeout=None):
+    """Closes the log file once it is flushed and fsynced to disk.
+
+    Later log records are not written to the log file (e.g. after it was committed).
+
+    Args:
+        timeout (float): Seconds to wait for the log to be closed (e.g. by another
+            thread). If None, waits until it is closed.
+
+    Returns:
+        bool: True if the log file was closed.
+    """
+
+    logging.getLogger().removeHandler(log_sink)
+    log_sink.close()
+    return log_sink.closed.wait(timeout)
+
+def log_dependencies(
+    conda_command, env_name="experiment", output_dir=None, include_pip=True
+):
+    """Logs the dependencies of the experiment environment to file.
+
+    The packages are read from the environment prefix on disk and written to
+    mamba_list.txt, pipdeptree.txt and inventory.json.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        env_name (str): The name of the environment to log the dependencies of.
+        output_dir (Path): The directory to write the dependency logs to. Defaults to
+            the root directory.
+        include_pip (bool): If False, pipdeptree.txt is not written (e.g. since the
+            single-process worker writes it).
+    """
+
+    if output_dir is None:
+        output_dir = ROOT_DIR
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Find the prefix of the experiment environment (resolved once per environment)
+    python_path = get_environment_python(
+        conda_command=conda_command, env_name=env_name
+    )
+    if python_path is None:
+        logger.warning(f"Could not find the {env_name} environment to log.")
+        return
+
+    write_inventory(
+        prefix=get_python_prefix(python_path),
+        output_dir=output_dir,
+        include_pip=include_pip,
+    )
 
 
 def print_code(code):
@@ -84,25 +247,117 @@ def print_code(code):
 
     print(highlight(code, PythonLexer(), TerminalFormatter()))
 
-# Function to close and remove all handlers from the logger
-def close_logger_handlers(logger):
-    for handler in logger.handlers[:]:  # Iterate over a copy of the list
-        handler.close()
-        logger.removeHandler(handler)
 
-def wait_for_log_update(timeout=10):
-    start_time = time.time()
-    initial_mod_time = LOGFILE.stat().st_mtime
-    while time.time() - start_time < timeout:
-        current_mod_time = LOGFILE.stat().st_mtime
-        if current_mod_time != initial_mod_time:
-            return True  # Log file has been updated
-        time.sleep(0.5)  # Wait for half a second before checking again
-    return False  # Timeout reached without detecting an update
+def kill_process_tree(process):
+    """Kills a process started with a shell along with all of its children."""
+
+    if platform.system() == "Windows":
+        subprocess.run(
+            f"taskkill /F /T /PID {process.pid}", shell=True, capture_output=True
+        )
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def wait_for_process(process, timeout=None):
+    """Waits for a process, reaping it with `os.wait4` to record its resource usage.
+
+    The CPU time of the process (and of the children it waited for) is added to the
+    running phases of the run report (see `record_child_usage`).
 
+    Raises:
+        subprocess.TimeoutExpired: If the process is still running after the timeout.
+    """
 
-def run_and_log(command, fail_message=None, pass_message=None):
-    """Runs a command and logs the output."""
+    if not hasattr(os, "wait4"):
+        process.wait(timeout=timeout)
+        return
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        while True:
+            options = 0 if deadline is None else os.WNOHANG
+            pid, status, rusage = os.wait4(process.pid, options)
+            if pid != 0:
+                break
+            if time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            time.sleep(WAIT_INTERVAL)
+    except ChildProcessError:
+        # Already reaped (e.g. by Popen), so its usage is unknown
+        process.wait()
+        return
+    # The process was reaped by wait4, so Popen must not wait for it
+    process.returncode = os.waitstatus_to_exitcode(status)
+    record_child_usage(rusage)
+
+
+def kill_child_processes():
+    """Kills the running commands started by `run_and_log` and refuses new ones."""
+
+    _cancelled.set()
+    with _child_processes_lock:
+        processes = list(_child_processes)
+    for process in processes:
+        kill_process_tree(process)
+
+
+def stream_output(stream, console, level, tail=None, captured=None):
+    """Tees lines from a subprocess stream to the console and log file as they arrive.
+
+    Args:
+        stream (IO[bytes]): The stdout or stderr stream of the subprocess.
+        console (IO[str]): The console stream to print the lines to.
+        level (int): The logging level to log the lines with.
+        tail (deque): If provided, the most recent lines are appended to it.
+        captured (list): If provided, the lines are appended to it instead of being
+            logged (see `split_stderr`).
+    """
+
+    for raw_line in iter(lambda: stream.readline(MAX_LINE_LENGTH), b""):
+        # Only keep the last update of progress bars redrawn with carriage returns
+        segments = raw_line.decode(errors="replace").rstrip("\r\n").split("\r")
+        line = next((segment for segment in reversed(segments) if segment), "")
+        print(line, file=console, flush=True)
+        if captured is None:
+            output_logger.log(level, line)
+        else:
+            captured.append(line)
+        if tail is not None:
+            tail.append(line)
+    stream.close()
+
+
+def quote_argument(argument):
+    """Quotes an argument of a shell command (e.g. 'numpy>=2', so > is no redirect).
+
+    Args:
+        argument (str): The argument to quote.
+    """
+
+    if platform.system() == "Windows":
+        # cmd.exe does not interpret redirects and pipes within double quotes
+        return '"' + argument.replace('"', '\\"') + '"'
+    return shlex.quote(argument)
+
+
+def run_and_log(
+    command, fail_message=None, pass_message=None, timeout=None, env=None
+):
+    """Runs a command and streams its output to the console and log file.
+
+    Args:
+        command (str): The command to run (in a shell from the envexp directory).
+        fail_message (str): The message to log if the command fails.
+        pass_message (str): The message to log if the command succeeds.
+        timeout (float): Seconds after which the command (and its children) are
+            killed and the command fails. If None, the command never times out.
+        env (dict): Environment variables to set for the command (on top of the
+            current environment).
+    """
 
     if fail_message is None:
         fail_message = "Failed!"
@@ -111,20 +366,72 @@ def run_and_log(command, fail_message=None, pass_message=None):
         pass_message = "Passed!"
 
     try:
-        output = subprocess.run(
+        if _cancelled.is_set():
+            raise RuntimeError(f"The run was cancelled before running: {command}")
+        process = subprocess.Popen(
             command,
             shell=True,
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             cwd=EXP_DIR,
+            env={**os.environ, **STREAMING_VARIABLES, **(env or {})},
+            start_new_session=platform.system() != "Windows",
         )
-        if output.returncode != 0:
-            error = output.stderr.decode()
-            error = error.replace("\r\r", "")
-            raise Exception(error)
-        print(output.stdout.decode())
+        with _child_processes_lock:
+            _child_processes.add(process)
+        error_tail = deque(maxlen=ERROR_TAIL_LINES)
+        # With compact artifacts, stderr is logged (or split out) once it is complete
+        captured = [] if _compact_artifacts.is_set() else None
+        # The readers run in a copy of the context, e.g. to buffer a task's output
+        readers = [
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(stream_output, process.stdout, sys.stdout, logging.INFO),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(
+                    stream_output,
+                    process.stderr,
+                    sys.stderr,
+                    logging.WARNING,
+                    error_tail,
+                    captured,
+                ),
+                daemon=True,
+            ),
+        ]
+        for reader in readers:
+            reader.start()
+
+        try:
+            wait_for_process(process, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_tree(process)
+            wait_for_process(process)
+            for reader in readers:
+                reader.join()
+            if captured:
+                split_stderr(command, captured)
+            raise TimeoutError(f"Command timed out after {timeout} seconds: {command}")
+        finally:
+            with _child_processes_lock:
+                _child_processes.discard(process)
+
+        for reader in readers:
+            reader.join()
+        if captured:
+            split_stderr(command, captured)
+        if process.returncode != 0:
+            raise RunError("\n".join(error_tail))
         logger.info(pass_message)
         print(pass_message)
     except Exception as e:
-        logger.exception(fail_message)
+        if isinstance(e, RunError) and _compact_artifacts.is_set():
+            # The stderr is already logged (or split out), so it is not repeated
+            logger.error(fail_message)
+        else:
+            logger.exception(fail_message)
         print(fail_message)
         raise e
\ No newline at end of file
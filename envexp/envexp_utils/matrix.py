@@ -0,0 +1,248 @@
+"""Defines functions for running experiments over a matrix of environment files."""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from envexp_utils.cache import DEFAULT_CACHE_BUDGET_GB, create_cached_environment
+from envexp_utils.environment import hash_environment_file, remove_environment
+from envexp_utils.file import ROOT_DIR
+from envexp_utils.log import logger
+from envexp_utils.report import timed_phase
+from envexp_utils.signature import exception_signature
+from envexp_utils.test import test_code, test_imports
+
+# Configure matrix outputs
+MATRIX_DIR = ROOT_DIR / "matrix"
+MATRIX_RESULTS = ROOT_DIR / "matrix_results.txt"
+DEFAULT_MAX_WORKERS = 4
+
+# Configure result labels
+PASSED = "pass"
+FAILED = "FAIL"
+SKIPPED = "-"
+
+
+def variant_env_name(environment_file):
+    """Returns a unique environment name for an environment file variant."""
+
+    environment_file = Path(environment_file)
+    yml_hash = hash_environment_file(environment_file=environment_file)
+    return f"experiment-{environment_file.stem}-{yml_hash[:8]}"
+
+
+def run_variant(
+    conda_command,
+    environment_file,
+    repo_name=None,
+    use_cache=True,
+    budget_gb=DEFAULT_CACHE_BUDGET_GB,
+    timeout=None,
+    pythonpath=None,
+    offline=False,
+    use_pool=True,
+    test_limits=None,
+):
+    """Creates the environment for a single variant and runs the tests in it.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        environment_file (Path): The environment file variant to test.
+        repo_name (str): The name of the repo to test imports for. If None, testing
+            the repo import is skipped.
+        use_cache (bool): Whether to look up and store environments in the cache.
+        budget_gb (float): The disk budget for all cached environments in GB.
+        timeout (float): Seconds after which a hung import or test step is killed.
+        pythonpath (Path): A directory to add to PYTHONPATH to import the repo from.
+        offline (bool): Whether to build only from the managed package directory.
+        use_pool (bool): Whether to build from the closest base of the warm pool.
+        test_limits (dict): The limits of the user test functions (see `test_code`).
+
+    Returns:
+        dict: The result of each step (environment, imports and tests) and the
+            failure signature of the first failed step.
+    """
+
+    environment_file = Path(environment_file).absolute()
+    with timed_phase(f"variant[{environment_file.name}]"):
+        return _run_variant(
+            conda_command=conda_command,
+            environment_file=environment_file,
+            repo_name=repo_name,
+            use_cache=use_cache,
+            budget_gb=budget_gb,
+            timeout=timeout,
+            pythonpath=pythonpath,
+            offline=offline,
+            use_pool=use_pool,
+            test_limits=test_limits,
+        )
+
+
+def _run_variant(
+    conda_command,
+    environment_file,
+    repo_name,
+    use_cache,
+    budget_gb,
+    timeout,
+    pythonpath,
+    offline,
+    use_pool,
+    test_limits,
+):
+    """Runs a single variant (see `run_variant`)."""
+
+    env_name = variant_env_name(environment_file)
+    result = {
+        "variant": environment_file.name,
+        "env_name": env_name,
+        "environment": SKIPPED,
+        "imports": SKIPPED,
+        "tests": SKIPPED,
+        "signature": SKIPPED,
+    }
+
+    def fail(step, error):
+        """Marks a step as failed (with the signature of the first failure)."""
+
+        result[step] = FAILED
+        if result["signature"] == SKIPPED:
+            result["signature"] = exception_signature(error)["signature"]
+
+    try:
+        try:
+            create_cached_environment(
+                conda_command=conda_command,
+                use_cache=use_cache,
+                budget_gb=budget_gb,
+                env_name=env_name,
+                environment_file=environment_file,
+                # Unique per variant, e.g. for a/environment.yml and b/environment.yml
+                output_dir=MATRIX_DIR / env_name,
+                offline=offline,
+                use_pool=use_pool,
+            )
+            result["environment"] = PASSED
+        except Exception as e:
+            fail("environment", e)
+            return result
+
+        if repo_name is not None:
+            try:
+                test_imports(
+                    conda_command=conda_command,
+                    repo_name=repo_name,
+                    env_name=env_name,
+                    timeout=timeout,
+                    pythonpath=pythonpath,
+                )
+                result["imports"] = PASSED
+            except Exception as e:
+                fail("imports", e)
+
+        try:
+            test_code(
+                conda_command=conda_command,
+                env_name=env_name,
+                timeout=timeout,
+                test_limits=test_limits,
+            )
+            result["tests"] = PASSED
+        except Exception as e:
+            fail("tests", e)
+    finally:
+        # The environment is kept in the cache, so remove the uniquely named copy
+        if use_cache:
+            remove_environment(conda_command=conda_command, env_name=env_name)
+
+    return result
+
+
+def run_matrix(
+    conda_command,
+    environment_files,
+    repo_name=None,
+    max_workers=DEFAULT_MAX_WORKERS,
+    use_cache=True,
+    budget_gb=DEFAULT_CACHE_BUDGET_GB,
+    timeout=None,
+    pythonpath=None,
+    offline=False,
+    use_pool=True,
+    test_limits=None,
+):
+    """Runs the experiment for each environment file variant in a bounded worker pool.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        environment_files (list[Path]): The environment file variants to test.
+        repo_name (str): The name of the repo to test imports for. If None, testing
+            the repo import is skipped.
+        max_workers (int): The maximum number of variants to run concurrently.
+        use_cache (bool): Whether to look up and store environments in the cache.
+        budget_gb (float): The disk budget for all cached environments in GB.
+        timeout (float): Seconds after which a hung import or test step is killed.
+        pythonpath (Path): A directory to add to PYTHONPATH to import the repo from.
+        offline (bool): Whether to build only from the managed package directory.
+        use_pool (bool): Whether to build from the closest base of the warm pool.
+        test_limits (dict): The limits of the user test functions (see `test_code`).
+
+    Returns:
+        list[dict]: The result of each variant (in the order given).
+    """
+
+    print(f"\nRunning matrix of {len(environment_files)} environment variants...")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                run_variant,
+                conda_command=conda_command,
+                environment_file=environment_file,
+                repo_name=repo_name,
+                use_cache=use_cache,
+                budget_gb=budget_gb,
+                timeout=timeout,
+                pythonpath=pythonpath,
+                offline=offline,
+                use_pool=use_pool,
+                test_limits=test_limits,
+            )
+            for environment_file in environment_files
+        ]
+        results = [future.result() for future in futures]
+
+    table = format_matrix_table(results)
+    logger.info(f"Matrix results:\n{table}")
+    print(f"\nMatrix results:\n{table}")
+    MATRIX_RESULTS.write_text(table + "\n")
+
+    return results
+
+
+def matrix_passed(results):
+    """Returns True if every step of every variant passed (or was skipped)."""
+
+    return all(
+        result[step] != FAILED
+        for result in results
+        for step in ("environment", "imports", "tests")
+    )
+
+
+def format_matrix_table(results):
+    """Formats the matrix results as a plain-text pass/fail table."""
+
+    header = ["variant", "environment", "imports", "tests", "signature"]
+    rows = [[result[column] for column in header] for result in results]
+    widths = [
+        max(len(str(row[idx])) for row in [header] + rows) for idx in range(len(header))
+    ]
+
+    lines = []
+    for row in [header] + rows:
+        lines.append(
+            "  ".join(str(cell).ljust(width) for cell, width in zip(row, widths))
+        )
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    return "\n".join(line.rstrip() for line in lines)
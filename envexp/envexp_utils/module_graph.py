@@ -0,0 +1,264 @@
+"""Defines functions for building the import graph of a repo's own modules.
+
+Each module of the repo is a node, with an edge to each module of the repo it
+imports. The transitive closure of a set of entry modules is then the part of the
+repo that is needed to import them (along with the packages that contain them).
+"""
+
+import ast
+import json
+import tokenize
+from pathlib import Path
+
+from envexp_utils.file import ROOT_DIR
+
+# Configure the exported module graph of a run
+MODULE_GRAPH = ROOT_DIR / "module_graph.json"
+
+
+def module_name(relative_path, package):
+    """Returns the dotted name of a module from its path relative to the package.
+
+    Args:
+        relative_path (Path): E.g. 'gui/app.py' or 'gui/__init__.py'.
+        package (str): The name of the repo's package. E.g. 'sleap'.
+    """
+
+    parts = Path(relative_path).with_suffix("").parts
+    if parts and parts[-1] == "__init__":
+        parts = parts[:-1]
+    return ".".join((package, *parts))
+
+
+def is_package_module(module, package):
+    """Returns True if the module is the package or one of its submodules."""
+
+    return module == package or module.startswith(f"{package}.")
+
+
+def extract_module_imports(source, module, is_package, package, filename="<unknown>"):
+    """Extracts the modules a module imports (anywhere in its source).
+
+    Relative imports are resolved against the module, and `from a import b` is
+    recorded as both 'a' and 'a.b' (as b may be a submodule).
+
+    Args:
+        source (str): The Python source code of the module.
+        module (str): The dotted name of the module. E.g. 'sleap.gui.app'.
+        is_package (bool): Whether the module is a package's __init__.py.
+        package (str): The name of the repo's package. E.g. 'sleap'.
+        filename (str): The filename used in syntax error messages.
+
+    Returns:
+        dict: The 'internal' candidate modules of the package and the top-level
+            names of the 'external' modules imported.
+    """
+
+    tree = ast.parse(source, filename=filename)
+    # The package that relative imports are relative to
+    parent = module.split(".") if is_package else module.split(".")[:-1]
+
+    internal, external = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module
+            if node.level:
+                if node.level - 1 >= len(parent):
+                    continue
+                base_parts = parent[: len(parent) - (node.level - 1)]
+                base = ".".join(base_parts + ([node.module] if node.module else []))
+            names = [base] + [
+                f"{base}.{alias.name}" for alias in node.names if alias.name != "*"
+            ]
+        else:
+            continue
+
+        for name in names:
+            if is_package_module(name, package):
+                internal.add(name)
+            else:
+                external.add(name.split(".")[0])
+    return {"internal": sorted(internal), "external": sorted(external)}
+
+
+def scan_module_file(python_file, input_dir, package):
+    """Extracts the imports of a module file (run in a worker process).
+
+    Returns:
+        tuple[dict, str]: The imports (see `extract_module_imports`) and an error
+            message (or None).
+    """
+
+    relative_path = Path(python_file).relative_to(input_dir)
+    try:
+        with tokenize.open(python_file) as infile:
+            source = infile.read()
+        imports = extract_module_imports(
+            source,
+            module=module_name(relative_path, package),
+            is_package=relative_path.name == "__init__.py",
+            package=package,
+            filename=str(python_file),
+        )
+    except (SyntaxError, UnicodeDecodeError, ValueError) as e:
+        return {"internal": [], "external": []}, f"{type(e).__name__}: {e}"
+    return imports, None
+
+
+def resolve_module_graph(package, imports_by_path):
+    """Resolves the candidate imports of each module to the modules of the repo.
+
+    Args:
+        package (str): The name of the repo's package. E.g. 'sleap'.
+        imports_by_path (dict): Mapping of each module's relative (posix) path to its
+            imports (see `extract_module_imports`).
+
+    Returns:
+        dict: Mapping of module name to its 'path', the modules of the repo it
+            'imports' and the 'external' top-level modules it imports.
+    """
+
+    paths = {
+        module_name(relative_path, package): relative_path
+        for relative_path in imports_by_path
+    }
+    graph = {}
+    for module, relative_path in sorted(paths.items()):
+        imports = imports_by_path[relative_path]
+        graph[module] = {
+            "path": relative_path,
+            "imports": sorted(
+                {name for name in imports["internal"] if name in paths} - {module}
+            ),
+            "external": imports["external"],
+        }
+    return graph
+
+
+def parent_modules(module, graph):
+    """Returns the packages (in the graph) that are imported before a module."""
+
+    parts = module.split(".")
+    parents = (".".join(parts[:idx]) for idx in range(1, len(parts)))
+    return [parent for parent in parents if parent in graph]
+
+
+def normalize_entry(entry, package):
+    """Returns the module name of an entry point given as a module or a path.
+
+    Args:
+        entry (str): E.g. 'sleap.gui.app', 'gui.app' or 'gui/app.py'.
+        package (str): The name of the repo's package. E.g. 'sleap'.
+    """
+
+    if entry.endswith(".py") or "/" in entry or "\\" in entry:
+        return module_name(Path(entry.replace("\\", "/")), package)
+    if is_package_module(entry, package):
+        return entry
+    return f"{package}.{entry}"
+
+
+def find_closure(graph, entries):
+    """Finds the modules needed to import the entry modules.
+
+    Args:
+        graph (dict): The module graph (see `resolve_module_graph`).
+        entries (list[str]): The names of the entry modules.
+
+    Returns:
+        list[str]: The sorted names of the modules in the transitive closure.
+    """
+
+    missing = [entry for entry in entries if entry not in graph]
+    if missing:
+        raise ValueError(f"Entry modules {missing} not found in the repo.")
+
+    closure = set()
+    stack = list(entries)
+    while stack:
+        module = stack.pop()
+        if module in closure:
+            continue
+        closure.add(module)
+        stack += graph[module]["imports"] + parent_modules(module, graph)
+    return sorted(closure)
+
+
+def find_library_importers(graph, library):
+    """Finds the modules that import a library directly or through other modules.
+
+    Returns:
+        tuple[set[str], set[str]]: The modules that import the library themselves
+            and the modules that only pull it in through the modules they import.
+    """
+
+    direct = {
+        module for module, node in graph.items() if library in node["external"]
+    }
+    importers = {module: set() for module in graph}
+    for module, node in graph.items():
+        for imported in node["imports"] + parent_modules(module, graph):
+            importers[imported].add(module)
+
+    pulled, stack = set(), list(direct)
+    while stack:
+        for importer in importers[stack.pop()]:
+            if importer not in direct and importer not in pulled:
+                pulled.add(importer)
+                stack.append(importer)
+    return direct, pulled
+
+
+def subgraph(graph, modules):
+    """Returns the part of the graph between the given modules."""
+
+    modules = set(modules)
+    return {
+        module: {
+            **graph[module],
+            "imports": [name for name in graph[module]["imports"] if name in modules],
+        }
+        for module in sorted(modules)
+    }
+
+
+def format_graph_json(graph, package, entries=(), library=None):
+    """Formats the module graph as JSON (with the modules that pull in a library)."""
+
+    data = {"package": package, "entries": list(entries), "modules": graph}
+    if library is not None:
+        direct, pulled = find_library_importers(graph, library)
+        data["library"] = {
+            "name": library,
+            "imported_by": sorted(direct),
+            "pulled_in_by": sorted(pulled),
+        }
+    return json.dumps(data, indent=2)
+
+
+def format_graph_dot(graph, package, entries=(), library=None):
+    """Formats the module graph as a Graphviz DOT digraph.
+
+    Entry modules are drawn bold. If a library is given, the modules that import it
+    are filled red and the modules that pull it in through others orange.
+    """
+
+    direct, pulled = find_library_importers(graph, library) if library else ((), ())
+    lines = [f'digraph "{package}" {{', "  node [shape=box, style=rounded];"]
+    for module in graph:
+        attributes = []
+        if module in entries:
+            attributes.append("penwidth=3")
+        if module in direct:
+            attributes.append('style="rounded,filled", fillcolor="#f4a3a3"')
+        elif module in pulled:
+            attributes.append('style="rounded,filled", fillcolor="#f8d39a"')
+        suffix = f" [{', '.join(attributes)}]" if attributes else ""
+        lines.append(f'  "{module}"{suffix};')
+    for module, node in graph.items():
+        for imported in node["imports"]:
+            lines.append(f'  "{module}" -> "{imported}";')
+    lines.append("}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,240 @@
+"""Defines the managed package directory and local channel for offline builds.
+
+Packages are downloaded (see `prefetch.py`) or extracted by environment builds into
+a package directory managed by envexp, from which a local channel is indexed. Offline
+builds solve against the local channel and never contact the remote channels.
+"""
+
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+import zipfile
+from pathlib import Path
+
+from envexp_utils.file import CACHE_DIR
+
+try:
+    import zstandard
+except ImportError:  # Optional, only needed to index .conda archives not extracted
+    zstandard = None
+
+# Configure the managed package directory and local channel
+PKGS_DIR = CACHE_DIR / "pkgs"
+WHEELS_DIR = CACHE_DIR / "wheels"  # The downloaded pip requirements
+CHANNEL_DIR = CACHE_DIR / "channel"
+OFFLINE_DIR = CACHE_DIR / "offline"
+
+# Local paths in the pip section, e.g. '- -e .' (relative to the environment file)
+LOCAL_REQUIREMENT_PATTERN = re.compile(r"^(\s*- (?:-e )?)(\.[^\s#]*)")
+
+# Keys of a package record that only describe where it was downloaded from
+LOCATION_KEYS = ("url", "channel", "schannel", "fn", "auth", "priority")
+
+
+def offline_variables(offline=True):
+    """Returns the environment variables that point conda at the managed packages.
+
+    Args:
+        offline (bool): Whether to also forbid the solver and installer from
+            contacting any remote channel.
+    """
+
+    variables = {"CONDA_PKGS_DIRS": str(PKGS_DIR)}
+    if offline:
+        # `conda env create` has no --offline flag, but every flavor reads these
+        # (and pip installs the pip section from the prefetched wheels)
+        variables.update(
+            {
+                "CONDA_OFFLINE": "true",
+                "MAMBA_OFFLINE": "true",
+                "PIP_NO_INDEX": "1",
+                "PIP_FIND_LINKS": str(WHEELS_DIR),
+            }
+        )
+    return variables
+
+
+def file_hashes(path):
+    """Returns the md5, sha256 and size of a file."""
+
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest(), Path(path).stat().st_size
+
+
+def read_archive_index(archive):
+    """Reads the info/index.json of a package archive (that was not extracted).
+
+    Returns:
+        dict: The package record, or None if it cannot be read.
+    """
+
+    try:
+        if archive.name.endswith(".tar.bz2"):
+            with tarfile.open(archive, "r:bz2") as tar:
+                return json.load(tar.extractfile("info/index.json"))
+
+        if zstandard is None:
+            return None
+        with zipfile.ZipFile(archive) as conda_zip:
+            info_name = next(
+                name for name in conda_zip.namelist() if name.startswith("info-")
+            )
+            with conda_zip.open(info_name) as info:
+                reader = zstandard.ZstdDecompressor().stream_reader(info)
+                with tarfile.open(fileobj=io.BytesIO(reader.read())) as tar:
+                    return json.load(tar.extractfile("info/index.json"))
+    except (OSError, KeyError, StopIteration, tarfile.TarError, zipfile.BadZipFile):
+        return None
+
+
+def read_package_records(pkgs_dir=None):
+    """Reads the records of the package archives in the managed package directory.
+
+    Records are read from the `info/repodata_record.json` of extracted packages, or
+    else from the `info/index.json` inside the archive.
+
+    Returns:
+        dict: Mapping of archive path to package record.
+    """
+
+    if pkgs_dir is None:
+        pkgs_dir = PKGS_DIR
+
+    records = {}
+    archives = [*pkgs_dir.glob("*.conda"), *pkgs_dir.glob("*.tar.bz2")]
+    for archive in sorted(archives):
+        extracted = pkgs_dir / archive.name.rsplit(".conda", 1)[0].rsplit(".tar", 1)[0]
+        record_file = extracted / "info" / "repodata_record.json"
+        if record_file.exists():
+            record = json.loads(record_file.read_text())
+        else:
+            record = read_archive_index(archive)
+            if record is None:
+                print(f"\t... skipping {archive.name} (cannot read its index)")
+                continue
+            md5, sha256, size = file_hashes(archive)
+            record.update({"md5": md5, "sha256": sha256, "size": size})
+
+        for key in LOCATION_KEYS:
+            record.pop(key, None)
+        records[archive] = record
+    return records
+
+
+def link_or_copy(src, dst):
+    """Hardlinks a file (if it is not already there), falling back to a copy."""
+
+    if dst.exists():
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def empty_repodata(subdir):
+    """Returns the repodata.json contents of a channel subdirectory without packages."""
+
+    return {
+        "info": {"subdir": subdir},
+        "packages": {},
+        "packages.conda": {},
+        "repodata_version": 1,
+    }
+
+
+def index_local_channel(pkgs_dir=None, channel_dir=None):
+    """Indexes the managed package archives into a local channel.
+
+    Writes `<subdir>/repodata.json` (and links the archives) for each platform
+    subdirectory, including an (empty) noarch subdirectory that conda requires.
+
+    Returns:
+        int: The number of indexed packages.
+    """
+
+    if channel_dir is None:
+        channel_dir = CHANNEL_DIR
+
+    print("\nIndexing local channel...")
+    repodata = {}
+    for archive, record in read_package_records(pkgs_dir).items():
+        subdir = record.get("subdir", "noarch")
+        key = "packages.conda" if archive.name.endswith(".conda") else "packages"
+        subdir_repodata = repodata.setdefault(subdir, empty_repodata(subdir))
+        subdir_repodata[key][archive.name] = record
+        (channel_dir / subdir).mkdir(parents=True, exist_ok=True)
+        link_or_copy(archive, channel_dir / subdir / archive.name)
+
+    repodata.setdefault("noarch", empty_repodata("noarch"))
+    for subdir, subdir_repodata in repodata.items():
+        (channel_dir / subdir).mkdir(parents=True, exist_ok=True)
+        (channel_dir / subdir / "repodata.json").write_text(
+            json.dumps(subdir_repodata, indent=1, sort_keys=True)
+        )
+
+    count = sum(
+        len(data["packages"]) + len(data["packages.conda"])
+        for data in repodata.values()
+    )
+    print(f"\t... indexed {count} packages into {channel_dir}")
+    return count
+
+
+def offline_environment_file(environment_file, channel_dir=None):
+    """Writes a copy of the environment file that only uses the local channel.
+
+    Local paths in the pip section are made absolute, since the copy is written to
+    a different directory.
+
+    Args:
+        environment_file (Path): The environment file to rewrite.
+        channel_dir (Path): The local channel. Defaults to the managed channel.
+
+    Returns:
+        Path: The rewritten environment file.
+    """
+
+    if channel_dir is None:
+        channel_dir = CHANNEL_DIR
+
+    environment_dir = Path(environment_file).absolute().parent
+    channels = ["channels:", f"  - {channel_dir.as_uri()}", "  - nodefaults"]
+    lines = []
+    in_channels = has_channels = False
+    for line in Path(environment_file).read_text().splitlines():
+        line = LOCAL_REQUIREMENT_PATTERN.sub(
+            lambda match: match[1] + (environment_dir / match[2]).resolve().as_posix(),
+            line,
+        )
+        if in_channels and (line.startswith((" ", "-")) or not line.strip()):
+            continue
+        in_channels = line.startswith("channels:")
+        if in_channels:
+            has_channels = True
+            lines += channels
+            continue
+        lines.append(line)
+    if not has_channels:
+        # Without a channels block, the default (remote) channels would be solved
+        # against, so the local channel is added before the dependencies
+        position = next(
+            (idx for idx, line in enumerate(lines) if line.startswith("dependencies:")),
+            len(lines),
+        )
+        lines[position:position] = channels
+    content = "\n".join(lines) + "\n"
+
+    content_hash = hashlib.sha256(content.encode()).hexdigest()[:8]
+    offline_file = OFFLINE_DIR / f"{Path(environment_file).stem}-{content_hash}.yml"
+    OFFLINE_DIR.mkdir(parents=True, exist_ok=True)
+    offline_file.write_text(content)
+    return offline_file
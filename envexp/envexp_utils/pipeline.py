@@ -0,0 +1,185 @@
+"""Defines a dependency graph of run phases that are run concurrently with asyncio.
+
+Each task runs in a worker thread as soon as the tasks it depends on have passed. The
+output of a task (its prints and log records) is buffered and written in the order
+the tasks were declared, so the console and test.log read as if the tasks ran one
+after another. The earliest task that has not finished yet streams its output live.
+"""
+
+import asyncio
+import contextvars
+import logging
+import sys
+import threading
+from functools import partial
+
+from envexp_utils.log import kill_child_processes
+from envexp_utils.report import timed_phase
+
+# The output buffer of the task running in the current context (if any)
+_task_output = contextvars.ContextVar("task_output", default=None)
+
+
+class TaskOutput:
+    """Buffers the output of a task until the output of all earlier tasks is written.
+
+    Args:
+        streams (dict): The real 'stdout' and 'stderr' streams to write to.
+    """
+
+    def __init__(self, streams):
+        self.streams = streams
+        self.entries = []
+        self.live = False
+        self.lock = threading.Lock()
+
+    def buffer(self, kind, item):
+        """Buffers a write ('stdout' or 'stderr') or a ('log', (handler, record)).
+
+        Returns:
+            bool: False if the task streams live, so the item was not buffered.
+        """
+
+        with self.lock:
+            if not self.live:
+                self.entries.append((kind, item))
+            return not self.live
+
+    def go_live(self):
+        """Writes the buffered output and streams all further output live."""
+
+        with self.lock:
+            for kind, item in self.entries:
+                if kind == "log":
+                    handler, record = item
+                    handler.handle(record)
+                else:
+                    self.streams[kind].write(item)
+            for stream in self.streams.values():
+                stream.flush()
+            self.entries.clear()
+            self.live = True
+
+
+class TaskStream:
+    """Stands in for sys.stdout (or sys.stderr), buffering the writes of tasks.
+
+    Args:
+        kind (str): 'stdout' or 'stderr'.
+        stream (IO[str]): The real stream.
+    """
+
+    def __init__(self, kind, stream):
+        self.kind = kind
+        self.stream = stream
+
+    def write(self, text):
+        output = _task_output.get()
+        if output is None or not output.buffer(self.kind, text):
+            return self.stream.write(text)
+        return len(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def buffer_log_record(handler, record):
+    """Logging filter that buffers the records of tasks (returns False if buffered)."""
+
+    output = _task_output.get()
+    return output is None or not output.buffer("log", (handler, record))
+
+
+def run_task(name, function, results):
+    """Runs the function of a task as a timed phase of the run report."""
+
+    with timed_phase(name):
+        return function(results)
+
+
+async def run_tasks(tasks, streams):
+    """Runs a dependency graph of tasks (see `run_pipeline`)."""
+
+    loop = asyncio.get_running_loop()
+    outputs = {name: TaskOutput(streams) for name in tasks}
+    results, errors = {}, {}
+
+    async def run(name):
+        dependencies, function = tasks[name]
+        for dependency in dependencies:
+            await futures[dependency]
+
+        context = contextvars.copy_context()
+        context.run(_task_output.set, outputs[name])
+        if not all(dependency in results for dependency in dependencies):
+            context.run(print, f"\nSkipping {name} (a task it depends on failed)...")
+            return
+        try:
+            results[name] = await loop.run_in_executor(
+                None, context.run, run_task, name, function, results
+            )
+        except Exception as e:
+            errors[name] = e
+
+    futures = {}
+    for name in tasks:
+        futures[name] = asyncio.ensure_future(run(name))
+
+    try:
+        for name in tasks:
+            outputs[name].go_live()
+            await futures[name]
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        # The children run in their own sessions, so they did not get the Ctrl-C
+        kill_child_processes()
+        for name in tasks:
+            outputs[name].go_live()
+        raise
+
+    for name in tasks:
+        if name in errors:
+            raise errors[name]
+    return results
+
+
+def run_pipeline(tasks):
+    """Runs a dependency graph of tasks concurrently.
+
+    Tasks whose dependencies failed are skipped, the others still run. Ctrl-C kills
+    the commands started by running tasks (see `run_and_log`) and stops starting new
+    ones.
+
+    Args:
+        tasks (dict): Mapping of task name to a tuple of the names of the tasks it
+            depends on (which must be declared before it) and a function that takes
+            the dict of results of the tasks that have passed.
+
+    Returns:
+        dict: Mapping of task name to the result of its function.
+
+    Raises:
+        Exception: The error of the first failed task (in the declared order).
+    """
+
+    declared = set()
+    for name, (dependencies, _) in tasks.items():
+        undeclared = set(dependencies) - declared
+        if undeclared:
+            raise ValueError(f"Task {name} depends on undeclared tasks {undeclared}.")
+        declared.add(name)
+
+    streams = {"stdout": sys.stdout, "stderr": sys.stderr}
+    filters = [
+        (handler, partial(buffer_log_record, handler))
+        for handler in logging.getLogger().handlers
+    ]
+    sys.stdout = TaskStream("stdout", streams["stdout"])
+    sys.stderr = TaskStream("stderr", streams["stderr"])
+    for handler, log_filter in filters:
+        handler.addFilter(log_filter)
+    try:
+        return asyncio.run(run_tasks(tasks, streams))
+    finally:
+        sys.stdout, sys.stderr = streams["stdout"], streams["stderr"]
+        for handler, log_filter in filters:
+            handler.removeFilter(log_filter)
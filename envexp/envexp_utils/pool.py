@@ -0,0 +1,269 @@
+"""Defines a warm pool of pre-built base environments to build experiments from.
+
+Each base is built from a definition in pool/*.yml (e.g. python, numpy and Qt)
+into the pool directory. An experiment environment is then cloned from the base whose
+packages are most similar to the ones it needs, and only the delta is installed.
+Stale bases are rebuilt by a background process after a run, when envexp is idle.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from envexp_utils.environment import hash_environment_file, read_conda_dependencies
+from envexp_utils.file import CACHE_DIR, EXP_DIR, ROOT_DIR
+from envexp_utils.inventory import read_conda_records, requirement_name
+from envexp_utils.lockfile import read_lockfile_package_names
+
+# Configure the pool of base environments
+POOL_DEFINITIONS_DIR = ROOT_DIR / "pool"
+POOL_DIR = CACHE_DIR / "pool"
+POOL_INDEX = POOL_DIR / "index.json"
+POOL_LOCK = POOL_DIR / "refresh.lock"
+POOL_REFRESH_LOG = POOL_DIR / "refresh.log"
+POOL_MAX_AGE = 7 * 24 * 3600  # Seconds after which a base is rebuilt (new releases)
+POOL_LOCK_TIMEOUT = 6 * 3600  # Seconds after which a refresh lock is considered stale
+MIN_BASE_SIMILARITY = 0.5  # Jaccard similarity below which no base is used
+
+
+def load_pool_index():
+    """Loads the pool index mapping base names to their built prefixes."""
+
+    if not POOL_INDEX.exists():
+        return {}
+    try:
+        return json.loads(POOL_INDEX.read_text())
+    except json.JSONDecodeError:
+        return {}
+
+
+def save_pool_index(index):
+    """Saves the pool index."""
+
+    POOL_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = POOL_INDEX.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(index, indent=2))
+    os.replace(tmp_path, POOL_INDEX)
+
+
+def list_pool_definitions():
+    """Returns a mapping of base name to its definition file in the pool directory."""
+
+    return {
+        definition.stem: definition
+        for definition in sorted(POOL_DEFINITIONS_DIR.glob("*.yml"))
+    }
+
+
+def find_stale_bases(index=None):
+    """Returns the names of the bases that are missing, outdated or too old."""
+
+    if index is None:
+        index = load_pool_index()
+
+    stale = []
+    for name, definition in list_pool_definitions().items():
+        entry = index.get(name)
+        if (
+            entry is None
+            or not Path(entry["prefix"]).exists()
+            or entry["yml_hash"] != hash_environment_file(environment_file=definition)
+            or time.time() - entry["built"] > POOL_MAX_AGE
+        ):
+            stale.append(name)
+    return stale
+
+
+def package_similarity(packages_a, packages_b):
+    """Returns the Jaccard similarity of two sets of package names."""
+
+    if not packages_a and not packages_b:
+        return 0.0
+    return len(packages_a & packages_b) / len(packages_a | packages_b)
+
+
+def find_closest_base(environment_file, lockfile=None):
+    """Finds the base environment most similar to the one an environment file needs.
+
+    The needed packages are taken from the explicit lockfile (even if it is outdated,
+    it is the closest resolved package list there is) and the environment file's
+    own conda dependencies.
+
+    Args:
+        environment_file (Path): The environment file to build.
+        lockfile (Path): The explicit lockfile of the environment file (if any).
+
+    Returns:
+        str: The prefix of the closest base, or None if no base is similar enough.
+    """
+
+    _, specs = read_conda_dependencies(environment_file)
+    packages = read_lockfile_package_names(lockfile)
+    for spec in specs:
+        name = requirement_name(spec.rsplit("::", 1)[-1])
+        if name is not None:
+            packages.add(name.lower())
+
+    index = load_pool_index()
+    closest, best_similarity = None, MIN_BASE_SIMILARITY
+    for name, entry in index.items():
+        if not Path(entry["prefix"]).exists():
+            continue
+        similarity = package_similarity(packages, set(entry["packages"]))
+        if similarity >= best_similarity:
+            closest, best_similarity = name, similarity
+    if closest is None:
+        return None
+
+    print(f"\t... using pool base {closest} (similarity {best_similarity:.2f})")
+    return index[closest]["prefix"]
+
+
+def build_pool_base(conda_command, name, definition):
+    """Builds a base environment into a new prefix (the previous one stays usable).
+
+    Returns:
+        dict: The pool index entry of the base, or None if the build failed.
+    """
+
+    yml_hash = hash_environment_file(environment_file=definition)
+    prefix = POOL_DIR / f"{name}-{yml_hash[:8]}-{int(time.time())}"
+    print(f"\nBuilding pool base {name} [{prefix}]...")
+
+    command = (
+        f"{conda_command} env create -p {prefix.as_posix()} "
+        f"-f {Path(definition).as_posix()}"
+    )
+    if conda_command == "micromamba":
+        command += " -y"
+    output = subprocess.run(command, shell=True)
+    if output.returncode != 0:
+        print(f"\t... failed to build pool base {name}")
+        shutil.rmtree(prefix, ignore_errors=True)
+        return None
+
+    records, _ = read_conda_records(prefix)
+    return {
+        "prefix": prefix.as_posix(),
+        "yml_hash": yml_hash,
+        "packages": sorted(record["name"] for record in records),
+        "built": time.time(),
+    }
+
+
+def acquire_refresh_lock():
+    """Takes the refresh lock, unless another (recent) refresh holds it.
+
+    Returns:
+        bool: True if the lock was taken.
+    """
+
+    POOL_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        if time.time() - POOL_LOCK.stat().st_mtime > POOL_LOCK_TIMEOUT:
+            POOL_LOCK.unlink()
+    except FileNotFoundError:
+        pass
+
+    try:
+        fd = os.open(POOL_LOCK, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+    return True
+
+
+def refresh_pool(conda_command):
+    """(Re)builds the stale bases of the pool and removes retired ones.
+
+    A base is swapped in the index only after its new prefix was built, so
+    experiments can keep cloning the previous prefix in the meantime. Prefixes that
+    are no longer in the index are removed on the next refresh.
+    """
+
+    print("\nRefreshing pool of base environments...")
+    if not acquire_refresh_lock():
+        print("\t... another refresh is running")
+        return
+
+    try:
+        index = load_pool_index()
+        definitions = list_pool_definitions()
+
+        # Remove the prefixes of bases that were replaced or whose definition is gone
+        index = {name: entry for name, entry in index.items() if name in definitions}
+        save_pool_index(index)
+        in_use = {Path(entry["prefix"]).name for entry in index.values()}
+        for prefix in POOL_DIR.iterdir():
+            if prefix.is_dir() and prefix.name not in in_use:
+                print(f"\t... removing retired base [{prefix}]")
+                shutil.rmtree(prefix, ignore_errors=True)
+
+        for name in find_stale_bases(index):
+            entry = build_pool_base(conda_command, name, definitions[name])
+            if entry is not None:
+                index[name] = entry
+                save_pool_index(index)
+    finally:
+        POOL_LOCK.unlink(missing_ok=True)
+
+
+def start_background_refresh():
+    """Refreshes the pool in a detached, low priority process if any base is stale.
+
+    Returns:
+        bool: True if a refresh was started.
+    """
+
+    if not find_stale_bases() or POOL_LOCK.exists():
+        return False
+
+    print("\nRefreshing pool of base environments in the background...")
+    POOL_DIR.mkdir(parents=True, exist_ok=True)
+    command = [sys.executable, (EXP_DIR / "test_env.py").as_posix(), "pool", "refresh"]
+    if os.name == "nt":
+        kwargs = dict(
+            creationflags=subprocess.DETACHED_PROCESS
+            | subprocess.IDLE_PRIORITY_CLASS
+        )
+    else:
+        # Not a preexec_fn calling os.nice, which is unsafe while threads are running
+        if shutil.which("nice") is not None:
+            command = ["nice", "-n", "19", *command]
+        kwargs = dict(start_new_session=True)
+    with POOL_REFRESH_LOG.open("a") as log:
+        subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            cwd=EXP_DIR,
+            **kwargs,
+        )
+    print(f"\t... logging to {POOL_REFRESH_LOG}")
+    return True
+
+
+def show_pool():
+    """Prints the bases of the pool and whether they are stale."""
+
+    index = load_pool_index()
+    stale = find_stale_bases(index)
+    definitions = list_pool_definitions()
+    print(f"\nPool of base environments ({POOL_DEFINITIONS_DIR}):")
+    if not definitions:
+        print("\t... no base definitions")
+    for name in definitions:
+        entry = index.get(name)
+        built = "never built"
+        if entry is not None:
+            built = (
+                f"{len(entry['packages'])} packages, built "
+                f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['built']))}"
+            )
+        print(f"\t{name}: {built}{' (stale)' if name in stale else ''}")
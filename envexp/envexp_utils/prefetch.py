@@ -0,0 +1,238 @@
+"""Defines functions for downloading the packages of an environment ahead of time."""
+
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from envexp_utils.environment import (
+    hash_environment_file,
+    read_conda_dependencies,
+    read_pip_requirements,
+)
+from envexp_utils.executable import supports
+from envexp_utils.file import EXP_DIR
+from envexp_utils.lockfile import (
+    LOCKFILE,
+    parse_package_filename,
+    read_lockfile_hash,
+)
+from envexp_utils.offline import (
+    PKGS_DIR,
+    WHEELS_DIR,
+    index_local_channel,
+    offline_variables,
+)
+
+# Configure prefetching
+DEFAULT_PREFETCH_WORKERS = 8
+DOWNLOAD_TIMEOUT = 60  # Seconds without data after which a download fails
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+_URLS_LOCK = threading.Lock()
+
+
+def read_explicit_urls(lockfile):
+    """Returns the (url, md5) of each package in an explicit lockfile."""
+
+    packages = []
+    for line in Path(lockfile).read_text().splitlines():
+        line = line.strip()
+        if "://" not in line or line.startswith("#"):
+            continue
+        url, _, md5 = line.partition("#")
+        packages.append((url, md5 or None))
+    return packages
+
+
+def solve_package_urls(conda_command, environment_file):
+    """Solves the environment file (without creating it) for the packages to fetch.
+
+    Only packages that are not in the managed package directory yet are returned.
+
+    Returns:
+        list[tuple[str, str]]: The url and md5 of each package to fetch.
+    """
+
+    if not supports(conda_command, "dry_run_json"):
+        raise Exception(
+            f"{conda_command} cannot solve without creating (--dry-run --json)."
+        )
+
+    channels, specs = read_conda_dependencies(environment_file)
+    command = f"{conda_command} create -n envexp-prefetch --dry-run --json -y"
+    command += " --override-channels"
+    command += "".join(f' -c "{channel}"' for channel in channels)
+    command += "".join(f' "{spec}"' for spec in specs)
+    output = subprocess.run(
+        command,
+        shell=True,
+        capture_output=True,
+        env={**os.environ, **offline_variables(offline=False)},
+    )
+    try:
+        actions = json.loads(output.stdout.decode()).get("actions", {})
+    except json.JSONDecodeError:
+        error = output.stderr.decode(errors="replace")
+        raise Exception(f"Failed to solve {environment_file}:\n{error}")
+    return [(record["url"], record.get("md5")) for record in actions.get("FETCH", [])]
+
+
+def download_package(url, md5=None, pkgs_dir=None):
+    """Downloads a package archive into the managed package directory.
+
+    The archive is downloaded to a temporary file and only moved into place once
+    its md5 matches (if given).
+
+    Returns:
+        bool: True if the package was downloaded, False if it was already there.
+    """
+
+    if pkgs_dir is None:
+        pkgs_dir = PKGS_DIR
+
+    archive = pkgs_dir / url.rsplit("/", 1)[-1]
+    if archive.exists():
+        return False
+
+    partial = archive.with_name(archive.name + ".part")
+    hasher = hashlib.md5()
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+        with partial.open("wb") as f:
+            for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+                f.write(chunk)
+    if md5 is not None and hasher.hexdigest() != md5:
+        partial.unlink()
+        raise ValueError(f"md5 mismatch for {url}: {hasher.hexdigest()} != {md5}")
+    partial.replace(archive)
+
+    # conda looks up the channel of cached archives in urls.txt
+    with _URLS_LOCK:
+        with (pkgs_dir / "urls.txt").open("a") as f:
+            f.write(f"{url}\n")
+    return True
+
+
+def find_python_version(packages):
+    """Returns the 'major.minor' python version of the packages to fetch (if any)."""
+
+    for url, _ in packages:
+        name, version, _ = parse_package_filename(url.rsplit("/", 1)[-1])
+        if name == "python":
+            return ".".join(version.split(".")[:2])
+    return None
+
+
+def download_pip_requirements(environment_file, python_version=None, wheels_dir=None):
+    """Downloads the pip section's requirements (and their dependencies) with pip.
+
+    If the environment's python differs from envexp's, only wheels for its version
+    are downloaded, and local requirements (e.g. '-e .') are skipped, as pip cannot
+    build them for another python.
+
+    Returns:
+        int: The number of downloaded files.
+    """
+
+    if wheels_dir is None:
+        wheels_dir = WHEELS_DIR
+
+    requirements = read_pip_requirements(environment_file)
+    if not requirements:
+        return 0
+
+    print(f"\nDownloading {len(requirements)} pip requirements...")
+    command = [sys.executable, "-m", "pip", "download", "--dest", str(wheels_dir)]
+    cross_version = python_version not in (
+        None,
+        ".".join(platform.python_version_tuple()[:2]),
+    )
+    if cross_version:
+        command += ["--python-version", python_version, "--only-binary", ":all:"]
+
+    environment_dir = Path(environment_file).absolute().parent
+    for requirement in requirements:
+        editable = requirement.startswith("-e ")
+        target = requirement[3:].strip() if editable else requirement
+        if target.startswith("."):
+            if cross_version:
+                print(f"\t... skipping local requirement {requirement}")
+                continue
+            # The local project is downloaded for its dependencies
+            target = (environment_dir / target).resolve().as_posix()
+        command.append(target)
+
+    wheels_dir.mkdir(parents=True, exist_ok=True)
+    before = set(wheels_dir.iterdir())
+    output = subprocess.run(command, capture_output=True)
+    if output.returncode != 0:
+        error = output.stderr.decode(errors="replace")
+        raise Exception(f"Failed to download the pip requirements:\n{error}")
+    return len(set(wheels_dir.iterdir()) - before)
+
+
+def prefetch_environment(
+    conda_command,
+    environment_file=None,
+    lockfile=None,
+    max_workers=DEFAULT_PREFETCH_WORKERS,
+):
+    """Downloads every package an environment file needs into the managed packages.
+
+    The packages are taken from the explicit lockfile if it was written for the
+    environment file, otherwise the environment file is solved (without creating
+    it). Afterwards, the local channel is reindexed for offline builds. The pip
+    section is downloaded with `pip download` into the managed wheels directory.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        environment_file (Path): The environment file to prefetch the packages of.
+            Defaults to envexp/environment.yml.
+        lockfile (Path): The explicit lockfile of the environment file. Defaults to
+            explicit.txt.
+        max_workers (int): The maximum number of concurrent downloads.
+
+    Returns:
+        int: The number of downloaded packages.
+    """
+
+    if environment_file is None:
+        environment_file = EXP_DIR / "environment.yml"
+    if lockfile is None:
+        lockfile = LOCKFILE
+
+    print(f"\nPrefetching packages of {environment_file}...")
+    PKGS_DIR.mkdir(parents=True, exist_ok=True)
+
+    yml_hash = hash_environment_file(environment_file=environment_file)
+    if read_lockfile_hash(lockfile) == yml_hash:
+        print("\t... using explicit lockfile")
+        packages = read_explicit_urls(lockfile)
+    else:
+        packages = solve_package_urls(conda_command, environment_file)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_package, url=url, md5=md5)
+            for url, md5 in packages
+        ]
+        downloaded = sum(future.result() for future in futures)
+
+    print(
+        f"\t... prefetched {downloaded} packages ({len(packages)} needed) to {PKGS_DIR}"
+    )
+    index_local_channel()
+
+    wheels = download_pip_requirements(
+        environment_file, python_version=find_python_version(packages)
+    )
+    if wheels:
+        print(f"\t... prefetched {wheels} pip packages to {WHEELS_DIR}")
+    return downloaded + wheels
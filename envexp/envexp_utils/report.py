@@ -0,0 +1,128 @@
+"""Defines per-phase timing instrumentation and the machine-readable run report."""
+
+import json
+import platform
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from envexp_utils.file import ROOT_DIR
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Configure the run report
+RUN_REPORT = ROOT_DIR / "run_report.json"
+RUN_REPORT_VERSION = 1
+
+_report = {"phases": []}
+_report_lock = threading.Lock()
+_phase_stack = threading.local()
+
+
+def reset_run_report(**metadata):
+    """Starts a new run report with the given metadata (e.g. the CLI arguments)."""
+
+    with _report_lock:
+        _report.clear()
+        _report.update(
+            {
+                "version": RUN_REPORT_VERSION,
+                "started": datetime.now().isoformat(timespec="seconds"),
+                "platform": f"{platform.system()}-{platform.machine()}",
+                "metadata": metadata,
+                "phases": [],
+            }
+        )
+
+
+def add_to_report(key, value):
+    """Adds a top-level entry to the run report."""
+
+    with _report_lock:
+        _report[key] = value
+
+
+def record_child_usage(rusage):
+    """Adds the CPU time and peak RSS of a terminated child to the running phases.
+
+    Called with the resource usage of each command reaped by `run_and_log` (see
+    `wait_for_process`), so a phase only counts the commands of its own thread, even
+    while other phases run concurrently.
+
+    Args:
+        rusage (resource.struct_rusage): The resource usage from `os.wait4`.
+    """
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1024**2 if platform.system() == "Darwin" else 1024
+    for usage in getattr(_phase_stack, "usages", []):
+        usage["children_cpu_s"] += rusage.ru_utime + rusage.ru_stime
+        usage["children_peak_rss_mb"] = max(
+            usage["children_peak_rss_mb"], rusage.ru_maxrss / scale
+        )
+
+
+@contextmanager
+def timed_phase(name):
+    """Records the wall time, CPU time and child peak RSS of a phase of the run.
+
+    Phases can be nested, in which case the name is prefixed by the enclosing
+    phases, e.g. 'create_environment/log_dependencies'. The CPU time is that of the
+    phase's thread and the child CPU time that of the commands it ran with
+    `run_and_log`, so phases that run concurrently do not count each other's.
+
+    Args:
+        name (str): The name of the phase.
+    """
+
+    stack = getattr(_phase_stack, "names", None)
+    if stack is None:
+        stack = _phase_stack.names = []
+        _phase_stack.usages = []
+    stack.append(name)
+    full_name = "/".join(stack)
+    usage = {"children_cpu_s": 0.0, "children_peak_rss_mb": 0.0}
+    _phase_stack.usages.append(usage)
+
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    status = "passed"
+    try:
+        yield
+    except BaseException:
+        status = "failed"
+        raise
+    finally:
+        stack.pop()
+        _phase_stack.usages.pop()
+        phase = {
+            "name": full_name,
+            "status": status,
+            "wall_s": round(time.perf_counter() - start_wall, 3),
+            "cpu_s": round(time.thread_time() - start_cpu, 3),
+            # Child CPU time and peak RSS are only accounted for on POSIX systems
+            "children_cpu_s": None,
+            "children_peak_rss_mb": None,
+        }
+        if resource is not None:
+            phase["children_cpu_s"] = round(usage["children_cpu_s"], 3)
+            phase["children_peak_rss_mb"] = round(usage["children_peak_rss_mb"], 1)
+        with _report_lock:
+            _report.setdefault("phases", []).append(phase)
+
+
+def write_run_report(status):
+    """Writes the run report to run_report.json.
+
+    Args:
+        status (str): The overall status of the run (i.e. 'passed' or 'failed').
+    """
+
+    with _report_lock:
+        _report["status"] = status
+        _report["finished"] = datetime.now().isoformat(timespec="seconds")
+        RUN_REPORT.write_text(json.dumps(_report, indent=2) + "\n")
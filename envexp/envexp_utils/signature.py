@@ -0,0 +1,159 @@
+"""Defines functions for reducing failure output to a normalized, hashable signature.
+
+Two failures have the same signature if they raise the same exception type from the
+same innermost frames (ignoring paths and line numbers) for the same failing import,
+so the same failure can be recognized across runs, environments and machines.
+"""
+
+import hashlib
+import json
+import re
+import traceback
+
+# Configure failure signatures
+SIGNATURE_FRAMES = 3  # The number of innermost frames that are part of a signature
+SIGNATURE_LENGTH = 12  # The number of hex digits of the signature hash
+
+FRAME_PATTERN = re.compile(r'^\s*File "(?P<path>[^"]+)", line \d+, in (?P<name>\S+)')
+EXCEPTION_PATTERN = re.compile(
+    r"^(?P<type>(?:[A-Za-z_][\w.]*)?"
+    r"(?:Error|Exception|Exit|Interrupt|Warning|Failure))"
+    r"(?::\s*(?P<message>.*))?$"
+)
+IMPORT_PATTERNS = [
+    re.compile(r"No module named '(?P<module>[^']+)'"),
+    re.compile(r"cannot import name '(?P<name>[^']+)' from '(?P<module>[^']+)'"),
+    re.compile(r"DLL load failed while importing (?P<module>\w+)"),
+]
+# Variable parts of messages, e.g. addresses, paths, quoted values and numbers
+VOLATILE_PATTERNS = [
+    (re.compile(r"0x[0-9a-fA-F]+"), "0x?"),
+    (re.compile(r"(?:[A-Za-z]:)?[\\/][^\s'\"]*"), "<path>"),
+    (re.compile(r"\d+"), "N"),
+]
+
+
+def normalize_frame_path(path):
+    """Strips a frame path down to the path within its package (or the file name)."""
+
+    parts = re.split(r"[\\/]", path)
+    if "site-packages" in parts:
+        return "/".join(parts[len(parts) - parts[::-1].index("site-packages") :])
+    return parts[-1]
+
+
+def normalize_message(message):
+    """Replaces the variable parts of an exception message with placeholders."""
+
+    for pattern, placeholder in VOLATILE_PATTERNS:
+        message = pattern.sub(placeholder, message)
+    return message.strip()
+
+
+def find_failing_import(message):
+    """Returns the module (or name) that failed to import, if any."""
+
+    for pattern in IMPORT_PATTERNS:
+        match = pattern.search(message)
+        if match is not None:
+            groups = match.groupdict()
+            if groups.get("name"):
+                return f"{groups['module']}.{groups['name']}"
+            return groups["module"]
+    return None
+
+
+def parse_traceback(output):
+    """Parses the innermost frames and the exception of the last traceback in output.
+
+    Args:
+        output (str): The (stderr) output of a failed command.
+
+    Returns:
+        dict: The 'frames' (path and function name, innermost last), the exception
+            'type' and 'message', or None if the output has no exception line.
+    """
+
+    lines = output.splitlines()
+    start = 0
+    for idx, line in enumerate(lines):
+        if line.startswith("Traceback (most recent call last):"):
+            start = idx
+
+    frames = []
+    exception = None
+    for line in lines[start:]:
+        frame = FRAME_PATTERN.match(line)
+        if frame is not None:
+            frames.append((frame["path"], frame["name"]))
+            continue
+        match = EXCEPTION_PATTERN.match(line.strip())
+        if match is not None and not line.startswith(" "):
+            exception = match
+    if exception is None:
+        return None
+    return {
+        "frames": frames,
+        "type": exception["type"],
+        "message": exception["message"] or "",
+    }
+
+
+def failure_signature(output):
+    """Computes the normalized signature of a failure.
+
+    Args:
+        output (str): The (stderr) output of the failed command or the traceback.
+
+    Returns:
+        dict: The signature hash (under 'signature'), the exception type, the
+            innermost frames (without paths and line numbers), the failing import and
+            the normalized message.
+    """
+
+    parsed = parse_traceback(output)
+    if parsed is None:
+        # E.g. a failed solve: use the last line of output that is not blank
+        last_line = next(
+            (line for line in reversed(output.splitlines()) if line.strip()), ""
+        )
+        parsed = {"frames": [], "type": "CommandFailed", "message": last_line}
+
+    message = normalize_message(parsed["message"])
+    signature = {
+        "exception": parsed["type"].rsplit(".", 1)[-1],
+        "frames": [
+            f"{normalize_frame_path(path)}:{name}"
+            for path, name in parsed["frames"][-SIGNATURE_FRAMES:]
+        ],
+        "import": find_failing_import(parsed["message"]),
+    }
+    # The message only tells failures apart if there is nothing more specific
+    if not signature["frames"] and signature["import"] is None:
+        signature["message"] = message
+    digest = hashlib.sha256(json.dumps(signature, sort_keys=True).encode()).hexdigest()
+    return {"signature": digest[:SIGNATURE_LENGTH], **signature, "message": message}
+
+
+def exception_signature(error):
+    """Computes the signature of an exception raised by a failed step.
+
+    Errors of failed commands (see `RunError`) are signed by the command's output,
+    other errors (e.g. timeouts) by their own type and message.
+    """
+
+    output = getattr(error, "output", None)
+    if output is None:
+        output = "".join(traceback.format_exception_only(type(error), error))
+    return failure_signature(output)
+
+
+def describe_signature(signature):
+    """Describes a failure signature in one line, e.g. for the commit message."""
+
+    description = f"{signature['signature']} {signature['exception']}"
+    if signature["import"] is not None:
+        description += f" importing {signature['import']}"
+    elif signature["frames"]:
+        description += f" in {signature['frames'][-1]}"
+    return description
@@ -1,43 +1,267 @@
 """Utilities for testing the experiment environment."""
 
 import inspect
+import json
+import os
+import secrets
+import tempfile
+import threading
+from multiprocessing.connection import Listener
+from pathlib import Path
+
 import user_test_code
-from envexp_utils.log import logger, print_code, run_and_log
+from envexp_utils.file import ROOT_DIR
+from envexp_utils.interpreter import get_python_command
+from envexp_utils.inventory import format_dependency_tree
+from envexp_utils.log import RunError, log_code, logger, print_code, run_and_log
+from envexp_utils.report import add_to_report
+
+# Configure the single-process worker
+WORKER_PATH = Path(__file__).parent / "worker.py"
+WORKER_AUTHKEY_VARIABLE = "ENVEXP_WORKER_AUTHKEY"
+
+# Configure the sandboxed runner of the user test functions
+TEST_RUNNER_PATH = Path(__file__).parent / "test_runner.py"
+DEFAULT_TEST_WORKERS = 4
+DEFAULT_TEST_LIMITS = {
+    "workers": DEFAULT_TEST_WORKERS,
+    "test_timeout": None,  # Wall-clock seconds per test
+    "cpu_time": None,  # CPU seconds per test
+    "memory_mb": None,  # Address space per test
+    "headless": False,  # Whether to keep GUI toolkits (e.g. Qt) from opening windows
+}
+TEST_RUNNER_FLAGS = {
+    "test_timeout": "--timeout",
+    "cpu_time": "--cpu-time",
+    "memory_mb": "--memory-mb",
+}
+
+
+def env_tag(env_name):
+    """Returns a tag to prefix messages with for environments other than the default."""
+
+    return "" if env_name == "experiment" else f"[{env_name}] "
+
+
+def pythonpath_variables(pythonpath):
+    """Returns the environment variables that add a directory to PYTHONPATH."""
+
+    if pythonpath is None:
+        return {}
+    paths = [str(pythonpath)] + os.environ.get("PYTHONPATH", "").split(os.pathsep)
+    return {"PYTHONPATH": os.pathsep.join(path for path in paths if path)}
+
+
+def log_user_code():
+    """Logs and prints the user-defined test code."""
+
+    user_code = inspect.getsource(user_test_code)
+    log_code("Running user-defined test code", user_code, user_test_code.__file__)
+    print(f"\nRunning user-defined test code:")
+    print_code(user_code)
 
 
-def test_code(conda_command):
+def log_imports(repo_name):
+    """Logs and prints the imports that are tested."""
+
+    logger.info("Testing imports with:")
+    print("\nTesting imports with:")
+    logger.info(f"\timport {repo_name}")
+    print_code(f"\timport {repo_name}")
+
+
+def record_test_results(results, env_name="experiment"):
+    """Adds the per-test results to the run report (under 'tests')."""
+
+    key = "tests" if env_name == "experiment" else f"tests[{env_name}]"
+    add_to_report(key, results)
+
+
+def test_code(conda_command, env_name="experiment", timeout=None, test_limits=None):
     """Runs user-defined test code.
-    
+
+    Each `test_*` function of user_test_code.py runs in its own process (in parallel)
+    with the given limits, so a hung or memory-hungry test only fails itself. A file
+    without test functions runs as a script in a single bounded process.
+
     Args:
         conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        env_name (str): The name of the environment to run the test code in.
+        timeout (float): Seconds after which the (hung) test run is killed.
+        test_limits (dict): Overrides of DEFAULT_TEST_LIMITS, i.e. the number of
+            parallel 'workers', the 'test_timeout' and 'cpu_time' (in seconds) and
+            'memory_mb' of each test, and whether to run 'headless'.
     """
 
-    user_code = inspect.getsource(user_test_code)
-    logger.info(f"Running user-defined test code:\n{user_code}")
-    print(f"\nRunning user-defined test code:")
-    print_code(user_code)
+    log_user_code()
+    limits = {**DEFAULT_TEST_LIMITS, **(test_limits or {})}
 
-    fail_message = "Tests failed!"
-    pass_message = "Tests passed successfully!"
-    command = f"{conda_command} run -n experiment python user_test_code.py"
-    run_and_log(command=command, fail_message=fail_message, pass_message=pass_message)
+    tag = env_tag(env_name)
+    fail_message = f"{tag}Tests failed!"
+    pass_message = f"{tag}Tests passed successfully!"
+    python, env = get_python_command(conda_command=conda_command, env_name=env_name)
+    with tempfile.TemporaryDirectory() as results_dir:
+        results_path = Path(results_dir) / "results.json"
+        command = (
+            f'{python} "{TEST_RUNNER_PATH}" user_test_code.py '
+            f'--results "{results_path}" --workers {limits["workers"]}'
+        )
+        for option, flag in TEST_RUNNER_FLAGS.items():
+            if limits[option] is not None:
+                command += f" {flag} {limits[option]}"
+        if limits["headless"]:
+            command += " --headless"
 
+        try:
+            run_and_log(
+                command=command,
+                fail_message=fail_message,
+                pass_message=pass_message,
+                timeout=timeout,
+                env=env,
+            )
+        finally:
+            if results_path.exists():
+                record_test_results(
+                    json.loads(results_path.read_text()), env_name=env_name
+                )
 
-def test_imports(conda_command, repo_name):
+
+def test_imports(
+    conda_command, repo_name, env_name="experiment", timeout=None, pythonpath=None
+):
     """Tests the imports in the experiment environment.
 
     Args:
         conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
         repo_name (str): The name of the repo to test imports for. E.g. 'sleap'.
+        env_name (str): The name of the environment to test the imports in.
+        timeout (float): Seconds after which the (hung) import is killed.
+        pythonpath (Path): A directory to add to PYTHONPATH to import the repo from
+            (if it is not in the envexp directory).
     """
 
-    logger.info("Testing imports with:")
-    print("\nTesting imports with:")
-    logger.info(f"\timport {repo_name}")
-    print_code(f"\timport {repo_name}")
+    log_imports(repo_name)
+
+    tag = env_tag(env_name)
+    fail_message = f"{tag}Imports failed!"
+    pass_message = f"{tag}Imports passed successfully!"
+    python, env = get_python_command(conda_command=conda_command, env_name=env_name)
+    command = f'{python} -c "import {repo_name}"'
+    run_and_log(
+        command=command,
+        fail_message=fail_message,
+        pass_message=pass_message,
+        timeout=timeout,
+        env={**env, **pythonpath_variables(pythonpath)},
+    )
+
+
+def test_in_worker(
+    conda_command,
+    repo_name=None,
+    env_name="experiment",
+    timeout=None,
+    pythonpath=None,
+    output_dir=None,
+):
+    """Runs the import check, user tests and dependency introspection in one process.
+
+    The worker reports the result of each step (and of each user test function) back
+    over a pipe, so the environment is only started once. The test functions run
+    one after another in the worker, without the limits of `test_code`. The
+    installed distributions are written to pipdeptree.txt.
+
+    Args:
+        conda_command (str): The conda command to use (i.e. micromamba, mamba, or conda)
+        repo_name (str): The name of the repo to test imports for. If None, testing
+            the repo import is skipped.
+        env_name (str): The name of the environment to run the worker in.
+        timeout (float): Seconds after which the (hung) worker is killed.
+        pythonpath (Path): A directory to add to PYTHONPATH to import the repo from.
+        output_dir (Path): The directory to write pipdeptree.txt to. Defaults to the
+            root directory.
+    """
+
+    if output_dir is None:
+        output_dir = ROOT_DIR
+
+    if repo_name is not None:
+        log_imports(repo_name)
+    log_user_code()
+
+    authkey = secrets.token_bytes(32)
+    listener = Listener(("127.0.0.1", 0), authkey=authkey)
+    messages = []
+
+    def receive():
+        """Receives the result messages until the worker closes the connection."""
+
+        try:
+            with listener.accept() as conn:
+                while True:
+                    messages.append(json.loads(conn.recv_bytes()))
+        except (EOFError, OSError):
+            pass
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+
+    host, port = listener.address
+    python, env = get_python_command(conda_command=conda_command, env_name=env_name)
+    command = f'{python} "{WORKER_PATH}" --address {host}:{port} --dependencies'
+    command += " --user-test user_test_code.py"
+    if repo_name is not None:
+        command += f" --repo-name {repo_name}"
+
+    tag = env_tag(env_name)
+    try:
+        run_and_log(
+            command=command,
+            fail_message=f"{tag}Worker failed!",
+            pass_message=f"{tag}Worker finished!",
+            timeout=timeout,
+            env={
+                **env,
+                **pythonpath_variables(pythonpath),
+                WORKER_AUTHKEY_VARIABLE: authkey.hex(),
+            },
+        )
+    finally:
+        receiver.join(timeout=5)
+        listener.close()
+
+    step_messages = {
+        "imports": (f"{tag}Imports passed successfully!", f"{tag}Imports failed!"),
+        "tests": (f"{tag}Tests passed successfully!", f"{tag}Tests failed!"),
+    }
+    test_results, errors = [], []
+    for message in messages:
+        if message["step"] == "dependencies":
+            (output_dir / "pipdeptree.txt").write_text(
+                format_dependency_tree(message["distributions"])
+            )
+            continue
 
-    fail_message = "Imports failed!"
-    pass_message = "Imports passed successfully!"
-    command = f'{conda_command} run -n experiment python -c "import {repo_name}"'
-    run_and_log(command=command, fail_message=fail_message, pass_message=pass_message)
+        pass_message, fail_message = step_messages[message["step"]]
+        if message["step"] == "tests":
+            # Each test function is reported (and fails) on its own
+            name = message["name"]
+            pass_message = f"{tag}Test {name} passed in {message['duration_s']} s"
+            fail_message = f"{tag}Test {name} failed!"
+            test_results.append(
+                {key: value for key, value in message.items() if key != "step"}
+            )
+        if message["passed"]:
+            logger.info(pass_message)
+            print(pass_message)
+        else:
+            logger.error(f"{fail_message}\n{message['error']}")
+            print(fail_message)
+            print(message["error"])
+            errors.append(message["error"])
 
+    if test_results:
+        record_test_results(test_results, env_name=env_name)
+    if errors:
+        raise RunError("\n".join(errors))
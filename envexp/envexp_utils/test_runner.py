@@ -0,0 +1,256 @@
+"""Runs the test functions of the user test file in parallel, bounded processes.
+
+This script is run with the experiment environment's python (so it may only use the
+standard library). The `test_*` functions defined at the top level of the test file
+are collected without importing it, and each one runs in its own process with
+CPU-time and memory limits (rlimits, on POSIX) and a wall-clock timeout, so a hung
+or memory-hungry test only fails itself. A test file without test functions runs as a
+script (its `if __name__ == "__main__":` block) in a single bounded process.
+
+The result (pass/fail, duration and peak memory) of each test is written as JSON to
+the --results file, and the exit code is 1 if any test failed.
+"""
+
+import argparse
+import ast
+import json
+import os
+import platform
+import runpy
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+SCRIPT_TEST = "__main__"  # The name of the single test of a file without functions
+POLL_INTERVAL = 0.05  # Seconds between checks whether a test process has exited
+# Environment variables that keep GUI toolkits from opening windows
+HEADLESS_VARIABLES = {"QT_QPA_PLATFORM": "offscreen", "MPLBACKEND": "Agg"}
+
+
+def collect_tests(path):
+    """Returns the names of the top-level `test_*` functions of a file (in order)."""
+
+    with open(path, encoding="utf-8") as infile:
+        tree = ast.parse(infile.read(), filename=path)
+    return [
+        node.name
+        for node in tree.body
+        if isinstance(node, ast.FunctionDef) and node.name.startswith("test_")
+    ]
+
+
+def run_test(path, name):
+    """Runs a single test function (or the file as a script) in this process."""
+
+    # Import from the working directory (like `python user_test_code.py`)
+    sys.path[0] = os.getcwd()
+    if name == SCRIPT_TEST:
+        runpy.run_path(path, run_name="__main__")
+        return
+
+    namespace = runpy.run_path(path, run_name="user_test_code")
+    namespace[name]()
+
+
+def set_limits(cpu_time, memory_mb):
+    """Sets the CPU time and address space limits of this test process (POSIX only).
+
+    The limits are set by the test process itself before the test file is run, as
+    forking with a `preexec_fn` is not safe while other threads are running.
+    """
+
+    if cpu_time is not None:
+        seconds = int(cpu_time)
+        resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 1))
+    if memory_mb is not None:
+        limit = int(memory_mb * 1024**2)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def peak_rss_mb(rusage):
+    """Returns the peak RSS (in MB) of a process from its resource usage."""
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1024**2 if platform.system() == "Darwin" else 1024
+    return round(rusage.ru_maxrss / scale, 1)
+
+
+def exit_code(status):
+    """Returns the return code (negative if killed by a signal) of a wait status."""
+
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def describe_exit(returncode, timed_out, cpu_time):
+    """Returns why a test process failed, or None if it passed."""
+
+    if timed_out:
+        return "Timed out (wall-clock limit)"
+    if returncode == 0:
+        return None
+    if returncode < 0:
+        signal_name = signal.Signals(-returncode).name
+        if signal_name == "SIGXCPU" or (
+            cpu_time is not None and signal_name == "SIGKILL"
+        ):
+            return f"Killed by {signal_name} (CPU time limit of {cpu_time} s)"
+        return f"Killed by {signal_name}"
+    return f"Exited with {returncode}"
+
+
+def run_test_process(path, name, timeout, cpu_time, memory_mb, headless):
+    """Runs a test in a bounded child process and waits for it (with `os.wait4`).
+
+    Returns:
+        dict: The 'name', whether it 'passed', the 'error', the 'duration_s', the
+            'peak_rss_mb' (None on Windows) and the combined 'output' of the test.
+    """
+
+    env = dict(os.environ)
+    if headless:
+        env.update(HEADLESS_VARIABLES)
+    command = [sys.executable, os.path.abspath(__file__), path, "--run-test", name]
+    # The child sets its own limits (a preexec_fn is not safe with the thread pool)
+    if cpu_time is not None:
+        command += ["--cpu-time", str(cpu_time)]
+    if memory_mb is not None:
+        command += ["--memory-mb", str(memory_mb)]
+
+    posix = resource is not None
+    with tempfile.TemporaryFile() as output:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+            env=env,
+            start_new_session=posix,
+        )
+
+        timed_out, rusage = False, None
+        if posix:
+            deadline = None if timeout is None else start + timeout
+            while True:
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+                if pid != 0:
+                    break
+                if deadline is not None and time.perf_counter() > deadline:
+                    timed_out = True
+                    os.killpg(process.pid, signal.SIGKILL)
+                    _, status, rusage = os.wait4(process.pid, 0)
+                    break
+                time.sleep(POLL_INTERVAL)
+            # The process was reaped by wait4, so Popen must not wait for it
+            process.returncode = exit_code(status)
+        else:
+            try:
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                process.kill()
+                process.wait()
+        duration = time.perf_counter() - start
+
+        output.seek(0)
+        text = output.read().decode(errors="replace")
+
+    error = describe_exit(process.returncode, timed_out, cpu_time)
+    lines = text.strip().splitlines()
+    if error is not None and process.returncode > 0 and lines:
+        # E.g. the exception of the traceback, like "AssertionError: ..."
+        error = lines[-1]
+    return {
+        "name": name,
+        "passed": error is None,
+        "error": error,
+        "duration_s": round(duration, 3),
+        "peak_rss_mb": peak_rss_mb(rusage) if rusage is not None else None,
+        "output": text,
+    }
+
+
+def format_result(result):
+    """Formats the summary line of a test result."""
+
+    status = "passed" if result["passed"] else "FAILED"
+    memory = result["peak_rss_mb"]
+    memory = f", peak {memory} MB" if memory is not None else ""
+    error = f": {result['error']}" if result["error"] else ""
+    return f"{result['name']} {status} in {result['duration_s']} s{memory}{error}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str)
+    parser.add_argument("--run-test", type=str, default=None)
+    parser.add_argument("--results", type=str, default=None)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=None)
+    parser.add_argument("--cpu-time", type=float, default=None)
+    parser.add_argument("--memory-mb", type=float, default=None)
+    parser.add_argument("--headless", action="store_true")
+    args = parser.parse_args()
+
+    if args.run_test is not None:
+        if resource is not None:
+            set_limits(args.cpu_time, args.memory_mb)
+        run_test(args.path, args.run_test)
+        return
+
+    names = collect_tests(args.path) or [SCRIPT_TEST]
+    print(f"Running {len(names)} tests with {args.workers} workers...", flush=True)
+    print_lock = threading.Lock()
+
+    def run(name):
+        result = run_test_process(
+            args.path,
+            name,
+            timeout=args.timeout,
+            cpu_time=args.cpu_time,
+            memory_mb=args.memory_mb,
+            headless=args.headless,
+        )
+        # Print the output of each test as one block (stderr if it failed)
+        with print_lock:
+            stream = sys.stdout if result["passed"] else sys.stderr
+            print(f"\n--- {format_result(result)}", file=stream)
+            if result["output"]:
+                print(result["output"].rstrip("\n"), file=stream)
+            stream.flush()
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        results = list(executor.map(run, names))
+
+    failed = [result for result in results if not result["passed"]]
+    print(f"\n{len(results) - len(failed)} passed, {len(failed)} failed", flush=True)
+    for result in failed:
+        print(format_result(result), file=sys.stderr, flush=True)
+
+    if args.results is not None:
+        with open(args.results, "w") as outfile:
+            json.dump(
+                [
+                    {key: value for key, value in result.items() if key != "output"}
+                    for result in results
+                ],
+                outfile,
+                indent=2,
+            )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Runs the import check, user tests and dependency introspection in one process.
+
+This script is run with the experiment environment's python (so it may only use the
+standard library) and reports the result of each step back to envexp over a
+`multiprocessing.connection`, authenticated with the key in ENVEXP_WORKER_AUTHKEY.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import re
+import runpy
+import sys
+import time
+import traceback
+from importlib import metadata
+from multiprocessing.connection import Client
+
+from test_runner import SCRIPT_TEST, collect_tests
+
+AUTHKEY_VARIABLE = "ENVEXP_WORKER_AUTHKEY"
+
+
+def run_step(step, function):
+    """Runs a step and returns its result message."""
+
+    start = time.perf_counter()
+    try:
+        function()
+        passed, error = True, None
+    except SystemExit as e:
+        passed = e.code in (None, 0)
+        error = None if passed else f"SystemExit: {e.code}"
+    except BaseException:
+        passed, error = False, traceback.format_exc()
+    return {
+        "step": step,
+        "passed": passed,
+        "error": error,
+        "duration_s": round(time.perf_counter() - start, 3),
+    }
+
+
+def run_user_tests(path):
+    """Runs each test function of the user test file (or the file as a script).
+
+    Returns:
+        list[dict]: The result message of each test (see `run_step`), with its name.
+    """
+
+    names = collect_tests(path)
+    if not names:
+        result = run_step("tests", lambda: runpy.run_path(path, run_name="__main__"))
+        return [{**result, "name": SCRIPT_TEST, "peak_rss_mb": None}]
+
+    namespace = {}
+    result = run_step(
+        "tests",
+        lambda: namespace.update(runpy.run_path(path, run_name="user_test_code")),
+    )
+    if not result["passed"]:
+        return [{**result, "name": os.path.basename(path), "peak_rss_mb": None}]
+    return [
+        {**run_step("tests", namespace[name]), "name": name, "peak_rss_mb": None}
+        for name in names
+    ]
+
+
+def requirement_name(requirement):
+    """Returns the name of a requirement, or None if it only applies to an extra."""
+
+    if ";" in requirement and "extra" in requirement.split(";", 1)[1]:
+        return None
+    match = re.match(r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)", requirement)
+    return match.group(1) if match else None
+
+
+def list_distributions():
+    """Lists the installed distributions with their (non-extra) requirements."""
+
+    distributions = {}
+    for distribution in metadata.distributions():
+        name = distribution.metadata["Name"]
+        if name is None or name in distributions:
+            continue
+        requires = [requirement_name(req) for req in (distribution.requires or [])]
+        distributions[name] = {
+            "name": name,
+            "version": distribution.version,
+            "requires": sorted({req for req in requires if req is not None}),
+        }
+    return sorted(distributions.values(), key=lambda dist: dist["name"].lower())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--address", type=str, required=True)
+    parser.add_argument("--repo-name", type=str, default=None)
+    parser.add_argument("--user-test", type=str, default=None)
+    parser.add_argument("--dependencies", action="store_true")
+    args = parser.parse_args()
+
+    # Import from the working directory (like `python -c`), not this script's directory
+    sys.path[0] = os.getcwd()
+
+    host, port = args.address.rsplit(":", 1)
+    authkey = bytes.fromhex(os.environ.pop(AUTHKEY_VARIABLE))
+    with Client((host, int(port)), authkey=authkey) as conn:
+
+        def send(message):
+            conn.send_bytes(json.dumps(message).encode())
+
+        if args.dependencies:
+            send({"step": "dependencies", "distributions": list_distributions()})
+
+        if args.repo_name is not None:
+            result = run_step(
+                "imports", lambda: importlib.import_module(args.repo_name)
+            )
+            send(result)
+            if not result["passed"]:
+                return
+
+        if args.user_test is not None:
+            for result in run_user_tests(args.user_test):
+                send(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,45 @@
 import argparse
 from pathlib import Path
 
-from envexp_utils.code_edit import delete_old_experiment_code, copy_source_code
+from envexp_utils.artifacts import DEFAULT_ARTIFACT_BUDGET_GB, expand_artifacts
+from envexp_utils.bisection import bisect_environments
+from envexp_utils.cache import DEFAULT_CACHE_BUDGET_GB, create_cached_environment
+from envexp_utils.code_edit import (
+    DEFAULT_WORKSPACE_MODE,
+    WORKSPACE_MODES,
+    copy_source_code,
+    delete_old_experiment_code,
+    show_module_graph,
+)
 from envexp_utils.commit import commit_experiment
-from envexp_utils.environment import (
-    determine_conda,
-    create_environment,
-    remove_environment,
+from envexp_utils.env_diff import diff_revisions
+from envexp_utils.environment import hash_environment_file
+from envexp_utils.executable import determine_conda, get_conda_info
+from envexp_utils.history import describe_failure_cluster, show_history
+from envexp_utils.import_profile import profile_imports
+from envexp_utils.log import (
+    log_dependencies,
+    reset_logfile,
+    use_atomic_logfile,
+    use_compact_artifacts,
+)
+from envexp_utils.matrix import DEFAULT_MAX_WORKERS, matrix_passed, run_matrix
+from envexp_utils.pipeline import run_pipeline
+from envexp_utils.pool import refresh_pool, show_pool, start_background_refresh
+from envexp_utils.prefetch import DEFAULT_PREFETCH_WORKERS, prefetch_environment
+from envexp_utils.report import (
+    add_to_report,
+    reset_run_report,
+    timed_phase,
+    write_run_report,
+)
+from envexp_utils.signature import exception_signature
+from envexp_utils.test import (
+    DEFAULT_TEST_WORKERS,
+    test_code,
+    test_imports,
+    test_in_worker,
 )
-from envexp_utils.log import reset_logfile
-from envexp_utils.test import test_code, test_imports
 
 
 def create_parser():
@@ -32,11 +62,351 @@ def create_parser():
         ),
         default=None,
     )
+    parser.add_argument(
+        "--nested-imports",
+        action="store_true",
+        help=(
+            "When a library is provided, also copy its imports that are nested in "
+            "conditionals, try-blocks and functions (not only module-level imports)."
+        ),
+    )
+    parser.add_argument(
+        "--rescan-imports",
+        action="store_true",
+        help=(
+            "When a library is provided, rescan every Python file for imports instead "
+            "of only the files that changed since the last scan."
+        ),
+    )
+    parser.add_argument(
+        "--workspace",
+        type=str,
+        choices=WORKSPACE_MODES,
+        help=(
+            "How to make the entire repo available when no library is provided: "
+            "'symlink' it, 'hardlink', 'reflink' or 'copy' its files, add its parent "
+            "directory to 'pythonpath', or 'link' (symlink, falling back to hardlink)."
+        ),
+        default=DEFAULT_WORKSPACE_MODE,
+    )
+    parser.add_argument(
+        "--exclude",
+        type=str,
+        action="append",
+        help=(
+            "A .gitignore-style pattern of files not to hardlink/reflink/copy into the "
+            "workspace (in addition to .git, __pycache__ and the repo's .gitignore). "
+            "Can be given multiple times."
+        ),
+        default=[],
+    )
+    parser.add_argument(
+        "--entry",
+        type=str,
+        action="append",
+        help=(
+            "An entry module of the repo, e.g. 'sleap.gui.app' or 'gui/app.py'. When "
+            "no library is provided, only the repo's modules needed to import the "
+            "entry modules are copied (and imported with the repo) instead of the "
+            "entire repo. Can be given multiple times."
+        ),
+        default=[],
+    )
     parser.add_argument(
         "--commit-message",
         type=str,
         help="The commit message to use when committing the changes.",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=(
+            "Always remove and recreate the experiment environment instead of reusing "
+            "a cached environment built from the same environment.yml."
+        ),
+    )
+    parser.add_argument(
+        "--cache-budget",
+        type=float,
+        help="The disk budget (in GB) for cached environments.",
+        default=DEFAULT_CACHE_BUDGET_GB,
+    )
+    parser.add_argument(
+        "--no-lockfile",
+        action="store_true",
+        help=(
+            "Always solve the environment.yml instead of creating the environment "
+            "from the explicit lockfile (explicit.txt)."
+        ),
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help=(
+            "Build environments only from the packages prefetched into the managed "
+            "package directory (see the prefetch command), solving against the "
+            "local channel indexed from them instead of the remote channels."
+        ),
+    )
+    parser.add_argument(
+        "--no-pool",
+        action="store_true",
+        help=(
+            "Solve environments from scratch instead of cloning the closest base "
+            "environment of the warm pool (pool/*.yml) and installing the delta."
+        ),
+    )
+    parser.add_argument(
+        "--matrix",
+        type=str,
+        nargs="+",
+        help=(
+            "Run the experiment against each of the given environment.yml variants "
+            "(instead of envexp/environment.yml) and report a combined pass/fail "
+            "table in matrix_results.txt. E.g. 'envexp/matrix/*.yml'."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        help="The maximum number of matrix variants to run concurrently.",
+        default=DEFAULT_MAX_WORKERS,
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help=(
+            "The timeout (in seconds) for each of the import and user test steps, "
+            "after which the hung step is killed and fails."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--test-workers",
+        type=int,
+        help=(
+            "The number of test functions (test_* in user_test_code.py) to run in "
+            "parallel processes."
+        ),
+        default=DEFAULT_TEST_WORKERS,
+    )
+    parser.add_argument(
+        "--test-timeout",
+        type=float,
+        help="The wall-clock limit (in seconds) of each test function.",
+        default=None,
+    )
+    parser.add_argument(
+        "--test-cpu-time",
+        type=float,
+        help="The CPU time limit (in seconds) of each test function (POSIX only).",
+        default=None,
+    )
+    parser.add_argument(
+        "--test-memory",
+        type=float,
+        help="The memory (address space) limit in MB of each test function (POSIX).",
+        default=None,
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help=(
+            "Run the test functions headless, e.g. with QT_QPA_PLATFORM=offscreen so "
+            "Qt tests do not open windows."
+        ),
+    )
+    parser.add_argument(
+        "--single-process",
+        action="store_true",
+        help=(
+            "Run the import check, user tests and dependency introspection in a "
+            "single worker process of the experiment environment."
+        ),
+    )
+    parser.add_argument(
+        "--atomic-log",
+        action="store_true",
+        help=(
+            "Write test.log to a temporary file that replaces it at the end of the "
+            "run, so test.log is never seen half-written."
+        ),
+    )
+    parser.add_argument(
+        "--compact-artifacts",
+        action="store_true",
+        help=(
+            "Store test.log, the inventories and large stderr output compressed in "
+            "the artifact store and only commit their manifest (artifacts.json)."
+        ),
+    )
+    parser.add_argument(
+        "--artifact-budget",
+        type=float,
+        help="The disk budget of the artifact store in GB.",
+        default=DEFAULT_ARTIFACT_BUDGET_GB,
+    )
+    parser.add_argument(
+        "--profile-imports",
+        action="store_true",
+        help=(
+            "Profile the import of the repo with `python -X importtime` and add the "
+            "slowest imports (and regressions since the last run) to the run report "
+            "and the commit message."
+        ),
+    )
+
+    subparsers = parser.add_subparsers(dest="command")
+    bisect_parser = subparsers.add_parser(
+        "bisect",
+        help=(
+            "Binary-search over the packages that differ between a known-good and a "
+            "known-bad environment to find the culprit packages."
+        ),
+    )
+    bisect_parser.add_argument(
+        "--good",
+        type=str,
+        required=True,
+        help="The mamba_list.txt or explicit lockfile of the known-good environment.",
+    )
+    bisect_parser.add_argument(
+        "--bad",
+        type=str,
+        required=True,
+        help="The mamba_list.txt or explicit lockfile of the known-bad environment.",
+    )
+    diff_parser = subparsers.add_parser(
+        "diff",
+        help=(
+            "Report the packages and dependency edges that changed between the "
+            "environments committed at two revisions."
+        ),
+    )
+    diff_parser.add_argument(
+        "rev_a", type=str, help="The old revision, e.g. the hash of a 'P:' commit."
+    )
+    diff_parser.add_argument(
+        "rev_b", type=str, help="The new revision, e.g. the hash of an 'F:' commit."
+    )
+    prefetch_parser = subparsers.add_parser(
+        "prefetch",
+        help=(
+            "Download every package an environment.yml needs into the managed "
+            "package directory (in parallel) and index them for --offline builds."
+        ),
+    )
+    prefetch_parser.add_argument(
+        "--environment-file",
+        type=str,
+        help="The environment file to prefetch. Defaults to envexp/environment.yml.",
+        default=None,
+    )
+    prefetch_parser.add_argument(
+        "--workers",
+        type=int,
+        help="The maximum number of concurrent downloads.",
+        default=DEFAULT_PREFETCH_WORKERS,
+    )
+    history_parser = subparsers.add_parser(
+        "history",
+        help=(
+            "Query the index of experiment runs (backfilled from git history), e.g. "
+            "'history numpy>=2 qtpy --status failed'."
+        ),
+    )
+    history_parser.add_argument(
+        "package_specs",
+        type=str,
+        nargs="*",
+        help=(
+            "Package specs that the environment of each run must satisfy, e.g. "
+            "'numpy>=2' or 'qtpy' (installed at any version)."
+        ),
+    )
+    history_parser.add_argument(
+        "--status",
+        type=str,
+        choices=["passed", "failed"],
+        help="Only show runs with this status.",
+        default=None,
+    )
+    history_parser.add_argument(
+        "--signature",
+        type=str,
+        help="Only show runs that failed with this failure signature.",
+        default=None,
+    )
+    history_parser.add_argument(
+        "--limit",
+        type=int,
+        help="The maximum number of (most recent) runs to show.",
+        default=None,
+    )
+    pool_parser = subparsers.add_parser(
+        "pool",
+        help=(
+            "Build the stale base environments of the warm pool (pool/*.yml) "
+            "or show their status."
+        ),
+    )
+    pool_parser.add_argument(
+        "pool_command",
+        type=str,
+        choices=["refresh", "status"],
+        help="Whether to 'refresh' the stale bases or show their 'status'.",
+    )
+    graph_parser = subparsers.add_parser(
+        "graph",
+        help=(
+            "Export the import graph of the modules of the repo given by --input-dir "
+            "(or of the modules needed to import the --entry modules)."
+        ),
+    )
+    graph_parser.add_argument(
+        "--format",
+        type=str,
+        choices=["dot", "json"],
+        help="Export the graph as Graphviz 'dot' or 'json'.",
+        default="dot",
+    )
+    graph_parser.add_argument(
+        "--highlight",
+        type=str,
+        help=(
+            "A library (e.g. 'qtpy') to highlight the modules that import it, "
+            "directly or through the modules they import."
+        ),
+        default=None,
+    )
+    graph_parser.add_argument(
+        "--output",
+        type=str,
+        help="The file to write the graph to. Defaults to printing it.",
+        default=None,
+    )
+    artifacts_parser = subparsers.add_parser(
+        "artifacts",
+        help="Expand the artifacts of a run committed with --compact-artifacts.",
+    )
+    artifacts_parser.add_argument(
+        "artifacts_command",
+        type=str,
+        choices=["expand"],
+        help="Expand the artifacts of the run to files.",
+    )
+    artifacts_parser.add_argument(
+        "rev",
+        type=str,
+        help="The commit of the run, e.g. HEAD~1 or a commit hash.",
+    )
+    artifacts_parser.add_argument(
+        "--output-dir",
+        type=str,
+        help="The directory to expand to. Defaults to expanded/<commit>.",
+        default=None,
+    )
     return parser
 
 
@@ -58,33 +428,40 @@ def parse_args(library=None, input_dir=None, commit_message=None):
     if args.input_dir is not None:
         args.input_dir = Path(args.input_dir)
         repo_name = args.input_dir.name
+    args.repo_name = repo_name
 
     # Print the modified arguments
     print(f"Modified Arguments:\n\t{args}")
 
-    if args.commit_message is None:
+    if args.commit_message is None and args.command is None:
         parser.print_usage()
         raise ValueError(
             "Missing required argument --commit-message. "
             "Please provide a commit message.",
         )
-    return args.library, args.input_dir, repo_name, args.commit_message
+    return args
 
 
 def main(library=None, input_dir=None, commit_message=None):
     """Main function to run the environment experiment.
 
     This function:
-        1. removes any existing environment called 'experiment'
+        1. removes any existing environment called 'experiment' (unless a cached
+            environment built from the same envexp/environment.yml can be reused)
         2. creates a new environment called 'experiment' from the envexp/environment.yml
         3. logs the dependencies of the experiment environment to mamaba_list.txt and
-            pipdeptree.txt
+            pipdeptree.txt (and to inventory.json, and the explicit lockfile to
+            explicit.txt)
         3. copies the source code from the input directory to the envexp directory
         4. tests the importability of the copied source code
         5. runs user-defined test code
-        6. logs results of the experiment to test.log
+        6. logs results of the experiment to test.log (and the timing of each phase
+            to run_report.json)
         7. commits the changes to the root directory
 
+    Independent steps run concurrently (see `experiment_tasks`), e.g. the source code
+    is copied while the environment is created, with the output kept in this order.
+
     Args:
         library (str): The library to search for in the imports. E.g. 'qtpy'.
         input_dir (str): The path to the source code of a repo. E.g. 'C:\path\\to\sleap'.
@@ -92,48 +469,329 @@ def main(library=None, input_dir=None, commit_message=None):
     """
 
     # Parse the command-line arguments
-    library, input_dir, repo_name, commit_message = parse_args(
+    args = parse_args(
         library=library,
         input_dir=input_dir,
         commit_message=commit_message,
     )
+    library, input_dir, repo_name, commit_message = (
+        args.library,
+        args.input_dir,
+        args.repo_name,
+        args.commit_message,
+    )
+    if args.atomic_log:
+        use_atomic_logfile()
+    if args.compact_artifacts:
+        use_compact_artifacts()
+
+    if args.command == "diff":
+        # Diffing committed environments does not run an experiment
+        diff_revisions(rev_a=args.rev_a, rev_b=args.rev_b)
+        return
+    if args.command == "history":
+        show_history(
+            package_specs=args.package_specs,
+            status=args.status,
+            signature=args.signature,
+            limit=args.limit,
+        )
+        return
+    if args.command == "pool":
+        # Managing the pool does not run an experiment (nor touch its logs)
+        if args.pool_command == "refresh":
+            refresh_pool(conda_command=determine_conda())
+        else:
+            show_pool()
+        return
+    if args.command == "prefetch":
+        # Downloading packages does not run an experiment (nor touch its logs)
+        prefetch_environment(
+            conda_command=determine_conda(),
+            environment_file=(
+                Path(args.environment_file) if args.environment_file else None
+            ),
+            max_workers=args.workers,
+        )
+        return
+    if args.command == "graph":
+        # Exporting the module graph does not run an experiment
+        if input_dir is None:
+            raise ValueError("The graph command requires --input-dir.")
+        show_module_graph(
+            input_dir=input_dir,
+            package=repo_name,
+            entries=args.entry,
+            library=args.highlight,
+            output_format=args.format,
+            output=args.output,
+        )
+        return
+    if args.command == "artifacts":
+        # Expanding the artifacts of a committed run does not run an experiment
+        expand_artifacts(rev=args.rev, output_dir=args.output_dir)
+        return
+
+    reset_run_report(
+        args={key: str(value) for key, value in vars(args).items()},
+    )
 
     # Determine the conda executable to use
-    conda_command = determine_conda()
-    remove_environment(conda_command=conda_command)
-    reset_logfile()
-    delete_old_experiment_code()
+    with timed_phase("determine_conda"):
+        conda_command = determine_conda()
+    add_to_report("conda_command", conda_command)
+    add_to_report("conda", get_conda_info(conda_command))
+    # The same hash as the environment cache key (see `create_cached_environment`)
+    add_to_report("yml_hash", hash_environment_file(conda_command=conda_command))
+
+
+    if args.command == "bisect" and commit_message is None:
+        commit_message = f"Bisect {args.good} -> {args.bad}"
 
+    status = "failed"
+    commit_details = []
     try:
-        # Create a new conda environment
-        create_environment(conda_command=conda_command)
-
-        # Test the imports
-        if input_dir is not None:
-            # Copy imports from the given directory
-            copy_source_code(
-                input_dir=input_dir,
-                repo_name=repo_name,
-                library=library,
-            )
-            test_imports(conda_command=conda_command, repo_name=repo_name)
+        if args.command == "bisect":
+            run_bisect_experiment(args=args, conda_command=conda_command)
+            commit_message = f"P: {commit_message}"
+            status = "passed"
+            return
 
-        # Run user-defined test code
-        test_code(conda_command=conda_command)
+        if args.matrix is not None:
+            run_matrix_experiment(args=args, conda_command=conda_command)
+            commit_message = f"P: {commit_message}"
+            status = "passed"
+            return
+
+        # Run the phases of the experiment, overlapping those that are independent
+        results = run_pipeline(experiment_tasks(args=args, conda_command=conda_command))
+        if "profile_imports" in results:
+            commit_details.append(results["profile_imports"])
 
         # If no errors, add P: to the commit message
         commit_message = f"P: {commit_message}"
+        status = "passed"
     except Exception as e:
         # If there are errors, add F: to the commit message
         commit_message = f"F: {commit_message}"
+        # Label the failure with the earlier runs that failed the same way
+        failure = exception_signature(e)
+        add_to_report("failure", failure)
+        commit_details.append(describe_failure_cluster(failure))
         raise e
     finally:
-        # Commit the changes
-        commit_experiment(commit_message=commit_message)
+        # Write the run report and commit the changes
+        write_run_report(status=status)
+        if commit_details:
+            commit_message = "\n\n".join([commit_message, *commit_details])
+        commit_experiment(
+            commit_message=commit_message,
+            compact=args.compact_artifacts,
+            budget_gb=args.artifact_budget,
+        )
+        # Rebuild stale pool bases while envexp is idle
+        if not args.no_pool:
+            start_background_refresh()
 
     return
 
 
+def make_test_limits(args):
+    """Returns the limits of the user test functions (see `test_code`)."""
+
+    return {
+        "workers": args.test_workers,
+        "test_timeout": args.test_timeout,
+        "cpu_time": args.test_cpu_time,
+        "memory_mb": args.test_memory,
+        "headless": args.headless,
+    }
+
+
+def setup_tasks():
+    """Returns the tasks that prepare a run (see `run_pipeline`).
+
+    They do not depend on the experiment environment, so they overlap with creating
+    it.
+    """
+
+    return {
+        "reset_logfile": ([], lambda results: reset_logfile()),
+        "delete_old_experiment_code": (
+            [],
+            lambda results: delete_old_experiment_code(),
+        ),
+    }
+
+
+def experiment_tasks(args, conda_command):
+    """Returns the phases of an experiment as a dependency graph (see `run_pipeline`).
+
+    Creating the environment overlaps with setting up the run and copying the source
+    code, and logging the dependencies overlaps with the tests.
+    """
+
+    def environment(results):
+        # Create a new conda environment (or reuse a cached one)
+        create_cached_environment(
+            conda_command=conda_command,
+            use_cache=not args.no_cache,
+            budget_gb=args.cache_budget,
+            use_lockfile=not args.no_lockfile,
+            include_pip=not args.single_process,
+            offline=args.offline,
+            use_pool=not args.no_pool,
+            defer_logging=True,
+        )
+
+    def source_code(results):
+        # Copy the source code to test the imports of
+        return copy_source_code(
+            input_dir=args.input_dir,
+            repo_name=args.repo_name,
+            library=args.library,
+            nested_imports=args.nested_imports,
+            rescan_imports=args.rescan_imports,
+            workspace=args.workspace,
+            exclude=args.exclude,
+            entries=args.entry,
+        )
+
+    def dependencies(results):
+        log_dependencies(
+            conda_command=conda_command, include_pip=not args.single_process
+        )
+
+    def worker(results):
+        # Run the imports, user-defined test code and dependency introspection
+        test_in_worker(
+            conda_command=conda_command,
+            repo_name=args.repo_name,
+            timeout=args.timeout,
+            pythonpath=results.get("copy_source_code"),
+        )
+
+    def imports(results):
+        test_imports(
+            conda_command=conda_command,
+            repo_name=args.repo_name,
+            timeout=args.timeout,
+            pythonpath=results.get("copy_source_code"),
+        )
+
+    def code(results):
+        # Run user-defined test code
+        test_code(
+            conda_command=conda_command,
+            timeout=args.timeout,
+            test_limits=make_test_limits(args),
+        )
+
+    def import_profile(results):
+        # Profile the import time of the repo
+        return profile_imports(
+            conda_command=conda_command,
+            repo_name=args.repo_name,
+            pythonpath=results.get("copy_source_code"),
+        )
+
+    tasks = setup_tasks()
+    tasks["environment"] = ([], environment)
+    test_dependencies = ["environment"]
+    if args.input_dir is not None:
+        tasks["copy_source_code"] = (["delete_old_experiment_code"], source_code)
+        test_dependencies.append("copy_source_code")
+    tasks["log_dependencies"] = (["environment"], dependencies)
+
+    if args.single_process:
+        tasks["test_in_worker"] = (test_dependencies, worker)
+        last_test = "test_in_worker"
+    else:
+        if args.input_dir is not None:
+            tasks["test_imports"] = (test_dependencies, imports)
+            test_dependencies = ["test_imports"]
+        tasks["test_code"] = (test_dependencies, code)
+        last_test = "test_code"
+
+    if args.profile_imports and args.input_dir is not None:
+        tasks["profile_imports"] = ([last_test], import_profile)
+    return tasks
+
+
+def run_matrix_experiment(args, conda_command):
+    """Runs the experiment against each environment.yml variant given by --matrix."""
+
+    # Copy the source code once for all variants
+    tasks = setup_tasks()
+    if args.input_dir is not None:
+        tasks["copy_source_code"] = (
+            ["delete_old_experiment_code"],
+            lambda results: copy_source_code(
+                input_dir=args.input_dir,
+                repo_name=args.repo_name,
+                library=args.library,
+                nested_imports=args.nested_imports,
+                rescan_imports=args.rescan_imports,
+                workspace=args.workspace,
+                exclude=args.exclude,
+                entries=args.entry,
+            ),
+        )
+    pythonpath = run_pipeline(tasks).get("copy_source_code")
+
+    results = run_matrix(
+        conda_command=conda_command,
+        environment_files=[Path(variant) for variant in args.matrix],
+        repo_name=args.repo_name,
+        max_workers=args.max_workers,
+        use_cache=not args.no_cache,
+        budget_gb=args.cache_budget,
+        timeout=args.timeout,
+        pythonpath=pythonpath,
+        offline=args.offline,
+        use_pool=not args.no_pool,
+        test_limits=make_test_limits(args),
+    )
+    if not matrix_passed(results):
+        raise Exception("One or more matrix variants failed!")
+
+
+def run_bisect_experiment(args, conda_command):
+    """Bisects the packages between the --good and --bad environments."""
+
+    # Copy the source code once for all candidates
+    tasks = setup_tasks()
+    if args.input_dir is not None:
+        tasks["copy_source_code"] = (
+            ["delete_old_experiment_code"],
+            lambda results: copy_source_code(
+                input_dir=args.input_dir,
+                repo_name=args.repo_name,
+                library=args.library,
+                nested_imports=args.nested_imports,
+                rescan_imports=args.rescan_imports,
+                workspace=args.workspace,
+                exclude=args.exclude,
+                entries=args.entry,
+            ),
+        )
+    pythonpath = run_pipeline(tasks).get("copy_source_code")
+
+    bisect_environments(
+        conda_command=conda_command,
+        good_file=Path(args.good),
+        bad_file=Path(args.bad),
+        repo_name=args.repo_name,
+        use_cache=not args.no_cache,
+        budget_gb=args.cache_budget,
+        timeout=args.timeout,
+        pythonpath=pythonpath,
+        offline=args.offline,
+        use_pool=not args.no_pool,
+        test_limits=make_test_limits(args),
+    )
+
+
 if __name__ == "__main__":
     main(
         # library="qtpy",
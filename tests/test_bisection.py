@@ -0,0 +1,104 @@
+from envexp_utils.bisection import diff_package_lists, find_culprits, parse_package_list
+
+MICROMAMBA_LIST = """\
+List of packages in environment: "/opt/envs/experiment"
+
+  Name           Version  Build               Channel
+──────────────────────────────────────────────────────────
+  numpy          2.0.1    py311h1_0           conda-forge
+  python         3.11.9   hb806964_0_cpython  conda-forge
+"""
+
+MAMBA_LIST = """\
+# packages in environment at /opt/envs/experiment:
+#
+# Name                    Version                   Build  Channel
+numpy                     1.26.4          py311h64a7726_0    conda-forge
+qtpy                      2.4.1              pyhd8ed1ab_0    conda-forge
+requests                  2.32.3                   pypi_0    pypi
+"""
+
+EXPLICIT_LOCKFILE = """\
+# This file may be used to create an environment using:
+@EXPLICIT
+https://conda.anaconda.org/conda-forge/linux-64/numpy-1.26.4-py311h64a7726_0.conda#ab
+https://conda.anaconda.org/conda-forge/noarch/qtpy-2.4.1-pyhd8ed1ab_0.conda
+"""
+
+
+def test_parse_micromamba_list_skips_headers():
+    packages = parse_package_list(MICROMAMBA_LIST)
+    assert sorted(packages) == ["numpy", "python"]
+    assert packages["numpy"] == {
+        "version": "2.0.1",
+        "build": "py311h1_0",
+        "channel": "conda-forge",
+    }
+
+
+def test_parse_mamba_list():
+    packages = parse_package_list(MAMBA_LIST)
+    assert sorted(packages) == ["numpy", "qtpy", "requests"]
+    assert packages["requests"]["channel"] == "pypi"
+
+
+def test_parse_explicit_lockfile():
+    packages = parse_package_list(EXPLICIT_LOCKFILE)
+    assert packages["numpy"]["version"] == "1.26.4"
+    assert packages["numpy"]["build"] == "py311h64a7726_0"
+    assert packages["qtpy"]["channel"] == "https://conda.anaconda.org/conda-forge"
+
+
+def test_diff_package_lists():
+    good = parse_package_list(MAMBA_LIST)
+    bad = parse_package_list(MICROMAMBA_LIST)
+    assert diff_package_lists(good, bad) == ["numpy", "python", "qtpy", "requests"]
+
+
+def make_is_bad(culprits, untestable=()):
+    """Returns an `is_bad` that is bad with all culprits applied (and records calls)."""
+
+    calls = []
+
+    def is_bad(applied):
+        calls.append(set(applied))
+        if any(set(applied) == set(candidate) for candidate in untestable):
+            return None
+        return set(culprits) <= set(applied)
+
+    return is_bad, calls
+
+
+def test_find_culprits_single():
+    is_bad, _ = make_is_bad({"e"})
+    assert find_culprits(list("abcdefgh"), is_bad) == ["e"]
+
+
+def test_find_culprits_interacting():
+    is_bad, _ = make_is_bad({"b", "g"})
+    assert sorted(find_culprits(list("abcdefgh"), is_bad)) == ["b", "g"]
+
+
+def test_find_culprits_empty_and_single_change():
+    is_bad, calls = make_is_bad({"a"})
+    assert find_culprits([], is_bad) == []
+    assert find_culprits(["a"], is_bad) == ["a"]
+    assert calls == []
+
+
+def test_find_culprits_skips_untestable_half():
+    # The half with the culprit cannot be built on its own
+    is_bad, calls = make_is_bad({"b"}, untestable=[("a", "b")])
+    assert find_culprits(list("abcd"), is_bad) == ["b"]
+    assert {"a", "b"} in calls
+
+
+def test_find_culprits_untestable_is_not_bad():
+    # An untestable half must not be narrowed onto as if it were bad
+    is_bad, _ = make_is_bad({"d"}, untestable=[("a", "b")])
+    assert find_culprits(list("abcd"), is_bad) == ["d"]
+
+
+def test_find_culprits_searches_untestable_second_half_first():
+    is_bad, _ = make_is_bad({"d"}, untestable=[("c", "d")])
+    assert find_culprits(list("abcd"), is_bad) == ["d"]
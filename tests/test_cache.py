@@ -0,0 +1,32 @@
+import threading
+
+from envexp_utils import cache
+
+
+def test_evict_skips_entries_in_use(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "ENV_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(cache, "CACHE_INDEX", tmp_path / "index.json")
+    index = {}
+    for last_used, key in enumerate(["old", "in-use", "new"]):
+        (tmp_path / key).mkdir()
+        index[key] = {"prefix": str(tmp_path / key), "size": 1, "last_used": last_used}
+    cache.save_cache_index(index)
+
+    # Another thread is cloning from (or storing) the least recently used entry
+    restoring, evicted = threading.Event(), threading.Event()
+
+    def restore():
+        with cache.cache_key_lock("in-use"):
+            restoring.set()
+            evicted.wait()
+
+    thread = threading.Thread(target=restore)
+    thread.start()
+    restoring.wait()
+    cache.evict_environments(budget_gb=1.5 / 1024**3, keep="new")
+    evicted.set()
+    thread.join()
+
+    assert sorted(cache.load_cache_index()) == ["in-use", "new"]
+    assert not (tmp_path / "old").exists()
+    assert (tmp_path / "in-use").exists()
@@ -0,0 +1,33 @@
+import json
+
+from envexp_utils.environment import find_extra_packages
+
+PACKAGES = {
+    "numpy": ["python >=3.11", "libblas"],
+    "python": ["openssl"],
+    "openssl": [],
+    "libblas": [],
+    "pip": [],
+    "qtpy": ["packaging"],
+    "packaging": [],
+}
+
+
+def test_find_extra_packages(tmp_path):
+    (tmp_path / "conda-meta").mkdir()
+    for name, depends in PACKAGES.items():
+        record = {"name": name, "depends": depends}
+        (tmp_path / "conda-meta" / f"{name}-1.0-0.json").write_text(json.dumps(record))
+    environment_file = tmp_path / "environment.yml"
+    environment_file.write_text(
+        "channels:\n  - conda-forge\n"
+        "dependencies:\n  - conda-forge::numpy>=1\n  - python=3.11\n"
+    )
+
+    # The base's Qt packages are neither listed nor dependencies (pip is kept)
+    assert find_extra_packages(tmp_path, environment_file) == ["packaging", "qtpy"]
+
+
+def test_find_extra_packages_without_environment(tmp_path):
+    assert find_extra_packages(None) is None
+    assert find_extra_packages(tmp_path) is None
@@ -0,0 +1,32 @@
+from envexp_utils import executable
+
+CREATE_HELP = """\
+usage: conda create [-h] [--clone ENV] [--file FILE] [--dry-run] [--json-indent N]
+
+options:
+  --clone ENV           Create a new environment as a copy of an existing one.
+  -d, --dry-run         Only display what would have been done.
+"""
+
+
+def fake_probe(help_output):
+    def run_probe(path, *args):
+        return "conda 24.1.2\n" if args == ("--version",) else help_output
+
+    return run_probe
+
+
+def test_dry_run_json_needs_both_options(monkeypatch):
+    monkeypatch.setattr(executable, "run_probe", fake_probe(CREATE_HELP))
+    probe = executable.probe_conda("conda")
+
+    assert probe["version"] == "24.1.2"
+    # --json-indent is not --json
+    assert probe["capabilities"] == {"clone": True, "dry_run_json": False}
+
+
+def test_dry_run_json_with_json_option(monkeypatch):
+    help_output = CREATE_HELP + "  --json                Report all output as json.\n"
+    monkeypatch.setattr(executable, "run_probe", fake_probe(help_output))
+
+    assert executable.probe_conda("conda")["capabilities"]["dry_run_json"] is True
@@ -0,0 +1,21 @@
+import json
+
+from envexp_utils.history import RUN_REPORT_FILE, read_run
+
+
+def test_read_run_uses_the_recorded_yml_hash():
+    report = {"platform": "Linux-x86_64", "conda_command": "mamba", "yml_hash": "abc"}
+    blobs = {f"sha:{RUN_REPORT_FILE}": json.dumps(report)}
+
+    run, _, _, _ = read_run("sha", "2024-01-01", "P: run", blobs)
+
+    assert run["yml_hash"] == "abc"
+    assert run["status"] == "passed"
+
+
+def test_read_run_without_recorded_yml_hash():
+    blobs = {f"sha:{RUN_REPORT_FILE}": json.dumps({"phases": []})}
+
+    run, _, _, _ = read_run("sha", "2024-01-01", "F: run", blobs)
+
+    assert run["yml_hash"] is None
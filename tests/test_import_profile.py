@@ -0,0 +1,61 @@
+from envexp_utils.import_profile import find_regressions, flatten_tree, parse_importtime
+
+IMPORTTIME_OUTPUT = """\
+import time: self [us] | cumulative | imported package
+import time:       100 |        100 |   _io
+import time:       200 |        300 | io
+import time:        50 |         50 |     sleap.util
+import time:      1000 |       1050 |   sleap.io
+import time:        10 |         10 |   sleap.nn
+import time:      2000 |       3060 | sleap
+Some other stderr line
+"""
+
+
+def test_parse_importtime():
+    tree = parse_importtime(IMPORTTIME_OUTPUT)
+    assert [node["module"] for node in tree] == ["io", "sleap"]
+    io, sleap = tree
+    assert [child["module"] for child in io["children"]] == ["_io"]
+    assert [child["module"] for child in sleap["children"]] == ["sleap.io", "sleap.nn"]
+    sleap_io = sleap["children"][0]
+    assert sleap_io["self_us"] == 1000
+    assert sleap_io["cumulative_us"] == 1050
+    assert [child["module"] for child in sleap_io["children"]] == ["sleap.util"]
+
+
+def test_flatten_tree():
+    modules = flatten_tree(parse_importtime(IMPORTTIME_OUTPUT))
+    assert sorted(module["module"] for module in modules) == [
+        "_io",
+        "io",
+        "sleap",
+        "sleap.io",
+        "sleap.nn",
+        "sleap.util",
+    ]
+    assert all("children" not in module for module in modules)
+
+
+def make_profile(total_us, **cumulative_us):
+    return {
+        "total_us": total_us,
+        "top_cumulative": [
+            {"module": module, "cumulative_us": us}
+            for module, us in cumulative_us.items()
+        ],
+    }
+
+
+def test_find_regressions():
+    previous = make_profile(100_000, sleap=50_000, numpy=1_000)
+    profile = make_profile(101_000, sleap=70_000, numpy=3_000, qtpy=90_000)
+    regressions = find_regressions(profile, previous)
+    # numpy tripled but by less than 5 ms, and qtpy has no previous time
+    assert regressions == [
+        {"module": "sleap", "previous_us": 50_000, "cumulative_us": 70_000}
+    ]
+
+
+def test_find_regressions_without_previous_profile():
+    assert find_regressions(make_profile(1, sleap=1), None) == []
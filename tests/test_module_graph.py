@@ -0,0 +1,111 @@
+import pytest
+
+from envexp_utils.module_graph import (
+    extract_module_imports,
+    find_closure,
+    find_library_importers,
+    normalize_entry,
+    resolve_module_graph,
+)
+
+SOURCE = """\
+import os
+import numpy as np
+from qtpy import QtWidgets
+from . import utils
+from .io import reader
+from ..core import model
+
+
+def lazy():
+    import sleap.nn.training
+    from sleap.gui import *
+"""
+
+
+def test_extract_module_imports():
+    imports = extract_module_imports(
+        SOURCE, module="sleap.gui.app", is_package=False, package="sleap"
+    )
+    assert imports["external"] == ["numpy", "os", "qtpy"]
+    assert imports["internal"] == [
+        "sleap.core",
+        "sleap.core.model",
+        "sleap.gui",
+        "sleap.gui.io",
+        "sleap.gui.io.reader",
+        "sleap.gui.utils",
+        "sleap.nn.training",
+    ]
+
+
+def test_extract_module_imports_of_package():
+    # Relative imports of an __init__.py are relative to the package itself
+    imports = extract_module_imports(
+        "from .app import main\n", module="sleap.gui", is_package=True, package="sleap"
+    )
+    assert imports["internal"] == ["sleap.gui.app", "sleap.gui.app.main"]
+
+
+def test_extract_module_imports_beyond_top_level():
+    imports = extract_module_imports(
+        "from ... import x\n", module="sleap.io", is_package=False, package="sleap"
+    )
+    assert imports == {"internal": [], "external": []}
+
+
+def make_graph():
+    def imports(internal=(), external=()):
+        return {"internal": list(internal), "external": list(external)}
+
+    return resolve_module_graph(
+        "pkg",
+        {
+            "__init__.py": imports(),
+            "core.py": imports(external=["numpy"]),
+            "gui/__init__.py": imports(),
+            "gui/app.py": imports(["pkg.gui.widgets", "pkg.core"], ["os"]),
+            "gui/widgets.py": imports(["pkg.gui.widgets.Button"], ["qtpy"]),
+            "cli.py": imports(["pkg.core", "pkg.missing"]),
+        },
+    )
+
+
+def test_resolve_module_graph():
+    graph = make_graph()
+    assert graph["pkg.gui.app"]["imports"] == ["pkg.core", "pkg.gui.widgets"]
+    assert graph["pkg.gui.app"]["path"] == "gui/app.py"
+    # Names that are not modules of the repo (and self-imports) are dropped
+    assert graph["pkg.gui.widgets"]["imports"] == []
+    assert graph["pkg.cli"]["imports"] == ["pkg.core"]
+
+
+def test_find_closure():
+    graph = make_graph()
+    assert find_closure(graph, ["pkg.gui.app"]) == [
+        "pkg",
+        "pkg.core",
+        "pkg.gui",
+        "pkg.gui.app",
+        "pkg.gui.widgets",
+    ]
+    assert find_closure(graph, ["pkg.cli"]) == ["pkg", "pkg.cli", "pkg.core"]
+
+
+def test_find_closure_missing_entry():
+    with pytest.raises(ValueError):
+        find_closure(make_graph(), ["pkg.nope"])
+
+
+def test_find_library_importers():
+    direct, pulled = find_library_importers(make_graph(), "qtpy")
+    assert direct == {"pkg.gui.widgets"}
+    assert pulled == {"pkg.gui.app"}
+
+
+@pytest.mark.parametrize(
+    "entry",
+    ["pkg.gui.app", "gui.app", "gui/app.py", "gui\\app.py"],
+)
+def test_normalize_entry(entry):
+    assert normalize_entry(entry, "pkg") == "pkg.gui.app"
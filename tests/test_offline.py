@@ -0,0 +1,50 @@
+from envexp_utils import offline
+from envexp_utils.offline import offline_environment_file
+from envexp_utils.prefetch import find_python_version
+
+
+def test_offline_environment_file_replaces_channels(tmp_path, monkeypatch):
+    monkeypatch.setattr(offline, "OFFLINE_DIR", tmp_path / "offline")
+    environment_file = tmp_path / "environment.yml"
+    environment_file.write_text(
+        "name: experiment\nchannels:\n  - conda-forge\n  - defaults\n"
+        "dependencies:\n  - numpy\n  - pip:\n    - -e .\n"
+    )
+    channel_dir = tmp_path / "channel"
+    lines = offline_environment_file(environment_file, channel_dir).read_text()
+    assert lines.splitlines() == [
+        "name: experiment",
+        "channels:",
+        f"  - {channel_dir.as_uri()}",
+        "  - nodefaults",
+        "dependencies:",
+        "  - numpy",
+        "  - pip:",
+        f"    - -e {tmp_path.resolve().as_posix()}",
+    ]
+
+
+def test_offline_environment_file_adds_channels(tmp_path, monkeypatch):
+    monkeypatch.setattr(offline, "OFFLINE_DIR", tmp_path / "offline")
+    environment_file = tmp_path / "environment.yml"
+    environment_file.write_text("name: experiment\ndependencies:\n  - numpy\n")
+    channel_dir = tmp_path / "channel"
+    lines = offline_environment_file(environment_file, channel_dir).read_text()
+    assert lines.splitlines() == [
+        "name: experiment",
+        "channels:",
+        f"  - {channel_dir.as_uri()}",
+        "  - nodefaults",
+        "dependencies:",
+        "  - numpy",
+    ]
+
+
+def test_find_python_version():
+    base = "https://conda.anaconda.org/conda-forge/linux-64"
+    packages = [
+        (f"{base}/numpy-2.0.1-py311h1_0.conda", None),
+        (f"{base}/python-3.11.9-hb806964_0_cpython.conda", "abc"),
+    ]
+    assert find_python_version(packages) == "3.11"
+    assert find_python_version(packages[:1]) is None
@@ -0,0 +1,60 @@
+import threading
+from types import SimpleNamespace
+
+from envexp_utils import report
+
+
+def make_rusage(utime=0.0, stime=0.0, maxrss=0):
+    return SimpleNamespace(ru_utime=utime, ru_stime=stime, ru_maxrss=maxrss)
+
+
+def read_phases():
+    return {phase["name"]: phase for phase in report._report["phases"]}
+
+
+def test_concurrent_phases_only_count_their_own_children():
+    report.reset_run_report()
+    started = threading.Barrier(2)
+
+    def run_phase(name, child_cpu_s):
+        with report.timed_phase(name):
+            started.wait()
+            report.record_child_usage(make_rusage(utime=child_cpu_s))
+
+    threads = [
+        threading.Thread(target=run_phase, args=(name, child_cpu_s))
+        for name, child_cpu_s in [("solve", 2.0), ("log", 0.5)]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    phases = read_phases()
+    assert phases["solve"]["children_cpu_s"] == 2.0
+    assert phases["log"]["children_cpu_s"] == 0.5
+
+
+def test_nested_phases_count_children_of_inner_phases():
+    report.reset_run_report()
+    with report.timed_phase("outer"):
+        with report.timed_phase("inner"):
+            report.record_child_usage(make_rusage(utime=1.0, stime=0.25))
+
+    phases = read_phases()
+    assert phases["outer/inner"]["children_cpu_s"] == 1.25
+    assert phases["outer"]["children_cpu_s"] == 1.25
+
+
+def test_peak_rss_is_the_maximum_of_the_phases_own_children(monkeypatch):
+    monkeypatch.setattr(report.platform, "system", lambda: "Linux")
+    report.reset_run_report()
+    with report.timed_phase("solve"):
+        report.record_child_usage(make_rusage(maxrss=2048 * 1024))
+    with report.timed_phase("log"):
+        report.record_child_usage(make_rusage(maxrss=100 * 1024))
+        report.record_child_usage(make_rusage(maxrss=300 * 1024))
+
+    phases = read_phases()
+    assert phases["solve"]["children_peak_rss_mb"] == 2048.0
+    assert phases["log"]["children_peak_rss_mb"] == 300.0